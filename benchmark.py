@@ -0,0 +1,318 @@
+"""
+Synthetic-network benchmarks for routing, stepping and memory scaling.
+
+Graphs are generated offline as SnapshotGraphs with the attributes OSMnx produces
+(node x/y, edge length in meters and maxspeed in km/h), so runs are reproducible
+without OSM data. Each case runs in a fresh process so its peak RSS is its own.
+
+Usage:
+    python benchmark.py --graphs grid planar --sizes 1000 10000 100000 --vehicles 100 1000 --output bench.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from multiprocessing import get_context
+
+import numpy as np
+
+from fleet import Fleet
+from graph_snapshot import SnapshotGraph, arrays_from_edges
+from instrumentation import instruments
+from routing import RouteEngine
+from simulation_engine import SimulationEngine
+from traffic_network import TrafficNetwork, haversine
+from vehicles import Vehicle
+
+# Synthetic graphs are laid out around Waterloo, ON, like the example bbox in simulation_map.py
+ORIGIN_LON = -80.54
+ORIGIN_LAT = 43.47
+SPACING = 100.0  # Meters between neighboring intersections
+MAXSPEEDS = (40.0, 50.0, 60.0, 80.0)
+
+
+def _grid_layout(n_nodes):
+    side = max(2, math.ceil(math.sqrt(n_nodes)))
+    rows, cols = np.divmod(np.arange(side * side), side)
+    return side, rows, cols
+
+
+def _to_lon_lat(east, north):
+    lat = ORIGIN_LAT + north / 111320.0
+    lon = ORIGIN_LON + east / (111320.0 * math.cos(math.radians(ORIGIN_LAT)))
+    return lon, lat
+
+
+def _build_graph(x, y, tails, heads, rng, kind):
+    """Make every road two-way and attach lengths and speed limits."""
+    start = np.concatenate([tails, heads])
+    end = np.concatenate([heads, tails])
+    straight = haversine(x[start], y[start], x[end], y[end])
+    # Roads are a little longer than the straight line between their intersections
+    length = straight * rng.uniform(1.0, 1.2, len(start))
+    speed = rng.choice(MAXSPEEDS, len(tails))
+    maxspeed = np.concatenate([speed, speed])
+    node_ids = np.arange(1, len(x) + 1, dtype=np.int64)
+    arrays = arrays_from_edges(node_ids, x, y, start, end, np.zeros(len(start), dtype=np.int32), length, maxspeed)
+    return SnapshotGraph(arrays, meta={'generator': kind, 'num_nodes': len(x), 'num_edges': len(start)})
+
+
+def grid_graph(n_nodes, seed=0):
+    """
+    A square street grid with at least n_nodes intersections.
+
+    :param n_nodes: Minimum number of nodes; rounded up to a square.
+    :param seed: Random seed for edge lengths and speed limits.
+    :return: A SnapshotGraph.
+    """
+    rng = np.random.default_rng(seed)
+    side, rows, cols = _grid_layout(n_nodes)
+    x, y = _to_lon_lat(cols * SPACING, rows * SPACING)
+    ids = rows * side + cols
+    right = ids[cols < side - 1]
+    up = ids[rows < side - 1]
+    tails = np.concatenate([right, up])
+    heads = np.concatenate([right + 1, up + side])
+    return _build_graph(x, y, tails, heads, rng, 'grid')
+
+
+def random_planar_graph(n_nodes, seed=0, drop=0.15, diagonal=0.35):
+    """
+    An irregular planar road network: a grid whose intersections are jittered inside
+    their cells, with a fraction of streets removed and random diagonals added. A cell
+    gets at most one diagonal, so no two roads cross.
+
+    :param n_nodes: Minimum number of nodes; rounded up to a square.
+    :param seed: Random seed.
+    :param drop: Fraction of grid streets removed.
+    :param diagonal: Fraction of cells that get a diagonal road.
+    :return: A SnapshotGraph.
+    """
+    rng = np.random.default_rng(seed)
+    side, rows, cols = _grid_layout(n_nodes)
+    jitter = rng.uniform(-0.35, 0.35, (2, len(rows))) * SPACING
+    x, y = _to_lon_lat(cols * SPACING + jitter[0], rows * SPACING + jitter[1])
+    ids = rows * side + cols
+    right = ids[cols < side - 1]
+    up = ids[rows < side - 1]
+    tails = np.concatenate([right, up])
+    heads = np.concatenate([right + 1, up + side])
+    keep = rng.random(len(tails)) >= drop
+    tails, heads = tails[keep], heads[keep]
+
+    cells = ids[(cols < side - 1) & (rows < side - 1)]
+    cells = cells[rng.random(len(cells)) < diagonal]
+    rising = rng.random(len(cells)) < 0.5
+    diagonal_tails = np.where(rising, cells, cells + 1)
+    diagonal_heads = np.where(rising, cells + side + 1, cells + side)
+    return _build_graph(x, y, np.concatenate([tails, diagonal_tails]),
+                        np.concatenate([heads, diagonal_heads]), rng, 'planar')
+
+
+GENERATORS = {'grid': grid_graph, 'planar': random_planar_graph}
+
+
+class BenchmarkCTCU(RouteEngine):
+    """
+    A RouteEngine with the CTCU attributes vehicles expect, counting the routes it computes.
+    Simulators ask for reroutes in batches through calculate_best_routes, so those are counted
+    separately from initial routes.
+    """
+
+    def __init__(self, traffic_network, threshold_density=3):
+        super().__init__(traffic_network)
+        self.threshold_density = threshold_density
+        self.route_calls = 0
+        self.reroutes = 0
+
+    def calculate_best_route(self, start_node, destination_node, traffic_network=None, method='astar'):
+        self.route_calls += 1
+        return super().calculate_best_route(start_node, destination_node, traffic_network, method)
+
+    def calculate_best_routes(self, pairs, traffic_network=None):
+        self.reroutes += len(pairs)
+        return super().calculate_best_routes(pairs, traffic_network)
+
+    def notify_vehicle_exit(self, vehicle_id):
+        pass
+
+
+def trips(graph, count, span=30, seed=0):
+    """
+    Random origin-destination pairs at most `span` grid cells apart.
+
+    :return: List of (origin node id, destination node id).
+    """
+    rng = np.random.default_rng(seed)
+    n = len(graph.node_ids)
+    side = math.isqrt(n)
+    origins = rng.integers(0, n, count)
+    rows = np.clip(origins // side + rng.integers(-span, span + 1, count), 0, side - 1)
+    cols = np.clip(origins % side + rng.integers(-span, span + 1, count), 0, side - 1)
+    destinations = rows * side + cols
+    destinations = np.where(destinations == origins, (origins + 1) % n, destinations)
+    return list(zip(graph.node_ids[origins].tolist(), graph.node_ids[destinations].tolist()))
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _percentiles(samples):
+    if not samples:
+        return {}
+    values = np.array(samples) * 1000
+    return {'p50_ms': float(np.percentile(values, 50)), 'p90_ms': float(np.percentile(values, 90)),
+            'p99_ms': float(np.percentile(values, 99)), 'mean_ms': float(values.mean())}
+
+
+def bench_routes(network, pairs):
+    """Latency of single route queries on an empty network."""
+    engine = RouteEngine(network)
+    latencies = []
+    for origin, destination in pairs:
+        started = time.perf_counter()
+        engine.route(origin, destination)
+        latencies.append(time.perf_counter() - started)
+    return {'queries': len(pairs), **_percentiles(latencies)}
+
+
+def bench_fleet(network, pairs, ticks, dt, threshold_density):
+    """Step an array-based Fleet with congestion rerouting on a fresh network."""
+    ctc = BenchmarkCTCU(network, threshold_density)
+    fleet = Fleet(network, ctc, capacity=len(pairs))
+    for vehicle_id, (origin, destination) in enumerate(pairs):
+        fleet.add(vehicle_id, origin, destination, ctc.calculate_best_route(origin, destination))
+
+    tick_times = []
+    completed = 0
+    for _ in range(ticks):
+        started = time.perf_counter()
+        completed += fleet.step(dt)
+        tick_times.append(time.perf_counter() - started)
+    elapsed = sum(tick_times)
+    return {
+        'vehicles': len(pairs),
+        'ticks': ticks,
+        'ticks_per_sec': ticks / elapsed if elapsed else None,
+        'edges_per_sec': completed / elapsed if elapsed else None,
+        'reroutes': ctc.reroutes,
+        'reroutes_per_sec': ctc.reroutes / elapsed if elapsed else None,
+        'tick': _percentiles(tick_times),
+    }
+
+
+def bench_vehicles(network, pairs, duration, threshold_density):
+    """Run Vehicle objects through the event-driven SimulationEngine on a fresh network."""
+    ctc = BenchmarkCTCU(network, threshold_density)
+    engine = SimulationEngine(network, ctc)
+    start_time = network.clock.time()
+    for vehicle_id, (origin, destination) in enumerate(pairs):
+        engine.add_vehicle(Vehicle(vehicle_id, origin, destination), start_time + vehicle_id * 0.1)
+
+    started = time.perf_counter()
+    events = engine.run(until=start_time + duration)
+    elapsed = time.perf_counter() - started
+    return {
+        'vehicles': len(pairs),
+        'events': events,
+        'events_per_sec': events / elapsed if elapsed else None,
+        'route_calls': ctc.route_calls,
+        'reroutes': ctc.reroutes,
+        'reroutes_per_sec': ctc.reroutes / elapsed if elapsed else None,
+        'seconds': elapsed,
+    }
+
+
+def run_case(kind, size, vehicle_counts, args):
+    """Benchmark one graph; runs in its own process."""
+    result = {'graph': kind, 'requested_nodes': size}
+    started = time.perf_counter()
+    graph = GENERATORS[kind](size, seed=args.seed)
+    result['generate_seconds'] = time.perf_counter() - started
+    result['nodes'] = graph.number_of_nodes()
+    result['edges'] = graph.number_of_edges()
+
+    started = time.perf_counter()
+    network = TrafficNetwork(graph)
+    result['network_seconds'] = time.perf_counter() - started
+
+    result['routes'] = bench_routes(network, trips(graph, args.queries, args.span, args.seed))
+    result['fleet'] = []
+    result['vehicles'] = []
+    # Each run gets a fresh network: simulators leave occupancy, link-model queues and edge listeners behind
+    for count in vehicle_counts:
+        pairs = trips(graph, count, args.span, args.seed + count)
+        result['fleet'].append(bench_fleet(TrafficNetwork(graph), pairs, args.ticks, args.dt, args.threshold))
+        if count <= args.max_object_vehicles:
+            result['vehicles'].append(bench_vehicles(TrafficNetwork(graph), pairs, args.ticks * args.dt,
+                                                     args.threshold))
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--graphs', nargs='+', default=['grid', 'planar'], choices=sorted(GENERATORS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--vehicles', nargs='+', type=int, default=[100, 1000, 10000])
+    parser.add_argument('--max-object-vehicles', type=int, default=1000,
+                        help='Largest vehicle count also run with Vehicle objects and the event engine')
+    parser.add_argument('--queries', type=int, default=200, help='Route queries per graph')
+    parser.add_argument('--ticks', type=int, default=60)
+    parser.add_argument('--dt', type=float, default=1.0)
+    parser.add_argument('--span', type=int, default=30, help='Maximum trip length in grid cells')
+    parser.add_argument('--threshold', type=int, default=3, help='Density above which vehicles reroute')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = {
+        'commit': _commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+        'cases': [],
+    }
+    random.seed(args.seed)
+    instruments.configure(enabled=False)
+    context = get_context()
+    for kind in args.graphs:
+        for size in args.sizes:
+            # A fresh process per case, so peak RSS and allocator state don't carry over
+            with context.Pool(1, maxtasksperchild=1) as pool:
+                case = pool.apply(run_case, (kind, size, args.vehicles, args))
+            report['cases'].append(case)
+            print(f"{kind} {case['nodes']} nodes: route p50 {case['routes'].get('p50_ms', 0):.2f} ms, "
+                  f"peak RSS {case['peak_rss_mb']:.0f} MB", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
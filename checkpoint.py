@@ -0,0 +1,334 @@
+import heapq
+import json
+import math
+import os
+import random
+
+import numpy as np
+
+from fleet import SLOT_ARRAYS
+from vehicles import Vehicle
+
+CHECKPOINT_VERSION = 2
+
+# Node id stored for positions that are None
+NO_NODE = -1
+
+
+def _id_array(ids):
+    """Vehicle ids as an int64 array if they are all integers, otherwise as strings."""
+    if all(isinstance(i, (int, np.integer)) for i in ids):
+        return np.array(ids, dtype=np.int64)
+    if all(isinstance(i, str) for i in ids):
+        return np.array(ids, dtype=np.str_)
+    raise TypeError("Checkpoints support integer or string vehicle ids")
+
+
+def _node_array(nodes):
+    return np.array([NO_NODE if node is None else node for node in nodes], dtype=np.int64)
+
+
+def _node(value):
+    return None if value == NO_NODE else value
+
+
+def _ragged(rows, dtype):
+    """Concatenate variable-length rows into (ptr, values) arrays."""
+    ptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=ptr[1:])
+    values = np.concatenate([np.asarray(row, dtype=dtype) for row in rows]) if rows else np.empty(0, dtype=dtype)
+    return ptr, values.astype(dtype)
+
+
+def save_checkpoint(directory, traffic_network, engine=None, fleet=None, meta=None):
+    """
+    Write the simulation state to a directory of .npy arrays plus meta.json.
+
+    The checkpoint holds the clock, edge state (densities, lengths, speed limits and which
+    vehicle is on which edge since when), the signal controller, the random number
+    generator, and optionally the vehicles and event queue of a SimulationEngine and the
+    arrays of a Fleet. Routes shared by several vehicles are written once. The graph
+    itself is not included; restore into a network built from the same graph.
+
+    :param directory: The checkpoint directory (created if needed).
+    :param traffic_network: The traffic network instance.
+    :param engine: Optional SimulationEngine whose vehicles and events are saved.
+    :param fleet: Optional Fleet whose vehicles are saved.
+    :param meta: Optional extra metadata stored in meta.json.
+    """
+    edges = traffic_network.edges
+    arrays = {
+        'traffic_density': edges.traffic_density,
+        'length': edges.length,
+        'maxspeed': edges.maxspeed,
+    }
+
+    occupants = list(edges.vehicle_edge.items())
+    arrays['occupant_id'] = _id_array([vehicle_id for vehicle_id, _ in occupants])
+    arrays['occupant_edge'] = np.array([i for _, i in occupants], dtype=np.int64)
+    arrays['occupant_arrival'] = np.array(
+        [edges.arrival_times.get(i, {}).get(vehicle_id, math.nan) for vehicle_id, i in occupants], dtype=np.float64)
+    # The link model's queue order, scheduled exits and pending slowdowns
+    link_model = traffic_network.link_model
+    arrays['occupant_order'] = np.array([link_model.order.get(vehicle_id, -1) for vehicle_id, _ in occupants],
+                                        dtype=np.int64)
+    arrays['occupant_exit'] = np.array([link_model.exit_at.get(vehicle_id, math.nan) for vehicle_id, _ in occupants],
+                                       dtype=np.float64)
+    arrays['occupant_speed_factor'] = np.array(
+        [link_model.speed_factor.get(vehicle_id, math.nan) for vehicle_id, _ in occupants], dtype=np.float64)
+    waiting = [(vehicle_id, i, since, payload) for i, queue in link_model.waiting.items()
+               for vehicle_id, (since, payload) in queue.items()]
+    arrays['waiting_id'] = _id_array([entry[0] for entry in waiting])
+    arrays['waiting_edge'] = np.array([entry[1] for entry in waiting], dtype=np.int64)
+    arrays['waiting_since'] = np.array([entry[2] for entry in waiting], dtype=np.float64)
+    arrays['waiting_data'] = np.array(['' if entry[3] is None else json.dumps(entry[3]) for entry in waiting],
+                                      dtype=np.str_)
+
+    signals = traffic_network.signals
+    nodes = list(signals.state_index)
+    arrays['signal_node'] = np.array(nodes, dtype=np.int64)
+    arrays['signal_state'] = np.array([signals.state_index[node] for node in nodes], dtype=np.int32)
+    arrays['signal_delay'] = np.array([signals.delay[node] for node in nodes], dtype=np.float64)
+    arrays['signal_next_switch'] = np.array([signals.next_switch.get(node, math.nan) for node in nodes],
+                                            dtype=np.float64)
+    arrays['signal_plan_ptr'], arrays['signal_plan'] = _ragged([signals.plans.get(node, ()) for node in nodes],
+                                                               np.float64)
+
+    info = dict(meta or {})
+    info.update({
+        'version': CHECKPOINT_VERSION,
+        'time': traffic_network.clock.time(),
+        'num_nodes': int(len(edges.node_ids)),
+        'num_edges': int(len(edges)),
+        'random_state': random.getstate(),
+        'engine': engine is not None,
+        'fleet': fleet is not None,
+    })
+    if engine is not None:
+        arrays.update(_engine_arrays(engine))
+        info['events_processed'] = engine.events_processed
+    if fleet is not None:
+        arrays.update(_fleet_arrays(fleet))
+        info['route_used'] = fleet.route_used
+    info['arrays'] = sorted(arrays)
+
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f'{name}.npy'), array)
+    # Written last so a partially written checkpoint is never picked up
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(info, f)
+
+
+def _engine_arrays(engine):
+    events = engine.pending_events()
+    vehicles = list(engine.vehicles.values())
+    rows = {id(vehicle): i for i, vehicle in enumerate(vehicles)}
+    for _, _, vehicle, _ in events:
+        if vehicle is not None and id(vehicle) not in rows:
+            rows[id(vehicle)] = len(vehicles)
+            vehicles.append(vehicle)
+
+    # Each distinct route buffer is written once
+    buffers, route_ids, cursors = [], [], []
+    buffer_ids = {}
+    for vehicle in vehicles:
+        route, cursor = vehicle.route_state()
+        j = buffer_ids.get(id(route))
+        if j is None:
+            j = buffer_ids[id(route)] = len(buffers)
+            buffers.append(route)
+        route_ids.append(j)
+        cursors.append(cursor)
+    route_ptr, route_nodes = _ragged(buffers, np.int32)
+
+    return {
+        'vehicle_id': _id_array([vehicle.vehicle_id for vehicle in vehicles]),
+        'vehicle_current': _node_array([vehicle.current_position for vehicle in vehicles]),
+        'vehicle_next': _node_array([vehicle.next_position for vehicle in vehicles]),
+        'vehicle_destination': _node_array([vehicle.destination for vehicle in vehicles]),
+        'vehicle_speed': np.array([vehicle.speed for vehicle in vehicles], dtype=np.float64),
+        'vehicle_state': np.array([vehicle.state_code for vehicle in vehicles], dtype=np.int8),
+        'vehicle_route': np.array(route_ids, dtype=np.int64),
+        'vehicle_cursor': np.array(cursors, dtype=np.int64),
+        'vehicle_on_network': np.arange(len(vehicles)) < len(engine.vehicles),
+        'route_ptr': route_ptr,
+        'route_nodes': route_nodes,
+        'event_time': np.array([event[0] for event in events], dtype=np.float64),
+        'event_kind': np.array([event[1] for event in events], dtype=np.str_),
+        'event_vehicle': np.array([-1 if event[2] is None else rows[id(event[2])] for event in events],
+                                  dtype=np.int64),
+        'event_data': np.array(['' if event[3] is None else json.dumps(event[3]) for event in events],
+                               dtype=np.str_),
+    }
+
+
+def _fleet_arrays(fleet):
+    n = fleet.size
+    arrays = {f'fleet_{name}': getattr(fleet, name)[:n] for name in SLOT_ARRAYS}
+    arrays['fleet_vehicle_id'] = _id_array(fleet.vehicle_ids)
+    arrays['fleet_route_nodes'] = fleet.route_nodes[:fleet.route_used]
+    return arrays
+
+
+def load_checkpoint(directory, mmap_mode='c'):
+    """
+    Open a checkpoint, memory-mapping its arrays. Restoring copies only what it changes,
+    so one loaded checkpoint can be restored into many scenario branches.
+
+    :param directory: The checkpoint directory.
+    :param mmap_mode: The memory-map mode passed to np.load; 'c' maps copy-on-write.
+    :return: A Checkpoint, or None if no complete checkpoint exists there.
+    """
+    meta_path = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('version') != CHECKPOINT_VERSION:
+        return None
+    arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode)
+              for name in meta['arrays']}
+    return Checkpoint(meta, arrays)
+
+
+class Checkpoint:
+    """A loaded checkpoint that can be restored into a network, engine and fleet."""
+
+    def __init__(self, meta, arrays):
+        self.meta = meta
+        self.arrays = arrays
+
+    @property
+    def time(self):
+        return self.meta['time']
+
+    def restore(self, traffic_network, engine=None, fleet=None):
+        """
+        Reset the given objects to the checkpointed state.
+
+        :param traffic_network: A network built from the graph the checkpoint was taken on.
+        :param engine: Optional SimulationEngine to restore vehicles and events into.
+        :param fleet: Optional Fleet to restore vehicles into.
+        """
+        meta, arrays = self.meta, self.arrays
+        edges = traffic_network.edges
+        if meta['num_edges'] != len(edges) or meta['num_nodes'] != len(edges.node_ids):
+            raise ValueError("Checkpoint was taken on a different graph")
+        if engine is not None and not meta['engine']:
+            raise ValueError("Checkpoint has no engine state")
+        if fleet is not None and not meta['fleet']:
+            raise ValueError("Checkpoint has no fleet state")
+
+        clock = traffic_network.clock
+        if hasattr(clock, 'set_time'):
+            clock.set_time(meta['time'])
+        random.setstate(_random_state(meta['random_state']))
+
+        # Copy in place, so arrays shared with a Fleet or PartitionedSimulation stay shared
+        edges.traffic_density[:] = arrays['traffic_density']
+        edges.length[:] = arrays['length']
+        edges.maxspeed[:] = arrays['maxspeed']
+        traffic_network.edge_cost_cache.mark_all()
+        self._restore_occupancy(edges)
+        self._restore_link_model(traffic_network.link_model)
+        self._restore_signals(traffic_network)
+        if engine is not None:
+            self._restore_engine(traffic_network, engine)
+        if fleet is not None:
+            self._restore_fleet(fleet)
+
+    def _restore_occupancy(self, edges):
+        arrays = self.arrays
+        edges.occupants, edges.arrival_times, edges.vehicle_edge = {}, {}, {}
+        for vehicle_id, i, arrival_time in zip(arrays['occupant_id'].tolist(), arrays['occupant_edge'].tolist(),
+                                               arrays['occupant_arrival'].tolist()):
+            edges.vehicle_edge[vehicle_id] = i
+            edges.occupants.setdefault(i, set()).add(vehicle_id)
+            if arrival_time == arrival_time:
+                edges.arrival_times.setdefault(i, {})[vehicle_id] = arrival_time
+
+    def _restore_link_model(self, link_model):
+        arrays = self.arrays
+        vehicle_ids = arrays['occupant_id'].tolist()
+        link_model.rebuild(dict(zip(vehicle_ids, arrays['occupant_order'].tolist())))
+        for vehicle_id, exit_at, factor in zip(vehicle_ids, arrays['occupant_exit'].tolist(),
+                                               arrays['occupant_speed_factor'].tolist()):
+            if exit_at == exit_at:
+                link_model.exit_at[vehicle_id] = exit_at
+            if factor == factor:
+                link_model.speed_factor[vehicle_id] = factor
+        for vehicle_id, i, since, data in zip(arrays['waiting_id'].tolist(), arrays['waiting_edge'].tolist(),
+                                              arrays['waiting_since'].tolist(), arrays['waiting_data'].tolist()):
+            link_model.block(vehicle_id, i, json.loads(data) if data else None, since)
+
+    def _restore_signals(self, traffic_network):
+        arrays = self.arrays
+        signals = traffic_network.signals
+        nodes = arrays['signal_node'].tolist()
+        ptr = arrays['signal_plan_ptr'].tolist()
+        plans = arrays['signal_plan']
+        signals.state_index = dict(zip(nodes, arrays['signal_state'].tolist()))
+        signals.delay = dict(zip(nodes, arrays['signal_delay'].tolist()))
+        signals.next_switch = {node: t for node, t in zip(nodes, arrays['signal_next_switch'].tolist()) if t == t}
+        signals.plans = {node: plans[ptr[k]:ptr[k + 1]].tolist() for k, node in enumerate(nodes)
+                         if ptr[k + 1] > ptr[k]}
+        signals.heap = [(t, node) for node, t in signals.next_switch.items()]
+        heapq.heapify(signals.heap)
+        traffic_network.sync_signals()
+
+    def _restore_engine(self, traffic_network, engine):
+        arrays = self.arrays
+        ptr = arrays['route_ptr'].tolist()
+        route_nodes = arrays['route_nodes']
+        buffers = []
+        for k in range(len(ptr) - 1):
+            route = route_nodes[ptr[k]:ptr[k + 1]]
+            route.flags.writeable = False
+            buffers.append(route)
+
+        vehicles = []
+        on_network = []
+        for vehicle_id, current, next_position, destination, speed, state, route, cursor, active in zip(
+                arrays['vehicle_id'].tolist(), arrays['vehicle_current'].tolist(), arrays['vehicle_next'].tolist(),
+                arrays['vehicle_destination'].tolist(), arrays['vehicle_speed'].tolist(),
+                arrays['vehicle_state'].tolist(), arrays['vehicle_route'].tolist(),
+                arrays['vehicle_cursor'].tolist(), arrays['vehicle_on_network'].tolist()):
+            vehicle = Vehicle(vehicle_id, _node(current), _node(destination), speed)
+            vehicle.next_position = _node(next_position)
+            vehicle.state_code = state
+            vehicle.set_route_state(buffers[route], cursor, traffic_network)
+            vehicles.append(vehicle)
+            if active:
+                on_network.append(vehicle)
+
+        events = [(event_time, kind, None if row < 0 else vehicles[row], json.loads(data) if data else None)
+                  for event_time, kind, row, data in zip(
+                      arrays['event_time'].tolist(), arrays['event_kind'].tolist(),
+                      arrays['event_vehicle'].tolist(), arrays['event_data'].tolist())]
+        engine.load_events(events, on_network)
+        engine.events_processed = self.meta.get('events_processed', 0)
+
+    def _restore_fleet(self, fleet):
+        arrays = self.arrays
+        vehicle_ids = arrays['fleet_vehicle_id'].tolist()
+        n = len(vehicle_ids)
+        if n > len(fleet.current):
+            fleet._grow(n)
+        for name in SLOT_ARRAYS:
+            getattr(fleet, name)[:n] = arrays[f'fleet_{name}']
+        used = self.meta['route_used']
+        if used > len(fleet.route_nodes):
+            fleet.route_nodes = np.empty(2 * used, dtype=np.int32)
+        fleet.route_nodes[:used] = arrays['fleet_route_nodes']
+        fleet.route_used = used
+        fleet.size = n
+        fleet.vehicle_ids = vehicle_ids
+        fleet.index = {vehicle_id: slot for slot, vehicle_id in enumerate(vehicle_ids)}
+        fleet.refresh_signals()
+
+
+def _random_state(state):
+    """random.getstate() comes back from JSON with lists where it had tuples."""
+    version, internal, gauss = state
+    return version, tuple(internal), gauss
@@ -0,0 +1,485 @@
+import hashlib
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from instrumentation import instruments
+
+# Topology arrays persisted by CustomizableContractionHierarchy.save
+CCH_ARRAYS = ('rank', 'up_ptr', 'up_head', 'arc_tail', 'parent',
+              'triangle_low', 'triangle_high', 'triangle_top', 'level_ptr', 'edge_arc', 'edge_upward')
+
+
+class CustomizableContractionHierarchy:
+    """
+    Customizable contraction hierarchy (CCH) over a TrafficNetwork's edge store.
+
+    Preprocessing computes a metric-independent contraction order (geometric nested
+    dissection, or minimum degree when nodes have no coordinates) and the resulting
+    chordal "arc" graph once. Customization
+    then assigns edge costs to the arcs and relaxes every lower triangle, level by
+    level, in vectorized passes; it is rerun whenever traffic densities change.
+    Queries walk the elimination tree upwards from both ends, so they never touch a
+    priority queue.
+
+    Arcs are undirected pairs {y, z} with rank[y] < rank[z]; each has an upward
+    cost (y -> z) and a downward cost (z -> y).
+    """
+
+    def __init__(self, arrays, num_nodes, topology=None):
+        self.num_nodes = num_nodes
+        self.topology = topology  # Digest of the edge endpoints the hierarchy was built for
+        for name in CCH_ARRAYS:
+            setattr(self, name, arrays[name])
+        num_arcs = len(self.up_head)
+        self.up_cost = np.full(num_arcs, np.inf)
+        self.down_cost = np.full(num_arcs, np.inf)
+        self.up_via = np.full(num_arcs, -1, dtype=np.int32)
+        self.down_via = np.full(num_arcs, -1, dtype=np.int32)
+        self._build_lookup()
+
+    def _build_lookup(self):
+        # Python lists and an arc lookup for the scalar query and path unpacking loops
+        self._up_ptr = self.up_ptr.tolist()
+        self._up_head = self.up_head.tolist()
+        self._parent = self.parent.tolist()
+        self._rank = self.rank.tolist()
+        self._up_via = self.up_via.tolist()
+        self._down_via = self.down_via.tolist()
+        self._arc_index = {(t, h): a for a, (t, h) in enumerate(zip(self.arc_tail.tolist(), self._up_head))}
+        self._up_cost_list = self.up_cost.tolist()
+        self._down_cost_list = self.down_cost.tolist()
+        # Scratch distance and predecessor lists for queries; only nodes on the search paths are touched
+        self._forward = [math.inf] * self.num_nodes
+        self._backward = [math.inf] * self.num_nodes
+        self._prev_forward = [-1] * self.num_nodes
+        self._prev_backward = [-1] * self.num_nodes
+
+    @classmethod
+    def build(cls, edges, node_x=None, node_y=None):
+        """
+        Compute the contraction order and arc graph for an edge store. This is the slow,
+        metric-independent step; its result can be saved and reused across runs.
+
+        :param edges: The EdgeStore of the network.
+        :param node_x: Optional node longitudes; with node_y, enables a nested dissection order.
+        :param node_y: Optional node latitudes.
+        """
+        n = len(edges.node_ids)
+        tails, heads = edges.start_index.tolist(), edges.end_index.tolist()
+        neighbors = [set() for _ in range(n)]
+        for u, v in zip(tails, heads):
+            if u != v:
+                neighbors[u].add(v)
+                neighbors[v].add(u)
+
+        if node_x is not None and node_y is not None and np.isfinite(node_x).all() and np.isfinite(node_y).all():
+            order = _nested_dissection_order(edges.start_index, edges.end_index, node_x, node_y)
+        else:
+            order = _minimum_degree_order(neighbors)
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n)
+
+        # Eliminate nodes in order, recording the upward neighbors of each and adding fill-in arcs
+        upward = [None] * n
+        for v in order.tolist():
+            nbs = neighbors[v]
+            upward[v] = list(nbs)
+            for a in nbs:
+                neighbors[a].discard(v)
+            for a in nbs:
+                na = neighbors[a]
+                for b in nbs:
+                    if a != b:
+                        na.add(b)
+            neighbors[v] = None
+
+        # Upward arcs in CSR form, with each node's arcs sorted by the rank of their head
+        up_ptr = np.zeros(n + 1, dtype=np.int64)
+        up_ptr[1:] = np.cumsum([len(upward[v]) for v in range(n)])
+        up_head = np.empty(up_ptr[-1], dtype=np.int32)
+        for v in range(n):
+            up_head[up_ptr[v]:up_ptr[v + 1]] = sorted(upward[v], key=lambda w: rank[w])
+        arc_tail = np.repeat(np.arange(n, dtype=np.int32), np.diff(up_ptr))
+        parent = np.full(n, -1, dtype=np.int32)
+        has_up = np.diff(up_ptr) > 0
+        parent[has_up] = up_head[up_ptr[:-1][has_up]]
+
+        arc_index = {(t, h): a for a, (t, h) in enumerate(zip(arc_tail.tolist(), up_head.tolist()))}
+
+        # Lower triangles: for node x with upward neighbors y, z (rank y < rank z), arcs {x,y}, {x,z} shortcut {y,z}
+        triangles = []
+        for x in range(n):
+            start, end = int(up_ptr[x]), int(up_ptr[x + 1])
+            for i in range(start, end):
+                y = int(up_head[i])
+                for j in range(i + 1, end):
+                    triangles.append((i, j, arc_index[(y, int(up_head[j]))]))
+        triangles = np.array(triangles, dtype=np.int64).reshape(-1, 3)
+
+        # Group triangles by the elimination tree level of their lowest node so each level is one pass
+        level = np.zeros(n, dtype=np.int64)
+        for x in np.argsort(rank).tolist():
+            p = parent[x]
+            if p >= 0:
+                level[p] = max(level[p], level[x] + 1)
+        triangle_level = level[arc_tail[triangles[:, 0]]] if len(triangles) else np.empty(0, dtype=np.int64)
+        order = np.argsort(triangle_level, kind='stable')
+        triangles = triangles[order]
+        level_ptr = np.searchsorted(triangle_level[order], np.arange(level.max() + 2 if n else 1))
+
+        # Map every original edge onto its arc and direction
+        edge_tail, edge_head = np.asarray(tails, dtype=np.int64), np.asarray(heads, dtype=np.int64)
+        edge_upward = rank[edge_tail] < rank[edge_head]
+        low = np.where(edge_upward, edge_tail, edge_head)
+        high = np.where(edge_upward, edge_head, edge_tail)
+        edge_arc = np.array([arc_index.get((a, b), -1) for a, b in zip(low.tolist(), high.tolist())], dtype=np.int64)
+
+        arrays = {
+            'rank': rank,
+            'up_ptr': up_ptr,
+            'up_head': up_head,
+            'arc_tail': arc_tail,
+            'parent': parent,
+            'triangle_low': triangles[:, 0],
+            'triangle_high': triangles[:, 1],
+            'triangle_top': triangles[:, 2],
+            'level_ptr': level_ptr.astype(np.int64),
+            'edge_arc': edge_arc,
+            'edge_upward': edge_upward,
+        }
+        return cls(arrays, n, topology_digest(edges))
+
+    def customize(self, edge_costs):
+        """
+        Re-weight the hierarchy for new edge costs.
+
+        :param edge_costs: Array with the cost of every edge in the edge store.
+        """
+        edge_costs = np.asarray(edge_costs, dtype=np.float64)
+        up = np.full(len(self.up_head), np.inf)
+        down = np.full(len(self.up_head), np.inf)
+        valid = self.edge_arc >= 0
+        is_up = valid & self.edge_upward
+        is_down = valid & ~self.edge_upward
+        np.minimum.at(up, self.edge_arc[is_up], edge_costs[is_up])
+        np.minimum.at(down, self.edge_arc[is_down], edge_costs[is_down])
+        up_via = np.full(len(self.up_head), -1, dtype=np.int32)
+        down_via = np.full(len(self.up_head), -1, dtype=np.int32)
+
+        low, high, top = self.triangle_low, self.triangle_high, self.triangle_top
+        ptr = self.level_ptr
+        for level in range(len(ptr) - 1):
+            s = slice(ptr[level], ptr[level + 1])
+            if ptr[level] == ptr[level + 1]:
+                continue
+            xy, xz, yz = low[s], high[s], top[s]
+            via = self.arc_tail[xy]
+            # y -> x -> z improves the upward cost of {y, z}; z -> x -> y the downward one
+            for cost, via_arr, candidate in ((up, up_via, down[xy] + up[xz]), (down, down_via, down[xz] + up[xy])):
+                before = cost[yz]
+                np.minimum.at(cost, yz, candidate)
+                improved = (candidate < before) & (candidate == cost[yz])
+                via_arr[yz[improved]] = via[improved]
+
+        self.up_cost, self.down_cost = up, down
+        self.up_via, self.down_via = up_via, down_via
+        self._up_cost_list = up.tolist()
+        self._down_cost_list = down.tolist()
+        self._up_via = up_via.tolist()
+        self._down_via = down_via.tolist()
+
+    def query(self, source, target):
+        """
+        Compute the shortest path between two node indices.
+
+        :return: A (cost, path) tuple where path is an int32 array of node indices,
+                 or (inf, None) if the target is unreachable.
+        """
+        forward, forward_prev, forward_path = self._upward_search(source, self._up_cost_list, self._forward, self._prev_forward)
+        backward, backward_prev, backward_path = self._upward_search(target, self._down_cost_list, self._backward, self._prev_backward)
+
+        # Both searches reach the root path; the best meeting node is on the shared part
+        best, meeting = math.inf, None
+        for v in forward_path:
+            d = forward[v] + backward[v]
+            if d < best:
+                best, meeting = d, v
+
+        path = None
+        if meeting is not None:
+            path = [meeting]
+            v = meeting
+            while v != source:
+                u = forward_prev[v]
+                path[:0] = self._unpack(u, v)[:-1]
+                v = u
+            v = meeting
+            while v != target:
+                w = backward_prev[v]
+                path.extend(self._unpack(v, w)[1:])
+                v = w
+            path = np.array(path, dtype=np.int32)
+
+        # Reset the scratch arrays for the next query
+        for dist, touched in ((forward, forward_path), (backward, backward_path)):
+            for v in touched:
+                dist[v] = math.inf
+        return best, path
+
+    def _upward_search(self, start, costs, dist, prev):
+        """
+        Relax upward arcs along the elimination tree path from start to the root.
+
+        :return: The distance and predecessor lists, and the nodes on the path.
+        """
+        up_ptr, up_head, parent = self._up_ptr, self._up_head, self._parent
+        dist[start] = 0.0
+        path = []
+        v = start
+        while v != -1:
+            path.append(v)
+            d = dist[v]
+            if d != math.inf:
+                for a in range(up_ptr[v], up_ptr[v + 1]):
+                    nd = d + costs[a]
+                    w = up_head[a]
+                    if nd < dist[w]:
+                        dist[w] = nd
+                        prev[w] = v
+            v = parent[v]
+        return dist, prev, path
+
+    def _unpack(self, u, v):
+        """Expand the (possibly shortcut) hop u -> v into original nodes, including both ends."""
+        stack = [(u, v)]
+        path = [u]
+        while stack:
+            a, b = stack.pop()
+            if self._rank[a] < self._rank[b]:
+                via = self._up_via[self._arc_index[(a, b)]]
+            else:
+                via = self._down_via[self._arc_index[(b, a)]]
+            if via < 0:
+                path.append(b)
+            else:
+                stack.append((via, b))
+                stack.append((a, via))
+        return path
+
+    def save(self, directory):
+        """
+        Save the metric-independent part of the hierarchy, e.g. next to a graph snapshot.
+
+        :param directory: The directory to write to (created if needed).
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in CCH_ARRAYS:
+            np.save(os.path.join(directory, f'cch_{name}.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'cch_meta.json'), 'w') as f:
+            json.dump({'num_nodes': self.num_nodes, 'num_edges': int(len(self.edge_arc)),
+                       'topology': self.topology}, f)
+
+    @classmethod
+    def load(cls, directory, edges=None, mmap_mode='r'):
+        """
+        Load a hierarchy saved with save().
+
+        :param directory: The directory it was saved to.
+        :param edges: Optional EdgeStore to check the hierarchy against.
+        :return: The hierarchy, or None if there is none or it doesn't match the edges.
+        """
+        meta_path = os.path.join(directory, 'cch_meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if edges is not None and (meta['num_nodes'] != len(edges.node_ids) or meta['num_edges'] != len(edges)
+                                  or meta.get('topology') != topology_digest(edges)):
+            return None
+        arrays = {name: np.load(os.path.join(directory, f'cch_{name}.npy'), mmap_mode=mmap_mode)
+                  for name in CCH_ARRAYS}
+        return cls(arrays, meta['num_nodes'], meta.get('topology'))
+
+
+def topology_digest(edges):
+    """
+    Hash the endpoints of every edge, so a saved hierarchy is only reused for the same graph.
+
+    :param edges: The EdgeStore of the network.
+    :return: A hex digest.
+    """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(edges.start_index, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(edges.end_index, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def _minimum_degree_order(neighbors):
+    """Minimum degree elimination order, simulating the fill-in on a copy of the adjacency."""
+    n = len(neighbors)
+    neighbors = [set(nb) for nb in neighbors]
+    degree = [len(nb) for nb in neighbors]
+    buckets = {}
+    for v in range(n):
+        buckets.setdefault(degree[v], set()).add(v)
+    order = []
+    min_degree = 0
+    for _ in range(n):
+        while not buckets.get(min_degree):
+            min_degree += 1
+        v = buckets[min_degree].pop()
+        order.append(v)
+        nbs = neighbors[v]
+        for a in nbs:
+            neighbors[a].discard(v)
+            neighbors[a].update(b for b in nbs if b != a)
+        for a in nbs:
+            d = len(neighbors[a])
+            if d != degree[a]:
+                buckets[degree[a]].discard(a)
+                buckets.setdefault(d, set()).add(a)
+                degree[a] = d
+                min_degree = min(min_degree, d)
+        neighbors[v] = set()
+    return np.array(order, dtype=np.int64)
+
+
+def _nested_dissection_order(tails, heads, node_x, node_y, leaf_size=32):
+    """
+    Geometric nested dissection order. Each cell is split at the median of its longer
+    axis; the nodes of one half that touch the other half form the separator and are
+    ordered after both halves, so queries only climb through separators.
+    """
+    n = len(node_x)
+    x = np.asarray(node_x, dtype=np.float64) * np.cos(np.radians(np.nanmean(node_y)))
+    y = np.asarray(node_y, dtype=np.float64)
+    tails = np.asarray(tails, dtype=np.int64)
+    heads = np.asarray(heads, dtype=np.int64)
+    side = np.zeros(n, dtype=np.int8)  # Scratch: 1 for the A half, 2 for the B half, 0 otherwise
+    order = np.empty(n, dtype=np.int64)
+    position = n  # Separators are filled in from the back
+    leaves = []
+
+    # Each cell carries its nodes and the edges with both ends inside it
+    stack = [(np.arange(n), np.flatnonzero(tails != heads))]
+    while stack:
+        nodes, cell_edges = stack.pop()
+        if len(nodes) <= leaf_size:
+            leaves.append(nodes)
+            continue
+        xs, ys = x[nodes], y[nodes]
+        coords = xs if np.ptp(xs) >= np.ptp(ys) else ys
+        in_a = np.zeros(len(nodes), dtype=bool)
+        in_a[np.argsort(coords, kind='stable')[:len(nodes) // 2]] = True
+        side[nodes[in_a]] = 1
+        side[nodes[~in_a]] = 2
+
+        # Nodes of A adjacent to B become the separator
+        t, h = tails[cell_edges], heads[cell_edges]
+        st, sh = side[t], side[h]
+        cross = st != sh
+        separator = np.unique(np.where(st[cross] == 1, t[cross], h[cross]))
+        position -= len(separator)
+        order[position:position + len(separator)] = separator
+        side[separator] = 0
+        st, sh = side[t], side[h]
+
+        a_nodes = nodes[side[nodes] == 1]
+        b_nodes = nodes[side[nodes] == 2]
+        a_edges = cell_edges[(st == 1) & (sh == 1)]
+        b_edges = cell_edges[(st == 2) & (sh == 2)]
+        side[nodes] = 0
+        stack.append((a_nodes, a_edges))
+        stack.append((b_nodes, b_edges))
+
+    if leaves:
+        order[:position] = np.concatenate(leaves)
+    return order
+
+
+class CCHRouter:
+    """
+    Routes over a TrafficNetwork with a customizable contraction hierarchy, offering the
+    same calculate_best_route interface as RouteEngine.
+
+    The hierarchy is re-customized lazily: any change to the network's edge costs marks the
+    router dirty, and the next query customizes it first. Queries made together through
+    calculate_best_routes share one customization.
+    """
+
+    def __init__(self, traffic_network, hierarchy=None, directory=None):
+        """
+        :param traffic_network: The traffic network instance.
+        :param hierarchy: A prebuilt hierarchy; otherwise it is loaded from directory or built.
+        :param directory: Where the hierarchy is persisted; defaults to the graph snapshot's directory.
+        """
+        self.traffic_network = traffic_network
+        self.edges = traffic_network.edges
+        if directory is None:
+            directory = getattr(traffic_network.graph, 'directory', None)
+        if hierarchy is None and directory is not None:
+            hierarchy = CustomizableContractionHierarchy.load(directory, self.edges)
+        if hierarchy is None:
+            hierarchy = CustomizableContractionHierarchy.build(
+                self.edges, traffic_network.node_x, traffic_network.node_y)
+            if directory is not None:
+                hierarchy.save(directory)
+        self.hierarchy = hierarchy
+        self.costs = traffic_network.edge_cost_cache
+        self.customized_version = None  # The edge cost version the hierarchy was last customized for
+        self.customize()
+
+    @property
+    def dirty(self):
+        """True if edge costs may have changed since the hierarchy was last customized."""
+        return self.customized_version != self.costs.version
+
+    def customize(self):
+        """Re-weight the hierarchy for the current traffic densities."""
+        started = time.perf_counter() if instruments.enabled else None
+        self.hierarchy.customize(self.traffic_network.edge_costs())
+        self.customized_version = self.costs.version
+        if started is not None:
+            instruments.observe('cch.customize', time.perf_counter() - started)
+
+    def refresh(self):
+        """
+        Customize the hierarchy if edge costs changed since the last customization.
+
+        :return: True if it was re-customized.
+        """
+        if not self.dirty:
+            return False
+        self.customize()
+        return True
+
+    def route(self, start_node, destination_node):
+        """
+        :return: int32 array of node indices including both ends, or None if unreachable.
+        """
+        self.refresh()
+        started = time.perf_counter() if instruments.enabled else None
+        try:
+            source, target = self.edges.node_index([start_node, destination_node]).tolist()
+        except KeyError:
+            return None  # A node that isn't in the network can't be reached
+        path = self.hierarchy.query(source, target)[1]
+        if started is not None:
+            instruments.observe('cch.route', time.perf_counter() - started)
+            instruments.count('cch.route_calls')
+        return path
+
+    def calculate_best_route(self, start_node, destination_node, traffic_network=None):
+        """Returns the node ids after start_node on the best route, empty if unreachable."""
+        path = self.route(start_node, destination_node)
+        if path is None:
+            return []
+        return self.edges.node_ids[path[1:]].tolist()
+
+    def calculate_best_routes(self, pairs, traffic_network=None):
+        """Returns the routes between several (start, destination) pairs, as calculate_best_route does."""
+        return [self.calculate_best_route(start, destination) for start, destination in pairs]
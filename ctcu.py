@@ -0,0 +1,320 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import instruments
+
+
+class Overloaded(RuntimeError):
+    """Raised when the CTCU already has max_pending distinct route requests waiting."""
+
+
+class CTCU:
+    """
+    Asyncio Central Traffic Control Unit that vehicles submit route requests to.
+
+    Requests are coalesced: a request for an (origin, destination) pair that is already
+    queued or being computed waits for that computation instead of starting another.
+    Distinct requests arriving within `window` seconds of each other are collected
+    into one batch, split into chunks and run on a thread pool, so the event loop
+    stays responsive while routes are searched. The routers keep per-query scratch state
+    and caches, so calls into the router are serialized by a lock; extra workers only
+    help routers that release the GIL. At most `max_pending` distinct requests
+    are accepted at a time; further ones raise Overloaded.
+
+    The CTCU wraps a router (RouteEngine, CCHRouter or RouteCache) and offers the
+    calculate_best_route interface vehicles use. It can run on the caller's event loop
+    (start/stop), on a background thread (start_background) so that synchronous code can
+    call calculate_best_route, and behind a JSON-lines socket server (serve).
+    """
+
+    def __init__(self, router, threshold_density=3, window=0.002, workers=1, max_pending=10000, max_batch=256):
+        """
+        :param router: Object providing calculate_best_route(start, destination, traffic_network).
+                       Calls are serialized, so the router need not be thread-safe.
+        :param threshold_density: Traffic density above which vehicles ask to be rerouted.
+        :param window: Seconds to wait after the first request of a batch for more to arrive.
+        :param workers: Number of threads computing routes. Since router calls hold a lock, more
+                        than one only overlaps the work around them.
+        :param max_pending: Maximum number of distinct requests queued or being computed.
+        :param max_batch: Maximum number of requests handed to a worker at once.
+        """
+        self.router = router
+        self.threshold_density = threshold_density
+        self.window = window
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self.loop = None
+        self.executor = None
+        self.inflight = {}  # (origin, destination) -> future of the route
+        self.queue = []  # Keys waiting for the next batch
+        self.requests = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.computed = 0
+        self.batches = 0
+        self.exited = 0
+        self._wakeup = None
+        self._dispatcher = None
+        self._thread = None
+        self._router_lock = threading.Lock()
+
+    async def start(self):
+        """Start dispatching requests on the running event loop."""
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='ctcu')
+        self._wakeup = asyncio.Event()
+        self._dispatcher = self.loop.create_task(self._dispatch())
+
+    async def stop(self):
+        """Stop dispatching; requests still waiting fail with CancelledError."""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for future in self.inflight.values():
+            if not future.done():
+                future.cancel()
+        self.inflight.clear()
+        self.queue.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.loop = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def request_route(self, start_node, destination_node):
+        """
+        Ask for the best route between two nodes.
+
+        :return: List of node ids after start_node, empty if the destination is unreachable.
+        :raises Overloaded: If max_pending distinct requests are already waiting.
+        """
+        self.requests += 1
+        key = (start_node, destination_node)
+        future = self.inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            if instruments.enabled:
+                instruments.count('ctcu.coalesced')
+        else:
+            if len(self.inflight) >= self.max_pending:
+                self.rejected += 1
+                if instruments.enabled:
+                    instruments.count('ctcu.rejected')
+                raise Overloaded(f"{len(self.inflight)} route requests pending")
+            future = self.inflight[key] = self.loop.create_future()
+            self.queue.append(key)
+            self._wakeup.set()
+        # Shielded, so one requester giving up doesn't cancel the route for the others
+        route = await asyncio.shield(future)
+        return list(route)
+
+    async def request_routes(self, pairs):
+        """
+        Ask for several routes at once. They are queued together, so they share batches and
+        duplicate pairs are computed once.
+
+        :param pairs: (start node, destination node) tuples.
+        :return: List of routes, each as returned by request_route.
+        :raises Overloaded: If the requests don't fit within max_pending; routes already queued still run.
+        """
+        return await asyncio.gather(*(self.request_route(start, destination) for start, destination in pairs))
+
+    def calculate_best_route(self, start_node, destination_node, traffic_network=None):
+        """
+        Synchronous interface for vehicles. Goes through the service when it runs on a background
+        thread, and straight to the router when called without one or from the service's own loop.
+
+        :return: List of node ids after start_node, empty if the destination is unreachable.
+        """
+        loop = self.loop
+        if loop is None or self._thread is None or threading.current_thread() is self._thread:
+            self.requests += 1
+            self.computed += 1
+            with self._router_lock:
+                return self.router.calculate_best_route(start_node, destination_node, traffic_network)
+        return asyncio.run_coroutine_threadsafe(self.request_route(start_node, destination_node), loop).result()
+
+    def calculate_best_routes(self, pairs, traffic_network=None):
+        """
+        Synchronous interface for simulators rerouting many vehicles at once. Through the background
+        service the whole set is submitted together and waits for one batch window, not one per route.
+
+        :param pairs: (start node, destination node) tuples.
+        :return: List of routes, each as returned by calculate_best_route.
+        """
+        pairs = [tuple(pair) for pair in pairs]
+        loop = self.loop
+        if loop is None or self._thread is None or threading.current_thread() is self._thread:
+            routes = {}
+            with self._router_lock:
+                for key in pairs:
+                    if key not in routes:
+                        routes[key] = self.router.calculate_best_route(key[0], key[1], traffic_network)
+            self.requests += len(pairs)
+            self.coalesced += len(pairs) - len(routes)
+            self.computed += len(routes)
+            return [list(routes[key]) for key in pairs]
+        if not pairs:
+            return []
+        return asyncio.run_coroutine_threadsafe(self.request_routes(pairs), loop).result()
+
+    def notify_vehicle_exit(self, vehicle_id):
+        """Called by vehicles leaving the network."""
+        self.exited += 1
+
+    async def _dispatch(self):
+        tasks = set()
+        while True:
+            await self._wakeup.wait()
+            # Let the window fill up before taking the batch
+            await asyncio.sleep(self.window)
+            self._wakeup.clear()
+            batch, self.queue = self.queue, []
+            self.batches += 1
+            if instruments.enabled:
+                instruments.count('ctcu.batches')
+                instruments.count('ctcu.batched', len(batch))
+            for i in range(0, len(batch), self.max_batch):
+                task = self.loop.create_task(self._run_chunk(batch[i:i + self.max_batch]))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+    async def _run_chunk(self, keys):
+        try:
+            routes = await self.loop.run_in_executor(self.executor, self._compute, keys)
+        except Exception as e:
+            for key in keys:
+                future = self.inflight.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            return
+        self.computed += len(keys)
+        for key, route in zip(keys, routes):
+            future = self.inflight.pop(key, None)
+            if future is not None and not future.done():
+                future.set_result(route)
+
+    def _compute(self, keys):
+        """Runs on a worker thread."""
+        started = time.perf_counter() if instruments.enabled else None
+        with self._router_lock:
+            routes = [self.router.calculate_best_route(start, destination) for start, destination in keys]
+        if started is not None:
+            instruments.observe('ctcu.chunk', time.perf_counter() - started)
+        return routes
+
+    def start_background(self):
+        """
+        Run the service on its own event loop in a daemon thread, for synchronous callers.
+
+        :return: The CTCU itself.
+        """
+        ready = threading.Event()
+        loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            ready.set()
+            loop.run_forever()
+            loop.close()
+
+        self._thread = threading.Thread(target=run, name='ctcu-loop', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop_background(self):
+        """Stop the service started with start_background."""
+        if self._thread is None:
+            return
+        loop = self.loop
+        asyncio.run_coroutine_threadsafe(self.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    async def serve(self, host='127.0.0.1', port=0):
+        """
+        Accept route requests over a socket, one JSON object per line.
+
+        Requests are {"id": ..., "origin": node, "destination": node}, answered with
+        {"id": ..., "route": [...]} or {"id": ..., "error": "..."}; {"op": "exit", "vehicle_id": ...}
+        reports a vehicle leaving and {"op": "stats"} returns the counters. Requests on one
+        connection are handled concurrently, so answers may come back out of order.
+
+        :param host: The interface to listen on.
+        :param port: The port; 0 picks a free one (see the returned server's sockets).
+        :return: The asyncio Server.
+        """
+        if self.loop is None:
+            await self.start()
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    async def _handle_connection(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.create_task(self._handle_request(line, writer))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def _handle_request(self, line, writer):
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            reply = {'error': f"invalid JSON: {e}"}
+        else:
+            reply = {'id': request.get('id')}
+            op = request.get('op', 'route')
+            try:
+                if op == 'route':
+                    reply['route'] = await self.request_route(request['origin'], request['destination'])
+                elif op == 'exit':
+                    self.notify_vehicle_exit(request.get('vehicle_id'))
+                elif op == 'stats':
+                    reply['stats'] = self.stats()
+                else:
+                    reply['error'] = f"unknown op: {op}"
+            except Overloaded as e:
+                reply['error'] = f"overloaded: {e}"
+            except KeyError as e:
+                reply['error'] = f"missing field: {e.args[0]}"
+            except Exception as e:
+                reply['error'] = repr(e)
+        writer.write(json.dumps(reply).encode() + b'\n')
+        await writer.drain()
+
+    def stats(self):
+        """Returns the request counters as a dictionary."""
+        return {
+            'requests': self.requests,
+            'coalesced': self.coalesced,
+            'rejected': self.rejected,
+            'computed': self.computed,
+            'batches': self.batches,
+            'pending': len(self.inflight),
+            'exited': self.exited,
+        }
@@ -0,0 +1,172 @@
+import csv
+import itertools
+import json
+import math
+
+import numpy as np
+
+from vehicles import Vehicle
+
+# Event kinds the DemandLoader registers with the SimulationEngine
+TRIP_DEPARTURE = 'trip_departure'
+DEMAND_REFILL = 'demand_refill'
+
+# Accepted column names for trip coordinates, as (x, y) pairs
+ORIGIN_COLUMNS = (('origin_x', 'origin_y'), ('origin_lon', 'origin_lat'))
+DESTINATION_COLUMNS = (('destination_x', 'destination_y'), ('destination_lon', 'destination_lat'))
+
+
+def read_trips(path, chunk_size=10000):
+    """
+    Read trip rows from a CSV or newline-delimited JSON file, a chunk at a time.
+
+    Each trip has a departure_time (simulated seconds) and either origin and destination
+    node ids or origin_x/origin_y and destination_x/destination_y coordinates (lon/lat,
+    also accepted as origin_lon/origin_lat etc.). vehicle_id and speed are optional.
+
+    :param path: A .csv file, or a .jsonl/.ndjson file with one JSON object per line.
+    :param chunk_size: Number of rows per chunk.
+    :return: Iterator over lists of row dictionaries.
+    """
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def _column(rows, name, default=math.nan):
+    """A float column of the chunk; empty or missing values become default."""
+    values = [row.get(name) for row in rows]
+    return np.array([default if value in (None, '') else float(value) for value in values], dtype=np.float64)
+
+
+def _endpoints(traffic_network, rows, node_column, coordinate_columns, max_snap_distance):
+    """Node ids for one end of the trips: given ids where present, otherwise snapped coordinates."""
+    nodes = np.full(len(rows), -1, dtype=np.int64)
+    valid = np.zeros(len(rows), dtype=bool)
+    given = [row.get(node_column) not in (None, '') for row in rows]
+    for i in np.flatnonzero(given).tolist():
+        node = int(rows[i][node_column])
+        if node in traffic_network.node_info:
+            nodes[i] = node
+            valid[i] = True
+
+    missing = np.flatnonzero(~np.array(given, dtype=bool))
+    if missing.size:
+        subset = [rows[i] for i in missing.tolist()]
+        for x_name, y_name in coordinate_columns:
+            x, y = _column(subset, x_name), _column(subset, y_name)
+            if not np.isnan(x).all():
+                break
+        located = ~(np.isnan(x) | np.isnan(y))
+        if located.any():
+            snapped, dist = traffic_network.nearest_nodes(x[located], y[located], return_dist=True)
+            ok = dist <= max_snap_distance if max_snap_distance is not None else np.ones(len(dist), dtype=bool)
+            targets = missing[located]
+            nodes[targets[ok]] = snapped[ok]
+            valid[targets[ok]] = True
+    return nodes, valid
+
+
+def snap_trips(traffic_network, rows, max_snap_distance=None, first_id=0):
+    """
+    Turn a chunk of trip rows into departures on the network.
+
+    :param traffic_network: The traffic network instance.
+    :param rows: Row dictionaries from read_trips.
+    :param max_snap_distance: Trips with a coordinate farther than this many meters from any node are dropped.
+    :param first_id: Vehicle id given to the first row without a vehicle_id; later rows count up from it.
+    :return: (list of (departure_time, vehicle_id, origin, destination, speed) sorted by departure time,
+              number of rows dropped).
+    """
+    origins, origin_ok = _endpoints(traffic_network, rows, 'origin', ORIGIN_COLUMNS, max_snap_distance)
+    destinations, destination_ok = _endpoints(traffic_network, rows, 'destination', DESTINATION_COLUMNS,
+                                              max_snap_distance)
+    departures = _column(rows, 'departure_time', 0.0)
+    speeds = _column(rows, 'speed', 25.0)
+    keep = origin_ok & destination_ok & ~np.isnan(departures) & (origins != destinations)
+
+    trips = []
+    for i in np.flatnonzero(keep).tolist():
+        vehicle_id = rows[i].get('vehicle_id')
+        if vehicle_id in (None, ''):
+            vehicle_id = first_id + i
+        elif isinstance(vehicle_id, str) and vehicle_id.isdigit():
+            vehicle_id = int(vehicle_id)
+        trips.append((departures[i].item(), vehicle_id, origins[i].item(), destinations[i].item(), speeds[i].item()))
+    trips.sort(key=lambda trip: trip[0])
+    return trips, len(rows) - len(trips)
+
+
+class DemandLoader:
+    """
+    Streams trips from a demand file into a SimulationEngine.
+
+    Only one chunk of trips is queued at a time: the next chunk is read when the
+    simulation reaches the last departure of the current one. Vehicles are created
+    when their departure time arrives and the engine lets go of them when they arrive,
+    so memory follows the number of vehicles on the network rather than the size of
+    the demand. Files are expected to be roughly sorted by departure time; trips that
+    turn up after their departure time depart as soon as they are read.
+    """
+
+    def __init__(self, engine, path, chunk_size=10000, max_snap_distance=None):
+        """
+        :param engine: The SimulationEngine to feed.
+        :param path: The demand file (see read_trips).
+        :param chunk_size: Number of trips read at a time.
+        :param max_snap_distance: Maximum distance in meters from a trip coordinate to its node.
+        """
+        self.engine = engine
+        self.traffic_network = engine.traffic_network
+        self.path = path
+        self.chunk_size = chunk_size
+        self.max_snap_distance = max_snap_distance
+        self.chunks = read_trips(path, chunk_size)
+        self.rows_read = 0
+        self.departed = 0
+        self.dropped = 0
+        self.late = 0
+        self.max_vehicles = 0  # Most vehicles on the network at once
+        self.exhausted = False
+        engine.add_handler(TRIP_DEPARTURE, self._on_departure)
+        engine.add_handler(DEMAND_REFILL, self._on_refill)
+
+    def start(self):
+        """Queue the first chunk of trips. Call before engine.run()."""
+        self._load_chunk()
+
+    def _load_chunk(self):
+        """Read the next chunk, schedule its departures and a refill after the last of them."""
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            return
+        trips, dropped = snap_trips(self.traffic_network, chunk, self.max_snap_distance, self.rows_read)
+        self.rows_read += len(chunk)
+        self.dropped += dropped
+        now = self.engine.clock.time()
+        for trip in trips:
+            departure_time = trip[0]
+            if departure_time < now:
+                self.late += 1
+                departure_time = now
+            self.engine.schedule(departure_time, TRIP_DEPARTURE, None, trip)
+        last = max(trips[-1][0], now) if trips else now
+        # Scheduled after the departures, so at equal times it runs once they have left
+        self.engine.schedule(last, DEMAND_REFILL)
+
+    def _on_departure(self, vehicle, trip):
+        _, vehicle_id, origin, destination, speed = trip
+        self.engine.enter_vehicle(Vehicle(vehicle_id, origin, destination, speed))
+        self.departed += 1
+        self.max_vehicles = max(self.max_vehicles, len(self.engine.vehicles))
+
+    def _on_refill(self, vehicle, data):
+        self._load_chunk()
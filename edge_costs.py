@@ -0,0 +1,131 @@
+import numpy as np
+
+VEHICLE_SPACING = 7.5  # Meters of lane taken up by a stopped vehicle, for the default edge capacity
+
+
+def linear_delay(base_time, density, capacity, alpha=0.01):
+    """
+    The network's original volume-delay function: alpha (1%) extra time per vehicle on the edge.
+
+    :param base_time: Free-flow travel times (length / maxspeed).
+    :param density: Number of vehicles on each edge.
+    :param capacity: Unused; accepted so all delay functions share a signature.
+    :return: Array of travel times.
+    """
+    return base_time * (1 + density * alpha)
+
+
+class BPRDelay:
+    """
+    Bureau of Public Roads volume-delay function: base_time * (1 + alpha * (density / capacity) ** beta).
+    """
+
+    def __init__(self, alpha=0.15, beta=4.0):
+        self.alpha = alpha
+        self.beta = beta
+
+    def __call__(self, base_time, density, capacity):
+        return base_time * (1 + self.alpha * (density / capacity) ** self.beta)
+
+
+def default_capacity(edges):
+    """The number of vehicles that fit on each edge, bumper to bumper in one lane (at least 1)."""
+    return np.maximum(edges.length / VEHICLE_SPACING, 1.0)
+
+
+class EdgeCostCache:
+    """
+    Current travel time of every edge, kept in one contiguous array.
+
+    Costs are only recomputed for edges marked dirty since the last refresh. The
+    network marks the edges vehicles leave and enter through an edge listener, and
+    writes through edge_info are picked up from the store; code that writes the arrays
+    directly (e.g. a Fleet) calls mark() or mark_all(). The delay function is any
+    vectorized callable delay(base_time, density, capacity) -> travel times, such as
+    linear_delay or BPRDelay.
+    """
+
+    def __init__(self, edges, delay_function=linear_delay, capacity=None):
+        """
+        :param edges: The EdgeStore whose costs are cached.
+        :param delay_function: The volume-delay function.
+        :param capacity: Per-edge capacity array; defaults to default_capacity(edges).
+        """
+        self.edges = edges
+        self.delay_function = delay_function
+        self.capacity = default_capacity(edges) if capacity is None else np.asarray(capacity, dtype=np.float64)
+        self.dirty = set()
+        self.version = 0  # Bumped whenever an edge is marked, so consumers can tell the costs may have changed
+        self.costs = None
+        self._cost_list = None  # The costs as a Python list, for scalar reads in search loops
+        self.mark_all()
+        edges.change_listeners.append(self.mark)
+
+    def set_delay_function(self, delay_function, capacity=None):
+        """Switch to another volume-delay function, optionally with new capacities, and recompute every cost."""
+        self.delay_function = delay_function
+        if capacity is not None:
+            self.capacity = np.asarray(capacity, dtype=np.float64)
+        self.mark_all()
+
+    def compute(self, indices):
+        """Evaluate the delay function for the given edges from the current edge state, bypassing the cache."""
+        edges = self.edges
+        return self.delay_function(edges.length[indices] / edges.maxspeed[indices],
+                                   edges.traffic_density[indices], self.capacity[indices])
+
+    def mark(self, indices):
+        """Mark an edge index, or an array of them, as changed."""
+        if np.isscalar(indices):
+            self.dirty.add(indices)
+        else:
+            self.dirty.update(np.asarray(indices).tolist())
+        self.version += 1
+
+    def mark_all(self):
+        """Recompute every edge cost, e.g. after densities were replaced wholesale."""
+        edges = self.edges
+        self.costs = np.asarray(self.delay_function(edges.length / edges.maxspeed, edges.traffic_density,
+                                                    self.capacity), dtype=np.float64)
+        self._cost_list = None
+        self.dirty.clear()
+        self.version += 1
+
+    def on_edge_change(self, vehicle_id, left_edge, entered_edge):
+        """Edge listener: the densities of the edges a vehicle left and entered have changed."""
+        if left_edge is not None:
+            self.dirty.add(left_edge)
+        if entered_edge is not None:
+            self.dirty.add(entered_edge)
+        self.version += 1
+
+    def refresh(self):
+        """Recompute the costs of the dirty edges."""
+        if not self.dirty:
+            return
+        indices = np.fromiter(self.dirty, dtype=np.int64, count=len(self.dirty))
+        self.dirty.clear()
+        costs = self.compute(indices)
+        self.costs[indices] = costs
+        if self._cost_list is not None:
+            cost_list = self._cost_list
+            for i, cost in zip(indices.tolist(), costs.tolist()):
+                cost_list[i] = cost
+
+    def values(self):
+        """Returns the up-to-date cost array. Read it, don't write to it."""
+        self.refresh()
+        return self.costs
+
+    def cost(self, i):
+        """Returns the up-to-date cost of edge i."""
+        if i in self.dirty:
+            self.refresh()
+        return float(self.costs[i])
+
+    def cost_list(self):
+        """Returns the up-to-date costs as a Python list, for search loops reading single edges."""
+        self.refresh()
+        if self._cost_list is None:
+            self._cost_list = self.costs.tolist()
+        return self._cost_list
@@ -0,0 +1,234 @@
+from collections.abc import Mapping, MutableMapping
+
+import numpy as np
+
+from graph_snapshot import normalize_maxspeed, parse_float, SnapshotGraph
+
+
+class EdgeStore:
+    """
+    Struct-of-arrays storage for per-edge state.
+
+    Edge attributes live in NumPy arrays indexed by edge index, and a single
+    (u, v, key) -> edge index map resolves edges. Occupancy is kept as per-edge
+    vehicle sets plus a vehicle -> edge index, so entering, leaving and moving
+    a vehicle are constant time. Sets and arrival times are only allocated for
+    edges that have been used.
+    """
+
+    def __init__(self, start_node, end_node, keys, length, maxspeed, node_ids=None):
+        self.start_node = np.asarray(start_node)
+        self.end_node = np.asarray(end_node)
+        self.keys = np.asarray(keys, dtype=np.int32)
+        self.length = np.asarray(length, dtype=np.float64)
+        self.maxspeed = np.asarray(maxspeed, dtype=np.float64)
+        self.traffic_density = np.zeros(len(self.length), dtype=np.int32)
+        self.occupants = {}  # edge index -> set of vehicle ids
+        self.arrival_times = {}  # edge index -> {vehicle id: arrival time}
+        self.vehicle_edge = {}  # vehicle id -> edge index
+        self.change_listeners = []  # Called with the edge index when a field is written through an EdgeRecord
+        self.edge_keys = list(zip(self.start_node.tolist(), self.end_node.tolist(), self.keys.tolist()))
+        self.index = {edge: i for i, edge in enumerate(self.edge_keys)}
+
+        # (u, v) resolves to the lowest-keyed parallel edge, and each node to its first outgoing edge
+        self.pair_index = {}
+        self.first_out = {}
+        for i, (u, v, key) in enumerate(self.edge_keys):
+            j = self.pair_index.get((u, v))
+            if j is None or key < self.edge_keys[j][2]:
+                self.pair_index[(u, v)] = i
+            self.first_out.setdefault(u, i)
+
+        # Sorted node ids, and the start and end of each edge as indices into them
+        if node_ids is None:
+            node_ids = np.unique(np.concatenate([self.start_node, self.end_node]))
+        self.node_ids = np.asarray(node_ids)
+        self.start_index = np.searchsorted(self.node_ids, self.start_node).astype(np.int32)
+        self.end_index = np.searchsorted(self.node_ids, self.end_node).astype(np.int32)
+
+        # Sorted (u, v) codes for resolving many node index pairs at once
+        codes = self.start_index.astype(np.int64) * len(self.node_ids) + self.end_index
+        order = np.lexsort((self.keys, codes))
+        self.pair_codes, first = np.unique(codes[order], return_index=True)
+        self.pair_edges = order[first].astype(np.int32)
+
+    @classmethod
+    def from_graph(cls, graph, default_maxspeed=50):
+        """
+        Build the store from a NetworkX MultiDiGraph or a SnapshotGraph.
+
+        :param graph: The road network graph.
+        :param default_maxspeed: The maxspeed used for edges where it's missing.
+        """
+        if isinstance(graph, SnapshotGraph):
+            counts = np.diff(graph.indptr)
+            start_node = np.repeat(graph.node_ids, counts)
+            end_node = graph.node_ids[graph.indices]
+            return cls(start_node, end_node, graph.keys, graph.length, graph.maxspeed, node_ids=graph.node_ids)
+
+        starts, ends, keys, lengths, maxspeeds = [], [], [], [], []
+        for u, v, key, data in graph.edges(keys=True, data=True):
+            if data.get('maxspeed') is None:
+                data['maxspeed'] = default_maxspeed
+            starts.append(u)
+            ends.append(v)
+            keys.append(key)
+            lengths.append(parse_float(data.get('length'), np.nan))
+            maxspeeds.append(data['maxspeed'])
+        return cls(starts, ends, keys, lengths, normalize_maxspeed(maxspeeds, default_maxspeed),
+                   node_ids=np.array(sorted(graph.nodes())))
+
+    def __len__(self):
+        return len(self.edge_keys)
+
+    def lookup(self, edge):
+        """
+        Returns the index of an edge, or None if it doesn't exist.
+
+        :param edge: Either a (u, v, key) tuple or a (u, v) pair, which resolves to the lowest-keyed edge.
+        """
+        if len(edge) == 2:
+            return self.pair_index.get(edge)
+        return self.index.get(edge)
+
+    def node_index(self, nodes):
+        """Returns the index of each of the given node ids (a scalar or an array), raising KeyError for unknown nodes."""
+        nodes = np.asarray(nodes, dtype=self.node_ids.dtype)
+        indices = np.searchsorted(self.node_ids, nodes)
+        flat_nodes, flat_indices = np.atleast_1d(nodes), np.atleast_1d(indices)
+        found = flat_indices < len(self.node_ids)
+        found[found] = self.node_ids[flat_indices[found]] == flat_nodes[found]
+        if not found.all():
+            raise KeyError(flat_nodes[~found][0].item())
+        return indices
+
+    def lookup_pairs(self, start_index, end_index):
+        """
+        Resolve many (u, v) pairs at once.
+
+        :param start_index: Array of start node indices.
+        :param end_index: Array of end node indices.
+        :return: Array of edge indices, with -1 where no edge exists.
+        """
+        codes = np.asarray(start_index, dtype=np.int64) * len(self.node_ids) + end_index
+        if not len(self.pair_codes):
+            return np.full(codes.shape, -1, dtype=np.int32)
+        pos = np.searchsorted(self.pair_codes, codes)
+        pos = np.minimum(pos, len(self.pair_codes) - 1)
+        found = self.pair_codes[pos] == codes
+        return np.where(found, self.pair_edges[pos], -1)
+
+    def enter(self, vehicle_id, i, arrival_time=None):
+        """
+        Place a vehicle on the edge with index i, taking it off the edge it was on before.
+
+        :param vehicle_id: The ID of the vehicle.
+        :param i: The index of the edge the vehicle enters.
+        :param arrival_time: The time the vehicle entered the edge, if it should be recorded.
+        :return: The index of the edge the vehicle left, or None.
+        """
+        previous = self.leave(vehicle_id)
+        self.vehicle_edge[vehicle_id] = i
+        occupants = self.occupants.get(i)
+        if occupants is None:
+            occupants = self.occupants[i] = set()
+        occupants.add(vehicle_id)
+        self.traffic_density[i] += 1
+        if arrival_time is not None:
+            self.arrival_times.setdefault(i, {})[vehicle_id] = arrival_time
+        return previous
+
+    def leave(self, vehicle_id):
+        """
+        Take a vehicle off the edge it is on.
+
+        :param vehicle_id: The ID of the vehicle.
+        :return: The index of the edge the vehicle left, or None if it wasn't on an edge.
+        """
+        i = self.vehicle_edge.pop(vehicle_id, None)
+        if i is None:
+            return None
+        occupants = self.occupants[i]
+        occupants.discard(vehicle_id)
+        if not occupants:
+            del self.occupants[i]
+        self.traffic_density[i] -= 1
+        arrival_times = self.arrival_times.get(i)
+        if arrival_times is not None:
+            arrival_times.pop(vehicle_id, None)
+            if not arrival_times:
+                del self.arrival_times[i]
+        return i
+
+
+class EdgeRecord(MutableMapping):
+    """A dict-like view of a single edge in an EdgeStore."""
+
+    FIELDS = ('start_node', 'end_node', 'length', 'maxspeed', 'traffic_density',
+              'vehicles_on_edge', 'arrival_times')
+    ARRAY_FIELDS = ('length', 'maxspeed', 'traffic_density')
+
+    __slots__ = ('store', 'i')
+
+    def __init__(self, store, i):
+        self.store = store
+        self.i = i
+
+    def __getitem__(self, field):
+        store, i = self.store, self.i
+        if field in self.ARRAY_FIELDS:
+            return getattr(store, field)[i].item()
+        if field == 'start_node':
+            return store.edge_keys[i][0]
+        if field == 'end_node':
+            return store.edge_keys[i][1]
+        if field == 'vehicles_on_edge':
+            return store.occupants.get(i, frozenset())
+        if field == 'arrival_times':
+            return store.arrival_times.get(i, {})
+        raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        if field not in self.ARRAY_FIELDS:
+            raise KeyError(f"Edge field '{field}' is read-only")
+        getattr(self.store, field)[self.i] = value
+        for listener in self.store.change_listeners:
+            listener(self.i)
+
+    def __delitem__(self, field):
+        raise TypeError('Edge fields cannot be deleted')
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class EdgeInfoView(Mapping):
+    """
+    A read-only mapping from (u, v, key) to EdgeRecord, keeping the old
+    edge_info dict-of-dicts interface on top of an EdgeStore. (u, v) pairs
+    are accepted as well and resolve to the lowest-keyed edge.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, edge):
+        i = self.store.lookup(edge)
+        if i is None:
+            raise KeyError(edge)
+        return EdgeRecord(self.store, i)
+
+    def __contains__(self, edge):
+        return self.store.lookup(edge) is not None
+
+    def __iter__(self):
+        return iter(self.store.edge_keys)
+
+    def __len__(self):
+        return len(self.store)
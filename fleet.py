@@ -0,0 +1,408 @@
+import time
+
+import numpy as np
+
+from instrumentation import instruments
+from vehicles import STATE_CODES, STATE_NAMES, Vehicle
+
+WAITING = STATE_CODES['waiting']
+MOVING = STATE_CODES['moving']
+REROUTING = STATE_CODES['rerouting']
+ARRIVED = STATE_CODES['arrived']
+
+# Edge value of a vehicle that is not on an edge, and of one crossing between nodes with no edge in the store
+NOT_ON_EDGE = -1
+NO_EDGE = -2
+
+# Per-vehicle arrays, indexed by slot
+SLOT_ARRAYS = ('current', 'next', 'destination', 'state', 'speed', 'edge',
+               'exit_time', 'route_start', 'route_end', 'cursor')
+
+
+class Fleet:
+    """
+    Array-based vehicle engine that advances every vehicle in one vectorized pass per tick.
+
+    Vehicle state (current and next node index, state code, speed, route cursor and
+    the edge being traversed) is held in NumPy arrays. Routes are stored back to back
+    in a single int32 buffer of node indices. Travel times use the network's edge costs,
+    as Vehicle.edge_delays does, plus the intersection delay at the end node. Densities
+    are written straight into the network's EdgeStore and marked in its cost cache.
+    """
+
+    def __init__(self, traffic_network, ctc_unit=None, capacity=1024):
+        """
+        :param traffic_network: The traffic network instance.
+        :param ctc_unit: Optional CTCU; vehicles entering an edge above its threshold_density are rerouted.
+        :param capacity: Initial number of vehicle slots.
+        """
+        self.traffic_network = traffic_network
+        self.ctc_unit = ctc_unit
+        self.edges = traffic_network.edges
+        self.costs = traffic_network.edge_cost_cache
+        self.clock = traffic_network.clock
+        self.size = 0
+        self.vehicle_ids = []
+        self.index = {}  # vehicle id -> slot
+        self.current = np.full(capacity, -1, dtype=np.int32)
+        self.next = np.full(capacity, -1, dtype=np.int32)
+        self.destination = np.full(capacity, -1, dtype=np.int32)
+        self.state = np.full(capacity, WAITING, dtype=np.int8)
+        self.speed = np.zeros(capacity, dtype=np.float64)
+        self.edge = np.full(capacity, -1, dtype=np.int32)
+        self.exit_time = np.zeros(capacity, dtype=np.float64)
+        self.route_start = np.zeros(capacity, dtype=np.int64)
+        self.route_end = np.zeros(capacity, dtype=np.int64)
+        self.cursor = np.zeros(capacity, dtype=np.int64)
+        self.route_nodes = np.empty(max(capacity * 8, 64), dtype=np.int32)
+        self.route_used = 0
+        self.node_delay = np.zeros(len(self.edges.node_ids), dtype=np.float64)
+        self.refresh_signals()
+
+    def __len__(self):
+        return self.size
+
+    def add(self, vehicle_id, start_node, destination_node, route=None, speed=25):
+        """
+        Add a vehicle to the fleet.
+
+        :param vehicle_id: The ID of the vehicle.
+        :param start_node: The node the vehicle starts at.
+        :param destination_node: The node the vehicle drives to.
+        :param route: Optional list of node ids after start_node, as returned by the CTCU.
+        :param speed: The vehicle's speed.
+        :return: The slot of the vehicle.
+        """
+        if self.size == len(self.current):
+            self._grow(2 * len(self.current))
+        slot = self.size
+        self.size += 1
+        self.vehicle_ids.append(vehicle_id)
+        self.index[vehicle_id] = slot
+        self.current[slot] = self.edges.node_index(start_node)
+        self.destination[slot] = self.edges.node_index(destination_node)
+        self.speed[slot] = speed
+        self.state[slot] = WAITING
+        self.edge[slot] = NOT_ON_EDGE
+        self.route_start[slot] = self.route_end[slot] = self.cursor[slot] = 0
+        if route:
+            self.assign_route(slot, route)
+        return slot
+
+    def remove(self, slots):
+        """
+        Drop vehicles from the fleet. The last vehicles are moved into the freed slots,
+        so slots of other vehicles may change; look them up in index afterwards.
+
+        :param slots: Slots of vehicles that are not on an edge.
+        """
+        for slot in sorted(np.asarray(slots).tolist(), reverse=True):
+            last = self.size - 1
+            del self.index[self.vehicle_ids[slot]]
+            if slot != last:
+                for name in SLOT_ARRAYS:
+                    array = getattr(self, name)
+                    array[slot] = array[last]
+                self.vehicle_ids[slot] = self.vehicle_ids[last]
+                self.index[self.vehicle_ids[slot]] = slot
+            self.vehicle_ids.pop()
+            self.size -= 1
+
+    def vehicle(self, vehicle_id):
+        """Returns a Vehicle-compatible view of the vehicle with the given ID."""
+        return FleetVehicle(self, self.index[vehicle_id])
+
+    def assign_route(self, slot, route):
+        """
+        Give a vehicle a new route and set it moving towards the first node on it.
+
+        :param slot: The slot of the vehicle.
+        :param route: List of node ids after the vehicle's current position.
+        """
+        self.store_route(slot, route)
+        self._advance(np.array([slot]))
+
+    def store_route(self, slot, route):
+        """
+        Replace the nodes ahead of a vehicle without changing its next position.
+
+        :param slot: The slot of the vehicle.
+        :param route: List of node ids.
+        """
+        self._store_route_indices(slot, self.edges.node_index(np.asarray(route)).astype(np.int32))
+
+    def _store_route_indices(self, slot, nodes):
+        if self.route_used + len(nodes) > len(self.route_nodes):
+            self._compact_routes(len(nodes))
+        start = self.route_used
+        self.route_nodes[start:start + len(nodes)] = nodes
+        self.route_used += len(nodes)
+        self.route_start[slot] = start
+        self.route_end[slot] = start + len(nodes)
+        self.cursor[slot] = start
+
+    def remaining_route(self, slot):
+        """Returns the node indices still ahead of the vehicle after its next position."""
+        return self.route_nodes[self.cursor[slot]:self.route_end[slot]]
+
+    def refresh_signals(self):
+        """Re-read the intersection delays of signalized nodes from the network's signal controller."""
+        delays = self.traffic_network.signals.delay
+        # Start from no delays, so signals removed from the controller stop delaying vehicles
+        self.node_delay[:] = 0
+        if delays:
+            self.node_delay[self.edges.node_index(list(delays))] = list(delays.values())
+
+    def travel_times(self, edges, end_nodes):
+        """
+        Calculate the traversal time of many edges at once.
+
+        :param edges: Array of edge indices.
+        :param end_nodes: Array of the end node index of each edge, for the intersection delay.
+        :return: Array of travel times.
+        """
+        return self.costs.compute(edges) + self.node_delay[end_nodes]
+
+    def step(self, dt):
+        """
+        Advance every moving vehicle by dt seconds of simulated time.
+
+        Vehicles can traverse several short edges within one tick; each edge is
+        entered at the time the previous one was left.
+
+        :param dt: The length of the tick in seconds.
+        :return: The number of edges completed during the tick.
+        """
+        started = time.perf_counter() if instruments.enabled else None
+        now = self.clock.time()
+        t_end = now + dt
+        n = self.size
+        self.refresh_signals()
+
+        state, edge = self.state[:n], self.edge[:n]
+        ready = np.flatnonzero((state == MOVING) & (edge == NOT_ON_EDGE))
+        if ready.size:
+            self._enter(ready, np.full(ready.size, now))
+
+        completed = 0
+        while True:
+            done = np.flatnonzero((state == MOVING) & (edge != NOT_ON_EDGE) & (self.exit_time[:n] <= t_end))
+            if not done.size:
+                break
+            times = self.exit_time[done]
+            self._exit(done)
+            completed += done.size
+            moving = state[done] == MOVING
+            if moving.any():
+                self._enter(done[moving], times[moving])
+
+        self.clock.advance_to(t_end)
+        if started is not None:
+            instruments.observe('fleet.tick', time.perf_counter() - started)
+            instruments.count('fleet.edges_completed', completed)
+        return completed
+
+    def _enter(self, slots, times, check_congestion=True):
+        """Put the given vehicles on the edge towards their next node at the given times."""
+        congested = self._occupy(slots, times, check_congestion)
+        if congested.any():
+            self._reroute(slots[congested], times[congested])
+
+    def _occupy(self, slots, times, check_congestion=True):
+        """
+        Count the given vehicles on their next edge and set their exit times.
+
+        :return: Boolean mask of the vehicles that entered an edge above the CTCU's threshold_density.
+        """
+        store = self.edges
+        e = store.lookup_pairs(self.current[slots], self.next[slots])
+        known = e >= 0
+        np.add.at(store.traffic_density, e[known], 1)
+        self.costs.mark(e[known])
+        # Vehicles without an edge to their next node just move there, like Vehicle.update_position
+        self.edge[slots] = np.where(known, e, NO_EDGE)
+
+        tt = np.zeros(slots.size)
+        tt[known] = self.travel_times(e[known], self.next[slots][known])
+        self.exit_time[slots] = times + tt
+
+        congested = np.zeros(slots.size, dtype=bool)
+        if check_congestion and self.ctc_unit is not None:
+            congested[known] = store.traffic_density[e[known]] > self.ctc_unit.threshold_density
+        return congested
+
+    def _exit(self, slots):
+        """Move the given vehicles to the end of their current edge."""
+        e = self.edge[slots]
+        np.subtract.at(self.edges.traffic_density, e[e >= 0], 1)
+        self.costs.mark(e[e >= 0])
+        self.edge[slots] = NOT_ON_EDGE
+        self.current[slots] = self.next[slots]
+        self._advance(slots)
+
+    def _advance(self, slots):
+        """Point the given vehicles at the next node of their route, or mark them arrived."""
+        more = (self.cursor[slots] < self.route_end[slots]) & (self.current[slots] != self.destination[slots])
+        going = slots[more]
+        self.next[going] = self.route_nodes[self.cursor[going]]
+        self.cursor[going] += 1
+        self.state[going] = MOVING
+        stopped = slots[~more]
+        self.next[stopped] = -1
+        self.state[stopped] = np.where(self.current[stopped] == self.destination[stopped], ARRIVED, WAITING)
+
+    def _reroute(self, slots, times):
+        """Ask the CTCU for new routes for vehicles that entered a congested edge."""
+        if instruments.enabled:
+            instruments.count('fleet.reroutes', slots.size)
+        self._pull_over(slots)
+        self._request_routes(slots)
+        self._enter(slots, times, check_congestion=False)
+
+    def _pull_over(self, slots):
+        """Take vehicles off the edge they just entered so they can be rerouted."""
+        np.subtract.at(self.edges.traffic_density, self.edge[slots], 1)
+        self.costs.mark(self.edge[slots])
+        self.edge[slots] = NOT_ON_EDGE
+        self.state[slots] = REROUTING
+
+    def _request_routes(self, slots):
+        """Route the given vehicles from their current node, leaving them pointed at their next node."""
+        node_ids = self.edges.node_ids
+        slots = slots.tolist()
+        if not slots:
+            return
+        # One batched request for all of them
+        pairs = list(zip(node_ids[self.current[slots]].tolist(), node_ids[self.destination[slots]].tolist()))
+        batch = getattr(self.ctc_unit, 'calculate_best_routes', None)
+        if batch is not None:
+            new_routes = batch(pairs, self.traffic_network)
+        else:
+            # A CTCU that only offers calculate_best_route
+            new_routes = [self.ctc_unit.calculate_best_route(start, destination, self.traffic_network)
+                          for start, destination in pairs]
+        for slot, new_route in zip(slots, new_routes):
+            if new_route:
+                self.assign_route(slot, new_route)
+            else:
+                # Keep driving on the original route
+                self.state[slot] = MOVING
+
+    def _grow(self, capacity):
+        for name in SLOT_ARRAYS:
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _compact_routes(self, extra):
+        """Drop consumed and abandoned route segments, growing the buffer if needed."""
+        n = self.size
+        remaining = self.route_end[:n] - self.cursor[:n]
+        needed = int(remaining.sum()) + extra
+        capacity = len(self.route_nodes)
+        while capacity < 2 * needed:
+            capacity *= 2
+        nodes = np.empty(capacity, dtype=np.int32)
+        starts = np.zeros(n, dtype=np.int64)
+        np.cumsum(remaining[:-1], out=starts[1:])
+        for slot in np.flatnonzero(remaining).tolist():
+            nodes[starts[slot]:starts[slot] + remaining[slot]] = self.route_nodes[self.cursor[slot]:self.route_end[slot]]
+        self.route_nodes = nodes
+        self.route_start[:n] = starts
+        self.cursor[:n] = starts
+        self.route_end[:n] = starts + remaining
+        self.route_used = int(remaining.sum())
+
+
+class FleetVehicle(Vehicle):
+    """
+    A per-vehicle view of a slot in a Fleet, so code written against Vehicle keeps working.
+    Reads and writes go straight to the fleet's arrays.
+    """
+
+    def __init__(self, fleet, slot):
+        self.fleet = fleet
+        self.slot = slot
+        self.vehicle_id = fleet.vehicle_ids[slot]
+
+    def _node_id(self, index):
+        return None if index < 0 else self.fleet.edges.node_ids[index].item()
+
+    @property
+    def current_position(self):
+        return self._node_id(self.fleet.current[self.slot])
+
+    @current_position.setter
+    def current_position(self, node):
+        self.fleet.current[self.slot] = -1 if node is None else self.fleet.edges.node_index(node)
+
+    @property
+    def next_position(self):
+        return self._node_id(self.fleet.next[self.slot])
+
+    @next_position.setter
+    def next_position(self, node):
+        self.fleet.next[self.slot] = -1 if node is None else self.fleet.edges.node_index(node)
+
+    @property
+    def destination(self):
+        return self._node_id(self.fleet.destination[self.slot])
+
+    @destination.setter
+    def destination(self, node):
+        self.fleet.destination[self.slot] = self.fleet.edges.node_index(node)
+
+    @property
+    def state(self):
+        return STATE_NAMES[self.fleet.state[self.slot]]
+
+    @state.setter
+    def state(self, name):
+        self.fleet.state[self.slot] = STATE_CODES[name]
+
+    @property
+    def state_code(self):
+        return int(self.fleet.state[self.slot])
+
+    @state_code.setter
+    def state_code(self, code):
+        self.fleet.state[self.slot] = code
+
+    @property
+    def speed(self):
+        return self.fleet.speed[self.slot].item()
+
+    @speed.setter
+    def speed(self, value):
+        self.fleet.speed[self.slot] = value
+
+    @property
+    def route(self):
+        return self.fleet.edges.node_ids[self.fleet.remaining_route(self.slot)].tolist()
+
+    @route.setter
+    def route(self, nodes):
+        self.fleet.store_route(self.slot, list(nodes))
+
+    @property
+    def route_length(self):
+        return int(self.fleet.route_end[self.slot] - self.fleet.cursor[self.slot])
+
+    def set_route(self, nodes, traffic_network=None):
+        self.fleet.store_route(self.slot, list(nodes))
+
+    def _set_route(self, nodes):
+        self.fleet.store_route(self.slot, list(nodes))
+
+    def route_state(self):
+        return self.fleet.remaining_route(self.slot).copy(), 0
+
+    def set_route_state(self, route, cursor, traffic_network=None):
+        self.fleet._store_route_indices(self.slot, np.asarray(route[cursor:], dtype=np.int32))
+
+    def advance_route(self):
+        fleet, slot = self.fleet, self.slot
+        node = fleet.route_nodes[fleet.cursor[slot]]
+        fleet.cursor[slot] += 1
+        return fleet.edges.node_ids[node].item()
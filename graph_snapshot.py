@@ -0,0 +1,261 @@
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+SNAPSHOT_VERSION = 1
+
+# Arrays stored in a snapshot directory, one .npy file each so they can be memory-mapped.
+SNAPSHOT_ARRAYS = ('node_ids', 'x', 'y', 'indptr', 'indices', 'keys', 'length', 'maxspeed')
+
+# Conversion factors from OSM maxspeed units to km/h
+SPEED_UNITS = {'': 1.0, 'km/h': 1.0, 'kmh': 1.0, 'kph': 1.0, 'mph': 1.609344, 'knots': 1.852}
+_SPEED = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([a-z/]*)\s*$')
+
+
+def snapshot_key(bbox, network_type, default_maxspeed):
+    """
+    Build the key identifying a snapshot of a generated graph.
+
+    :param bbox: The bounding box passed to the graph generator.
+    :param network_type: The OSMnx network type (e.g. 'drive').
+    :param default_maxspeed: The maxspeed used for edges where it's missing.
+    :return: A hex digest usable as a directory name.
+    """
+    raw = json.dumps([list(bbox), network_type, default_maxspeed, SNAPSHOT_VERSION])
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def parse_float(value, default):
+    """Convert an edge attribute to a float, falling back to the default when it can't be parsed."""
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float(default)
+
+
+def _parse_maxspeed(text):
+    """km/h for one maxspeed string, averaging ';'-separated values; NaN if none can be parsed."""
+    speeds = []
+    for part in text.split(';'):
+        match = _SPEED.match(part.lower())
+        if match and match.group(2) in SPEED_UNITS:
+            speeds.append(float(match.group(1)) * SPEED_UNITS[match.group(2)])
+    return sum(speeds) / len(speeds) if speeds else float('nan')
+
+
+def normalize_maxspeed(values, default):
+    """
+    Convert raw OSM maxspeed values to a float64 array in km/h.
+
+    Accepts numbers, strings with an optional unit ("50", "25 mph", "10 knots"), ';'-separated
+    strings and lists of these (averaged, as OSMnx does). Values that can't be parsed, like
+    "none" or "signals", and missing values get the default. Each distinct value is parsed
+    once, so this is fast on a whole graph's worth of edges.
+
+    :param values: Sequence of raw maxspeed values.
+    :param default: The maxspeed used where it's missing or can't be parsed.
+    :return: Array of speeds in km/h.
+    """
+    keys = ['' if value is None else ';'.join(map(str, value)) if isinstance(value, (list, tuple)) else str(value)
+            for value in values]
+    if not keys:
+        return np.empty(0, dtype=np.float64)
+    unique, inverse = np.unique(np.array(keys, dtype=np.str_), return_inverse=True)
+    speeds = np.array([_parse_maxspeed(key) for key in unique.tolist()], dtype=np.float64)
+    speeds[~(speeds > 0)] = default
+    return speeds[inverse.ravel()]
+
+
+def graph_to_arrays(graph, default_maxspeed=50):
+    """
+    Convert a NetworkX MultiDiGraph into the compact CSR arrays stored in a snapshot.
+
+    Nodes are sorted by id so that lookups can use a binary search instead of a dict,
+    and edges are grouped by their start node.
+
+    :param graph: The graph generated by OSMnx.
+    :param default_maxspeed: The maxspeed used for edges where it's missing.
+    :return: A dictionary of NumPy arrays keyed by the names in SNAPSHOT_ARRAYS.
+    """
+    node_ids = np.array(sorted(graph.nodes()), dtype=np.int64)
+    x = np.empty(len(node_ids), dtype=np.float64)
+    y = np.empty(len(node_ids), dtype=np.float64)
+    for i, node in enumerate(node_ids.tolist()):
+        data = graph.nodes[node]
+        x[i] = data.get('x', np.nan)
+        y[i] = data.get('y', np.nan)
+
+    starts, ends, keys, lengths, maxspeeds = [], [], [], [], []
+    for u, v, key, data in graph.edges(keys=True, data=True):
+        starts.append(u)
+        ends.append(v)
+        keys.append(key)
+        lengths.append(parse_float(data.get('length'), np.nan))
+        maxspeeds.append(data.get('maxspeed'))
+
+    start_index = np.searchsorted(node_ids, np.array(starts, dtype=np.int64))
+    end_index = np.searchsorted(node_ids, np.array(ends, dtype=np.int64))
+    return arrays_from_edges(node_ids, x, y, start_index, end_index,
+                             np.array(keys, dtype=np.int32),
+                             np.array(lengths, dtype=np.float64),
+                             normalize_maxspeed(maxspeeds, default_maxspeed))
+
+
+def arrays_from_edges(node_ids, x, y, start_index, end_index, keys, length, maxspeed):
+    """
+    Assemble snapshot arrays from flat edge lists given as node indices.
+
+    :return: A dictionary of NumPy arrays keyed by the names in SNAPSHOT_ARRAYS.
+    """
+    order = np.argsort(start_index, kind='stable')
+    counts = np.bincount(start_index, minlength=len(node_ids))
+    indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return {
+        'node_ids': np.asarray(node_ids, dtype=np.int64),
+        'x': np.asarray(x, dtype=np.float64),
+        'y': np.asarray(y, dtype=np.float64),
+        'indptr': indptr,
+        'indices': np.asarray(end_index, dtype=np.int32)[order],
+        'keys': np.asarray(keys, dtype=np.int32)[order],
+        'length': np.asarray(length, dtype=np.float64)[order],
+        'maxspeed': np.asarray(maxspeed, dtype=np.float64)[order],
+    }
+
+
+def save_snapshot(directory, arrays, meta=None):
+    """
+    Write snapshot arrays to a directory.
+
+    :param directory: The snapshot directory (created if needed).
+    :param arrays: The arrays returned by graph_to_arrays.
+    :param meta: Optional extra metadata stored in meta.json.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name in SNAPSHOT_ARRAYS:
+        np.save(os.path.join(directory, f'{name}.npy'), arrays[name])
+    info = dict(meta or {})
+    info.update({
+        'version': SNAPSHOT_VERSION,
+        'num_nodes': int(len(arrays['node_ids'])),
+        'num_edges': int(len(arrays['indices'])),
+    })
+    # Written last so a partially written snapshot is never picked up
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(info, f)
+
+
+def load_snapshot(directory, mmap_mode='r'):
+    """
+    Open a snapshot directory, memory-mapping its arrays.
+
+    :param directory: The snapshot directory.
+    :param mmap_mode: The memory-map mode passed to np.load.
+    :return: A SnapshotGraph, or None if no complete snapshot exists there.
+    """
+    meta_path = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('version') != SNAPSHOT_VERSION:
+        return None
+    arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode)
+              for name in SNAPSHOT_ARRAYS}
+    return SnapshotGraph(arrays, directory=directory, meta=meta)
+
+
+class SnapshotGraph:
+    """
+    A read-only, graph-compatible view over snapshot arrays.
+
+    It implements the subset of the NetworkX MultiDiGraph API used by TrafficNetwork
+    (nodes, edges, neighbors) so a snapshot can be used without rebuilding the graph.
+    """
+
+    def __init__(self, arrays, directory=None, meta=None):
+        self.directory = directory
+        self.meta = meta or {}
+        self.node_ids = arrays['node_ids']
+        self.x = arrays['x']
+        self.y = arrays['y']
+        self.indptr = arrays['indptr']
+        self.indices = arrays['indices']
+        self.keys = arrays['keys']
+        self.length = arrays['length']
+        self.maxspeed = arrays['maxspeed']
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __iter__(self):
+        return iter(self.node_ids.tolist())
+
+    def __contains__(self, node):
+        return self.node_index(node) is not None
+
+    def arrays(self):
+        """Returns the snapshot arrays as a dictionary."""
+        return {name: getattr(self, name) for name in SNAPSHOT_ARRAYS}
+
+    def node_index(self, node):
+        """Returns the index of the node with the given id, or None if it isn't in the graph."""
+        i = int(np.searchsorted(self.node_ids, node))
+        if i < len(self.node_ids) and self.node_ids[i] == node:
+            return i
+        return None
+
+    def number_of_nodes(self):
+        return len(self.node_ids)
+
+    def number_of_edges(self):
+        return len(self.indices)
+
+    def nodes(self, data=False):
+        """Iterates over node ids, or (node, data) pairs when data is True."""
+        if not data:
+            return self.node_ids.tolist()
+        return ((node, {'x': x, 'y': y})
+                for node, x, y in zip(self.node_ids.tolist(), self.x.tolist(), self.y.tolist()))
+
+    def edges(self, nbunch=None, keys=False, data=False):
+        """
+        Iterates over edges in CSR order, following the NetworkX edges() signature.
+
+        :param nbunch: A single node or an iterable of nodes to restrict the edges to.
+        :param keys: Whether to include the edge key.
+        :param data: Whether to include the edge attribute dictionary.
+        """
+        if nbunch is None:
+            nodes = range(len(self.node_ids))
+        elif np.isscalar(nbunch):
+            i = self.node_index(nbunch)
+            nodes = [] if i is None else [i]
+        else:
+            nodes = [i for i in map(self.node_index, nbunch) if i is not None]
+
+        node_ids = self.node_ids
+        for i in nodes:
+            u = int(node_ids[i])
+            for e in range(int(self.indptr[i]), int(self.indptr[i + 1])):
+                edge = (u, int(node_ids[self.indices[e]]))
+                if keys:
+                    edge += (int(self.keys[e]),)
+                if data:
+                    edge += ({'length': float(self.length[e]), 'maxspeed': float(self.maxspeed[e])},)
+                yield edge
+
+    def neighbors(self, node):
+        """Iterates over the successors of the given node."""
+        i = self.node_index(node)
+        if i is None:
+            raise KeyError(node)
+        targets = np.unique(self.indices[self.indptr[i]:self.indptr[i + 1]])
+        return iter(self.node_ids[targets].tolist())
+
+    successors = neighbors
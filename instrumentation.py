@@ -0,0 +1,236 @@
+import json
+import math
+import struct
+import time
+
+import numpy as np
+
+# Event levels, as in the logging module. OFF disables tracing.
+DEBUG = 10
+INFO = 20
+WARNING = 30
+OFF = 100
+
+TRACE_MAGIC = b'TRCTRACE'
+TRACE_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('event', '<u2'),
+    ('level', 'u1'),
+    ('vehicle', '<i8'),
+    ('a', '<i8'),
+    ('b', '<i8'),
+    ('value', '<f8'),
+])
+
+HISTOGRAM_BUCKETS = 48  # Powers of two from 1 microsecond up to about 4 years
+
+
+class Histogram:
+    """Timing histogram with power-of-two buckets starting at one microsecond."""
+
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = math.frexp(seconds * 1e6)[1] if seconds > 1e-6 else 0
+        self.buckets[min(bucket, HISTOGRAM_BUCKETS - 1)] += 1
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile (0-100), in seconds."""
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(2.0 ** bucket * 1e-6, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+class Instrumentation:
+    """
+    Counters, timing histograms and a sampled event trace for the simulation's hot paths.
+
+    Everything is off by default. Call sites check a single attribute before doing any
+    work, so disabled instrumentation costs one comparison:
+
+        if instruments.enabled:
+            instruments.count('routing.route_calls')
+        if instruments.trace_level <= DEBUG:
+            instruments.event(DEBUG, 'vehicle_added', vehicle_id, node)
+
+    Events are fixed-size records (see TRACE_DTYPE) in a ring buffer that keeps the most
+    recent `capacity` events; flush() writes them to a binary trace file.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_level = OFF
+        self.clock = None
+        self.counters = {}
+        self.histograms = {}
+        self.configure_trace()
+
+    def configure(self, enabled=True, trace_level=OFF, sample_rate=1.0, capacity=65536, clock=None):
+        """
+        Turn instrumentation on or off.
+
+        :param enabled: Whether to keep counters and timing histograms.
+        :param trace_level: Lowest level of events to trace; OFF disables tracing.
+        :param sample_rate: Fraction of events below WARNING to keep, e.g. 0.01 keeps every 100th.
+        :param capacity: Number of events the ring buffer holds.
+        :param clock: Clock whose time() stamps the events, e.g. a SimulationClock; defaults to perf_counter.
+        """
+        self.enabled = enabled
+        self.trace_level = trace_level
+        self.clock = clock
+        self.configure_trace(sample_rate, capacity)
+
+    def configure_trace(self, sample_rate=1.0, capacity=65536):
+        self.sample_every = max(1, round(1 / sample_rate)) if sample_rate > 0 else 0
+        self.buffer = np.zeros(capacity, dtype=TRACE_DTYPE)
+        self.position = 0  # Total number of events written since the last flush
+        self.skipped = 0  # Events left out by sampling, counting towards the next sample
+        self.event_codes = {}  # event name -> code
+        self.labels = {}  # non-integer vehicle id or argument -> label index
+
+    def reset(self):
+        """Clear the counters, histograms and trace buffer."""
+        self.counters = {}
+        self.histograms = {}
+        self.buffer[:] = 0
+        self.position = 0
+        self.skipped = 0
+
+    def count(self, name, n=1):
+        """Add n to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        """Record a duration in a timing histogram."""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def event(self, level, name, vehicle=None, a=None, b=None, value=math.nan):
+        """
+        Trace an event. Events below WARNING are sampled.
+
+        :param level: DEBUG, INFO or WARNING.
+        :param name: The event name, e.g. 'vehicle_added'.
+        :param vehicle: The vehicle the event is about, if any.
+        :param a: First integer argument, e.g. a node id or edge index.
+        :param b: Second integer argument.
+        :param value: A float argument, e.g. a delay or speed.
+        """
+        if level < self.trace_level:
+            return
+        if level < WARNING:
+            if not self.sample_every:
+                return
+            self.skipped += 1
+            if self.skipped < self.sample_every:
+                return
+            self.skipped = 0
+        code = self.event_codes.get(name)
+        if code is None:
+            code = self.event_codes[name] = len(self.event_codes)
+        t = self.clock.time() if self.clock is not None else time.perf_counter()
+        self.buffer[self.position % len(self.buffer)] = (
+            t, code, level, self._encode(vehicle), self._encode(a), self._encode(b), value)
+        self.position += 1
+
+    def _encode(self, value):
+        """Integers are stored as is; other values become negative label codes, None is -1."""
+        if value is None:
+            return -1
+        if isinstance(value, (int, np.integer)):
+            return int(value)
+        label = self.labels.get(value)
+        if label is None:
+            label = self.labels[value] = len(self.labels)
+        return -2 - label
+
+    def events(self):
+        """Returns the buffered events, oldest first."""
+        capacity = len(self.buffer)
+        if self.position <= capacity:
+            return self.buffer[:self.position].copy()
+        start = self.position % capacity
+        return np.concatenate([self.buffer[start:], self.buffer[:start]])
+
+    def flush(self, path):
+        """
+        Write the buffered events to a binary trace file and empty the buffer.
+
+        The file holds TRACE_MAGIC, the length of a JSON header as a little-endian uint32,
+        the header (event names, labels, record dtype, events lost to the ring buffer),
+        then the raw records. Read it back with read_trace().
+
+        :return: The number of events written.
+        """
+        events = self.events()
+        header = json.dumps({
+            'events': {code: name for name, code in self.event_codes.items()},
+            'labels': {str(label): str(value) for value, label in self.labels.items()},
+            'dtype': TRACE_DTYPE.descr,
+            'dropped': max(0, self.position - len(self.buffer)),
+        }).encode()
+        with open(path, 'wb') as f:
+            f.write(TRACE_MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            f.write(events.tobytes())
+        self.position = 0
+        return len(events)
+
+    def summary(self):
+        """Returns the counters and histogram summaries as a dictionary."""
+        return {
+            'counters': dict(self.counters),
+            'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()},
+            'events': min(self.position, len(self.buffer)),
+        }
+
+
+def read_trace(path):
+    """
+    Read a trace file written by Instrumentation.flush.
+
+    :return: (header dictionary, structured array of events).
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"Not a trace file: {path}")
+        (length,) = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(length))
+        header['events'] = {int(code): name for code, name in header['events'].items()}
+        events = np.frombuffer(f.read(), dtype=TRACE_DTYPE)
+    return header, events
+
+
+# The process-wide instrumentation used by the simulation modules
+instruments = Instrumentation()
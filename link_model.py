@@ -0,0 +1,224 @@
+import itertools
+import math
+from collections import OrderedDict
+
+import numpy as np
+
+from edge_costs import VEHICLE_SPACING
+
+SATURATION_FLOW = 0.5  # Vehicles per second that can leave an edge, i.e. 1800 per hour
+MAX_WAIT = 300.0  # Seconds a vehicle waits for room on a full edge before squeezing in anyway
+
+
+class LinkModel:
+    """
+    Spatial-queue link model: every edge is a FIFO queue of vehicles.
+
+    Each edge keeps its vehicles in entry order as a linked list, so the leader and
+    follower of a vehicle and its place relative to another are found in O(1). An edge
+    holds at most `storage` vehicles (its length in jammed vehicle spacings) and lets
+    at most `outflow` vehicles per second leave, so a vehicle exits no earlier than
+    1 / outflow after its leader. A vehicle that finds the next edge full stays where
+    it is, which keeps its current edge occupied and lets queues spill back upstream;
+    it is released when a vehicle leaves the full edge, or after max_wait seconds to
+    break gridlock.
+
+    The model follows the network's edge listener, so it sees every vehicle moving
+    through TrafficNetwork; storage is checked against the network's densities.
+    """
+
+    def __init__(self, traffic_network, spacing=VEHICLE_SPACING, outflow=SATURATION_FLOW, max_wait=MAX_WAIT):
+        """
+        :param traffic_network: The traffic network instance.
+        :param spacing: Meters of lane per vehicle in a jam, setting each edge's storage capacity.
+        :param outflow: Vehicles per second that can leave an edge, a scalar or per-edge array.
+        :param max_wait: Seconds a blocked vehicle waits before entering a full edge regardless.
+        """
+        self.traffic_network = traffic_network
+        self.edges = traffic_network.edges
+        self.clock = traffic_network.clock
+        length = np.nan_to_num(self.edges.length, nan=0.0)
+        self.storage = np.maximum(np.floor(length / spacing), 1).astype(np.int32)
+        self.headway = 1.0 / np.broadcast_to(np.asarray(outflow, dtype=np.float64), self.storage.shape)
+        self.max_wait = max_wait
+        self.head = {}  # edge index -> first vehicle in the queue
+        self.tail = {}  # edge index -> last vehicle in the queue
+        self.ahead = {}  # vehicle id -> vehicle in front of it on its edge
+        self.behind = {}  # vehicle id -> vehicle behind it on its edge
+        self.order = {}  # vehicle id -> entry sequence number, increasing along each queue
+        self.entry_time = {}  # vehicle id -> time it entered its edge
+        self.exit_at = {}  # vehicle id -> earliest time it may leave its edge
+        self.speed_factor = {}  # vehicle id -> slowdown applied to its next traversal
+        self.waiting = {}  # edge index -> OrderedDict of vehicle id -> (blocked since, payload)
+        self.blocked = {}  # vehicle id -> (edge index, blocked since)
+        self._sequence = itertools.count()
+        traffic_network.add_edge_listener(self.on_edge_change)
+
+    def on_edge_change(self, vehicle_id, left_edge, entered_edge):
+        """Edge listener: move the vehicle between queues. A vehicle that moves is no longer waiting."""
+        if vehicle_id in self.blocked:
+            self.unblock(vehicle_id)
+        if left_edge is not None:
+            self._remove(vehicle_id, left_edge)
+        if entered_edge is not None:
+            self._append(vehicle_id, entered_edge)
+
+    def _append(self, vehicle_id, i):
+        tail = self.tail.get(i)
+        if tail is None:
+            self.head[i] = vehicle_id
+        else:
+            self.behind[tail] = vehicle_id
+            self.ahead[vehicle_id] = tail
+        self.tail[i] = vehicle_id
+        self.order[vehicle_id] = next(self._sequence)
+        self.entry_time[vehicle_id] = self.clock.time()
+
+    def _remove(self, vehicle_id, i):
+        front = self.ahead.pop(vehicle_id, None)
+        back = self.behind.pop(vehicle_id, None)
+        if front is None:
+            if back is None:
+                self.head.pop(i, None)
+            else:
+                self.head[i] = back
+        else:
+            if back is None:
+                self.behind.pop(front, None)
+            else:
+                self.behind[front] = back
+        if back is None:
+            if front is None:
+                self.tail.pop(i, None)
+            else:
+                self.tail[i] = front
+        else:
+            if front is None:
+                self.ahead.pop(back, None)
+            else:
+                self.ahead[back] = front
+        self.order.pop(vehicle_id, None)
+        self.entry_time.pop(vehicle_id, None)
+        self.exit_at.pop(vehicle_id, None)
+
+    def leader(self, vehicle_id):
+        """Returns the vehicle directly ahead on the same edge, or None."""
+        return self.ahead.get(vehicle_id)
+
+    def follower(self, vehicle_id):
+        """Returns the vehicle directly behind on the same edge, or None."""
+        return self.behind.get(vehicle_id)
+
+    def is_ahead(self, vehicle_id, other_vehicle_id):
+        """
+        Returns True if the vehicle entered its edge before the other one, False if after,
+        and None unless both are queued on the same edge.
+        """
+        edges = self.edges.vehicle_edge
+        i = edges.get(vehicle_id)
+        if i is None or edges.get(other_vehicle_id) != i:
+            return None
+        return self.order[vehicle_id] < self.order[other_vehicle_id]
+
+    def queue(self, i):
+        """Returns the vehicles on edge i from first to last."""
+        vehicles = []
+        vehicle_id = self.head.get(i)
+        while vehicle_id is not None:
+            vehicles.append(vehicle_id)
+            vehicle_id = self.behind.get(vehicle_id)
+        return vehicles
+
+    def has_room(self, i, vehicle_id=None):
+        """Returns True if edge i can take another vehicle (or the given vehicle is already on it)."""
+        if vehicle_id is not None and self.edges.vehicle_edge.get(vehicle_id) == i:
+            return True
+        return self.edges.traffic_density[i] < self.storage[i]
+
+    def exit_time(self, vehicle_id, i, travel_time):
+        """
+        Schedule the vehicle's exit from edge i: after its travel time, and no sooner than the
+        outflow capacity allows after its leader.
+
+        :return: The exit time.
+        """
+        factor = self.speed_factor.pop(vehicle_id, None)
+        if factor:
+            travel_time /= factor
+        t = self.entry_time.get(vehicle_id, self.clock.time()) + travel_time
+        leader = self.ahead.get(vehicle_id)
+        if leader is not None and leader in self.exit_at:
+            t = max(t, self.exit_at[leader] + float(self.headway[i]))
+        self.exit_at[vehicle_id] = t
+        return t
+
+    def slow_down(self, vehicle_id, factor):
+        """Scale the speed of the vehicle's next traversal by factor (e.g. 0.8)."""
+        self.speed_factor[vehicle_id] = factor
+
+    def block(self, vehicle_id, i, payload=None, since=None):
+        """
+        Hold a vehicle back because edge i is full, replacing any earlier wait.
+
+        :param payload: Anything the caller needs to resume the vehicle, returned by release.
+        :param since: The time it started waiting; defaults to now.
+        :return: The time the vehicle has been waiting since.
+        """
+        self.unblock(vehicle_id)
+        if since is None:
+            since = self.clock.time()
+        self.blocked[vehicle_id] = (i, since)
+        waiting = self.waiting.get(i)
+        if waiting is None:
+            waiting = self.waiting[i] = OrderedDict()
+        waiting[vehicle_id] = (since, payload)
+        return since
+
+    def unblock(self, vehicle_id):
+        """Forget that a vehicle is waiting."""
+        entry = self.blocked.pop(vehicle_id, None)
+        if entry is None:
+            return
+        waiting = self.waiting[entry[0]]
+        del waiting[vehicle_id]
+        if not waiting:
+            del self.waiting[entry[0]]
+
+    def blocked_since(self, vehicle_id):
+        """Returns the time the vehicle has been waiting since, or None if it isn't waiting."""
+        entry = self.blocked.get(vehicle_id)
+        return None if entry is None else entry[1]
+
+    def release(self, i):
+        """
+        Let the first vehicle waiting for edge i go, if the edge has room.
+
+        :return: (vehicle id, payload), or None.
+        """
+        waiting = self.waiting.get(i)
+        if not waiting or not self.has_room(i):
+            return None
+        vehicle_id, (_, payload) = next(iter(waiting.items()))
+        self.unblock(vehicle_id)
+        return vehicle_id, payload
+
+    def rebuild(self, order=None):
+        """
+        Rebuild the queues from the network's occupancy, e.g. after a restore.
+
+        :param order: Optional dict of vehicle id -> queue position; by default vehicles queue by arrival time.
+        """
+        self.head, self.tail, self.ahead, self.behind = {}, {}, {}, {}
+        self.order, self.entry_time, self.exit_at = {}, {}, {}
+        self.waiting, self.blocked, self.speed_factor = {}, {}, {}
+        edges = self.edges
+        now = self.clock.time()
+        for i, occupants in edges.occupants.items():
+            arrival_times = edges.arrival_times.get(i, {})
+            if order is not None:
+                key = order.get
+            else:
+                key = lambda vehicle_id: arrival_times.get(vehicle_id, -math.inf)
+            for vehicle_id in sorted(occupants, key=key):
+                self._append(vehicle_id, i)
+                self.entry_time[vehicle_id] = arrival_times.get(vehicle_id, now)
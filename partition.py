@@ -0,0 +1,423 @@
+import os
+import time
+from collections import Counter
+from multiprocessing import get_context
+
+import numpy as np
+
+from fleet import Fleet, MOVING, NOT_ON_EDGE, SLOT_ARRAYS
+from graph_snapshot import SnapshotGraph, graph_to_arrays
+from instrumentation import instruments
+from shared_arrays import SharedArrays
+from simulation_engine import SimulationClock
+from traffic_network import TrafficNetwork
+
+
+def partition_nodes(edges, node_x, node_y, k, imbalance=0.03, refine_passes=2):
+    """
+    Split the nodes of a network into k spatially compact regions of about equal size.
+
+    Regions come from recursive coordinate bisection: each cell is cut across its longer
+    axis so both sides get a share of the outgoing edges proportional to the number of
+    regions they will hold. A few greedy passes then move boundary nodes to the
+    neighboring region holding most of their neighbors, which lowers the edge cut.
+
+    :param edges: The network's EdgeStore.
+    :param node_x: Node longitudes, aligned with edges.node_ids.
+    :param node_y: Node latitudes, aligned with edges.node_ids.
+    :param k: Number of regions.
+    :param imbalance: How far above the average weight a region may grow during refinement.
+    :param refine_passes: Number of boundary refinement passes.
+    :return: int32 array with the region of every node.
+    """
+    n = len(edges.node_ids)
+    weight = np.bincount(edges.start_index, minlength=n).astype(np.float64) + 1
+    x = np.asarray(node_x, dtype=np.float64) * np.cos(np.radians(np.nanmean(node_y) if n else 0.0))
+    y = np.asarray(node_y, dtype=np.float64)
+    # Nodes without coordinates are placed at the centroid
+    x = np.where(np.isnan(x), np.nanmean(x) if n else 0.0, x)
+    y = np.where(np.isnan(y), np.nanmean(y) if n else 0.0, y)
+
+    region = np.zeros(n, dtype=np.int32)
+    stack = [(np.arange(n), 0, k)]
+    while stack:
+        nodes, first, count = stack.pop()
+        if count == 1 or len(nodes) == 0:
+            region[nodes] = first
+            continue
+        left = count // 2
+        xs, ys = x[nodes], y[nodes]
+        coords = xs if np.ptp(xs) >= np.ptp(ys) else ys
+        nodes = nodes[np.argsort(coords, kind='stable')]
+        cumulative = np.cumsum(weight[nodes])
+        cut = int(np.searchsorted(cumulative, cumulative[-1] * left / count))
+        stack.append((nodes[:cut], first, left))
+        stack.append((nodes[cut:], first + left, count - left))
+
+    if k > 1 and refine_passes:
+        _refine(region, weight, edges.start_index, edges.end_index, k, imbalance, refine_passes)
+    return region
+
+
+def _refine(region, weight, tails, heads, k, imbalance, passes):
+    """Greedily move boundary nodes to the neighboring region with most of their neighbors."""
+    n = len(region)
+    loops = tails == heads
+    a = np.concatenate([tails[~loops], heads[~loops]]).astype(np.int64)
+    b = np.concatenate([heads[~loops], tails[~loops]]).astype(np.int64)
+    order = np.argsort(a, kind='stable')
+    ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(a, minlength=n), out=ptr[1:])
+    neighbors = b[order]
+
+    size = np.bincount(region, weights=weight, minlength=k)
+    cap = (1 + imbalance) * weight.sum() / k
+    for _ in range(passes):
+        moved = 0
+        boundary = np.unique(a[region[a] != region[b]])
+        for u in boundary.tolist():
+            own = region[u]
+            counts = Counter(region[neighbors[ptr[u]:ptr[u + 1]]].tolist())
+            target, best = own, counts.get(own, 0)
+            for r, c in counts.items():
+                if c > best and size[r] + weight[u] <= cap:
+                    target, best = r, c
+            if target != own:
+                region[u] = target
+                size[own] -= weight[u]
+                size[target] += weight[u]
+                moved += 1
+        if not moved:
+            break
+
+
+class PartitionedSimulation:
+    """
+    Runs a Fleet simulation split over worker processes, one per region of the graph.
+
+    Every worker holds the whole graph but only the vehicles at nodes of its region, and
+    only ever changes the density of edges starting in its region. Densities live in
+    shared memory, so a CTCU in any worker routes with the global traffic picture.
+
+    Workers advance in lockstep. A tick runs the same rounds as Fleet.step: all workers
+    exit the vehicles whose edge ends within the tick, vehicles whose next edge starts in
+    another region are handed to that worker in one batch per round, and then every worker
+    enters its vehicles. Rerouting happens in a separate phase, after every worker has
+    counted its entries, so routes are computed from the same densities as in a
+    single-process Fleet and the results match.
+    """
+
+    def __init__(self, traffic_network, processes=None, ctc_factory=None, region=None):
+        """
+        :param traffic_network: The traffic network instance.
+        :param processes: Number of regions and worker processes; defaults to the CPU count.
+        :param ctc_factory: Optional picklable callable building a CTCU from a worker's network,
+            e.g. RouteEngine or a functools.partial around it.
+        :param region: Optional precomputed region of every node, as returned by partition_nodes.
+        """
+        self.traffic_network = traffic_network
+        self.edges = traffic_network.edges
+        self.clock = traffic_network.clock
+        self.processes = processes or os.cpu_count() or 1
+        if region is None:
+            region = partition_nodes(self.edges, traffic_network.node_x, traffic_network.node_y, self.processes)
+        self.region = np.asarray(region, dtype=np.int32)
+
+        graph = traffic_network.graph
+        arrays = graph.arrays() if isinstance(graph, SnapshotGraph) else graph_to_arrays(
+            graph, traffic_network.default_maxspeed)
+        arrays['region'] = self.region
+        arrays['traffic_density'] = np.zeros(len(arrays['indices']), dtype=np.int32)
+        self.shared = SharedArrays(arrays)
+        self.traffic_density = self.shared['traffic_density']
+
+        # With a snapshot the workers' edge order matches the network's, so it can read the live densities
+        self._shares_density = isinstance(graph, SnapshotGraph)
+        if self._shares_density:
+            self.traffic_density[:] = self.edges.traffic_density
+            self.edges.traffic_density = self.traffic_density
+
+        context = get_context()
+        self.connections = []
+        self.workers = []
+        for r in range(self.processes):
+            parent, child = context.Pipe()
+            worker = context.Process(target=_run_worker, daemon=True, args=(
+                child, r, self.shared.spec(), traffic_network.default_maxspeed, self.clock.time(), ctc_factory))
+            worker.start()
+            child.close()
+            self.connections.append(parent)
+            self.workers.append(worker)
+        self._signal_delays = None
+        self.rounds = 0
+        self.handoffs = 0
+
+    def _broadcast(self, command, *args):
+        for connection in self.connections:
+            connection.send((command, args))
+        return [connection.recv() for connection in self.connections]
+
+    def add(self, vehicle_id, start_node, destination_node, route=None, speed=25):
+        """Add a vehicle to the worker of its start node's region, like Fleet.add."""
+        r = self.region[self.edges.node_index(start_node)]
+        self.connections[r].send(('add', ([(vehicle_id, start_node, destination_node, route, speed)],)))
+        self.connections[r].recv()
+
+    def add_many(self, vehicles):
+        """
+        Add many vehicles, sending one batch to each worker.
+
+        :param vehicles: Iterable of (vehicle_id, start_node, destination_node, route, speed) tuples.
+        """
+        vehicles = list(vehicles)
+        if not vehicles:
+            return
+        regions = self.region[self.edges.node_index(np.array([v[1] for v in vehicles]))].tolist()
+        batches = [[] for _ in self.connections]
+        for vehicle, r in zip(vehicles, regions):
+            batches[r].append(vehicle)
+        for connection, batch in zip(self.connections, batches):
+            connection.send(('add', (batch,)))
+        for connection in self.connections:
+            connection.recv()
+
+    def step(self, dt):
+        """
+        Advance every worker by dt seconds of simulated time, like Fleet.step.
+
+        :return: The number of edges completed during the tick.
+        """
+        started = time.perf_counter() if instruments.enabled else None
+        now = self.clock.time()
+        t_end = now + dt
+        delays = self.traffic_network.signals.delay
+        if delays != self._signal_delays:
+            self._signal_delays = dict(delays)
+            self._broadcast('signals', self._signal_delays)
+
+        if sum(self._broadcast('begin', now, t_end)):
+            self._broadcast('reroute')
+
+        completed = 0
+        while True:
+            replies = self._broadcast('exit')
+            done = sum(count for count, _ in replies)
+            if not done:
+                break
+            completed += done
+            self.rounds += 1
+            incoming = [[] for _ in self.connections]
+            for _, outgoing in replies:
+                for r, batch in outgoing.items():
+                    incoming[r].append(batch)
+                    self.handoffs += len(batch['ids'])
+            for connection, batches in zip(self.connections, incoming):
+                connection.send(('enter', (batches,)))
+            if sum(connection.recv() for connection in self.connections):
+                self._broadcast('reroute')
+
+        self.clock.advance_to(t_end)
+        if self._shares_density:
+            self.traffic_network.edge_cost_cache.mark_all()
+        if started is not None:
+            instruments.observe('partition.tick', time.perf_counter() - started)
+            instruments.count('partition.edges_completed', completed)
+        return completed
+
+    def run(self, until, dt=1.0):
+        """Step until the clock reaches until. Returns the number of edges completed."""
+        completed = 0
+        while self.clock.time() < until:
+            completed += self.step(min(dt, until - self.clock.time()))
+        return completed
+
+    def vehicles(self):
+        """
+        Collect the state of every vehicle from the workers.
+
+        :return: Dict of vehicle id -> (current node id, next node id or None, state code).
+        """
+        result = {}
+        for part in self._broadcast('collect'):
+            result.update(part)
+        return result
+
+    def close(self):
+        """Stop the workers and release the shared memory."""
+        if not self.connections:
+            return
+        self._broadcast('stop')
+        for worker in self.workers:
+            worker.join()
+        if self._shares_density:
+            self.edges.traffic_density = self.traffic_density.copy()
+            self.traffic_network.edge_cost_cache.mark_all()
+        self.traffic_density = None
+        self.shared.close()
+        self.connections = []
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RegionFleet(Fleet):
+    """
+    The Fleet of one worker of a PartitionedSimulation. Fleet.step is split into the
+    phases the coordinator runs in lockstep across workers.
+    """
+
+    def __init__(self, traffic_network, region, own, ctc_unit=None):
+        super().__init__(traffic_network, ctc_unit)
+        self.region = region
+        self.own = own
+        self.t_end = 0.0
+        self.rerouting = None  # (slots, times) of vehicles waiting for the reroute phase
+
+    def begin(self, now, t_end):
+        """Start a tick: enter the vehicles that are ready to move at the current time."""
+        self.clock.advance_to(now)
+        self.t_end = t_end
+        self.refresh_signals()
+        n = self.size
+        self.exit_time[:n][(self.state[:n] == MOVING) & (self.edge[:n] == NOT_ON_EDGE)] = now
+        return self.enter_pending()
+
+    def exit_due(self):
+        """
+        Exit every vehicle whose edge ends within the tick and split off those continuing in other regions.
+
+        :return: (number of vehicles exited, dict of region -> handoff batch).
+        """
+        self._settle()
+        n = self.size
+        done = np.flatnonzero((self.state[:n] == MOVING) & (self.edge[:n] != NOT_ON_EDGE)
+                              & (self.exit_time[:n] <= self.t_end))
+        if not done.size:
+            return 0, {}
+        self._exit(done)
+        leaving = done[(self.state[done] == MOVING) & (self.region[self.current[done]] != self.own)]
+        outgoing = {}
+        if leaving.size:
+            targets = self.region[self.current[leaving]]
+            for r in np.unique(targets).tolist():
+                outgoing[r] = self._pack(leaving[targets == r])
+            self.remove(leaving)
+        return done.size, outgoing
+
+    def enter_pending(self, batches=()):
+        """
+        Take in handed-off vehicles and count every vehicle waiting to enter an edge on it.
+
+        :return: The number of vehicles that entered a congested edge and wait for the reroute phase.
+        """
+        for batch in batches:
+            self._unpack(batch)
+        n = self.size
+        pending = np.flatnonzero((self.state[:n] == MOVING) & (self.edge[:n] == NOT_ON_EDGE))
+        if not pending.size:
+            return 0
+        times = self.exit_time[pending]
+        congested = self._occupy(pending, times)
+        if congested.any():
+            self.rerouting = (pending[congested], times[congested])
+            self._pull_over(self.rerouting[0])
+        return int(congested.sum())
+
+    def reroute_pending(self):
+        """
+        Route the vehicles pulled over by enter_pending. They are put on their new edge by the
+        next exit_due, once every worker has finished reading the densities for its routes.
+        """
+        if self.rerouting is not None:
+            # Other workers have changed densities since the last refresh without marking them
+            self.costs.mark_all()
+            self._request_routes(self.rerouting[0])
+
+    def _settle(self):
+        if self.rerouting is not None:
+            slots, times = self.rerouting
+            self.rerouting = None
+            self._enter(slots, times, check_congestion=False)
+
+    def _pack(self, slots):
+        """Build a handoff batch for the given vehicles; exit_time carries the time they left their edge."""
+        batch = {name: getattr(self, name)[slots].copy() for name in SLOT_ARRAYS}
+        batch['ids'] = [self.vehicle_ids[slot] for slot in slots.tolist()]
+        remaining = [self.remaining_route(slot) for slot in slots.tolist()]
+        batch['route_length'] = np.array([len(route) for route in remaining], dtype=np.int64)
+        batch['route_nodes'] = np.concatenate(remaining) if remaining else np.empty(0, dtype=np.int32)
+        return batch
+
+    def _unpack(self, batch):
+        count = len(batch['ids'])
+        capacity = len(self.current)
+        while self.size + count > capacity:
+            capacity *= 2
+        if capacity > len(self.current):
+            self._grow(capacity)
+        slots = np.arange(self.size, self.size + count)
+        for name in SLOT_ARRAYS:
+            getattr(self, name)[slots] = batch[name]
+        for slot, vehicle_id in zip(slots.tolist(), batch['ids']):
+            self.vehicle_ids.append(vehicle_id)
+            self.index[vehicle_id] = slot
+        self.size += count
+        ends = np.cumsum(batch['route_length'])
+        for slot, end, length in zip(slots.tolist(), ends.tolist(), batch['route_length'].tolist()):
+            self._store_route_indices(slot, batch['route_nodes'][end - length:end])
+
+    def collect(self):
+        node_ids = self.edges.node_ids
+        result = {}
+        for slot, vehicle_id in enumerate(self.vehicle_ids):
+            nxt = self.next[slot]
+            result[vehicle_id] = (node_ids[self.current[slot]].item(),
+                                  None if nxt < 0 else node_ids[nxt].item(), int(self.state[slot]))
+        return result
+
+
+def _run_worker(connection, own, spec, default_maxspeed, start_time, ctc_factory):
+    """Worker process: build the network over the shared arrays and serve the coordinator's commands."""
+    shared = SharedArrays.attach(spec)
+    network = TrafficNetwork(SnapshotGraph(shared.arrays), default_maxspeed, clock=SimulationClock(start_time))
+    network.edges.traffic_density = shared['traffic_density']
+    network.edge_cost_cache.mark_all()
+    ctc_unit = ctc_factory(network) if ctc_factory is not None else None
+    fleet = RegionFleet(network, shared['region'], own, ctc_unit)
+    try:
+        while True:
+            command, args = connection.recv()
+            if command == 'stop':
+                connection.send(None)
+                break
+            if command == 'add':
+                for vehicle_id, start_node, destination_node, route, speed in args[0]:
+                    fleet.add(vehicle_id, start_node, destination_node, route, speed)
+                reply = None
+            elif command == 'signals':
+                # The coordinator sends the full set, so signals it dropped must go too
+                network.signals.delay.clear()
+                network.signals.delay.update(args[0])
+                fleet.refresh_signals()
+                reply = None
+            elif command == 'begin':
+                reply = fleet.begin(*args)
+            elif command == 'exit':
+                reply = fleet.exit_due()
+            elif command == 'enter':
+                reply = fleet.enter_pending(args[0])
+            elif command == 'reroute':
+                fleet.reroute_pending()
+                reply = None
+            elif command == 'collect':
+                reply = fleet.collect()
+            else:
+                raise ValueError(f"Unknown command: {command}")
+            connection.send(reply)
+    finally:
+        # The network keeps views into the shared blocks; they are released when the process exits
+        connection.close()
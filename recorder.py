@@ -0,0 +1,267 @@
+import json
+import os
+import queue
+import threading
+import time
+import zipfile
+
+import numpy as np
+
+from instrumentation import instruments
+
+INDEX_FILE = 'index.json'
+NO_EDGE = -1  # Edge column value for a vehicle entering from or leaving to off the network
+COMPRESS_LEVEL = 1  # zlib level; higher levels barely shrink these columns but cost several times the CPU
+
+
+def _ids(values):
+    """Vehicle ids as an int64 array if they are all integers, otherwise as strings."""
+    if all(isinstance(v, (int, np.integer)) for v in values):
+        return np.array(values, dtype=np.int64)
+    return np.array([str(v) for v in values], dtype=np.str_)
+
+
+def _save_npz(path, columns):
+    """Like np.savez_compressed, with a faster compression level."""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as archive:
+        for name, values in columns.items():
+            with archive.open(f'{name}.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, values, allow_pickle=False)
+
+
+class Recorder:
+    """
+    Records edge densities and vehicle edge transitions to chunked, compressed columnar files.
+
+    Transitions (time, vehicle, left edge, entered edge) come from the network's edge
+    listener. Densities are recorded by snapshot(), called once per tick: it compares
+    the density array with the previous snapshot and writes only the edges that
+    changed, so it also sees changes made by a Fleet. Rows are buffered in memory and
+    handed to a background thread in chunks of chunk_rows; that thread compresses them
+    into .npz files and keeps index.json up to date. At most max_pending chunks wait for
+    the writer, after which recording blocks until it catches up.
+    """
+
+    def __init__(self, traffic_network, directory, chunk_rows=262144, max_pending=4):
+        """
+        :param traffic_network: The traffic network to record.
+        :param directory: The output directory (created if needed).
+        :param chunk_rows: Number of rows per chunk file.
+        :param max_pending: Maximum number of chunks waiting to be written.
+        """
+        self.traffic_network = traffic_network
+        self.edges = traffic_network.edges
+        self.clock = traffic_network.clock
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        os.makedirs(directory, exist_ok=True)
+        self.index = {'transitions': [], 'densities': []}  # Chunks handed to the writer
+        self._written = {'transitions': [], 'densities': []}  # Chunks on disk, owned by the writer thread
+        self.rows = {'transitions': 0, 'densities': 0}
+        self._transitions = ([], [], [], [])  # time, vehicle, left edge, entered edge
+        self._densities = ([], [], [])  # time, edge index array, density array
+        self._density_rows = 0
+        self._last_density = np.zeros(len(self.edges), dtype=self.edges.traffic_density.dtype)
+        self._chunks = queue.Queue(max_pending)
+        self._error = None
+        self._writer = threading.Thread(target=self._write_chunks, name='recorder', daemon=True)
+        self._writer.start()
+        self._write_index()
+        traffic_network.add_edge_listener(self.on_edge_change)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def on_edge_change(self, vehicle_id, left_edge, entered_edge):
+        """Edge listener: record a vehicle moving between edges."""
+        times, vehicles, left, entered = self._transitions
+        times.append(self.clock.time())
+        vehicles.append(vehicle_id)
+        left.append(NO_EDGE if left_edge is None else left_edge)
+        entered.append(NO_EDGE if entered_edge is None else entered_edge)
+        if len(vehicles) >= self.chunk_rows:
+            self._flush_transitions()
+
+    def snapshot(self, t=None):
+        """
+        Record the densities of the edges that changed since the previous snapshot.
+
+        :param t: The time of the snapshot; defaults to the clock's time.
+        :return: The number of edges recorded.
+        """
+        density = self.edges.traffic_density
+        changed = np.flatnonzero(density != self._last_density)
+        if not changed.size:
+            return 0
+        values = density[changed]
+        self._last_density[changed] = values
+        times, edges, densities = self._densities
+        times.append(np.full(changed.size, self.clock.time() if t is None else t))
+        edges.append(changed.astype(np.int32))
+        densities.append(values.astype(np.int32))
+        self._density_rows += changed.size
+        if self._density_rows >= self.chunk_rows:
+            self._flush_densities()
+        return changed.size
+
+    def flush(self):
+        """Hand the buffered rows to the writer, even if the chunks are not full."""
+        self._flush_transitions()
+        self._flush_densities()
+
+    def close(self):
+        """Write everything still buffered and stop the writer thread."""
+        if self._writer is None:
+            return
+        listeners = self.traffic_network.edge_listeners
+        if self.on_edge_change in listeners:
+            listeners.remove(self.on_edge_change)
+        self.flush()
+        self._chunks.put(None)
+        self._writer.join()
+        self._writer = None
+        if self._error is not None:
+            raise self._error
+
+    def _flush_transitions(self):
+        times, vehicles, left, entered = self._transitions
+        if not times:
+            return
+        self._submit('transitions', {
+            'time': np.array(times, dtype=np.float64),
+            'vehicle': _ids(vehicles),
+            'left': np.array(left, dtype=np.int32),
+            'entered': np.array(entered, dtype=np.int32),
+        })
+        self._transitions = ([], [], [], [])
+
+    def _flush_densities(self):
+        times, edges, densities = self._densities
+        if not times:
+            return
+        self._submit('densities', {
+            'time': np.concatenate(times),
+            'edge': np.concatenate(edges),
+            'density': np.concatenate(densities),
+        })
+        self._densities = ([], [], [])
+        self._density_rows = 0
+
+    def _submit(self, kind, columns):
+        if self._error is not None:
+            raise self._error
+        number = len(self.index[kind])
+        entry = {
+            'file': f'{kind}-{number:06d}.npz',
+            'rows': len(columns['time']),
+            'start': float(columns['time'][0]),
+            'end': float(columns['time'][-1]),
+        }
+        self.index[kind].append(entry)
+        self.rows[kind] += entry['rows']
+        self._chunks.put((kind, entry, columns))
+
+    def _write_chunks(self):
+        """Writer thread: compress chunks to disk and keep the index current."""
+        while True:
+            item = self._chunks.get()
+            if item is None:
+                break
+            kind, entry, columns = item
+            started = time.perf_counter() if instruments.enabled else None
+            try:
+                _save_npz(os.path.join(self.directory, entry['file']), columns)
+                self._written[kind].append(entry)
+                self._write_index()
+            except Exception as e:
+                self._error = e
+            if started is not None:
+                instruments.observe('recorder.write', time.perf_counter() - started)
+                instruments.count('recorder.chunks')
+
+    def _write_index(self):
+        index = dict(self._written, num_edges=len(self.edges))
+        path = os.path.join(self.directory, INDEX_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.tmp', path)
+
+
+class Recording:
+    """
+    Reads a directory written by a Recorder. Queries load only the chunks overlapping the
+    requested time range, one at a time.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.num_edges = self.index['num_edges']
+
+    def _chunks(self, kind, start=None, end=None):
+        for entry in self.index.get(kind, []):
+            if (start is not None and entry['end'] < start) or (end is not None and entry['start'] > end):
+                continue
+            with np.load(os.path.join(self.directory, entry['file'])) as chunk:
+                yield {name: chunk[name] for name in chunk.files}
+
+    @staticmethod
+    def _select(columns, start, end, mask=None):
+        t = columns['time']
+        keep = np.ones(len(t), dtype=bool) if mask is None else mask
+        if start is not None:
+            keep &= t >= start
+        if end is not None:
+            keep &= t <= end
+        return {name: values[keep] for name, values in columns.items()}
+
+    @staticmethod
+    def _concat(parts, names):
+        if not parts:
+            return {name: np.empty(0) for name in names}
+        return {name: np.concatenate([part[name] for part in parts]) for name in names}
+
+    def transitions(self, start=None, end=None, vehicle=None, edge=None):
+        """
+        Vehicle edge transitions between start and end (inclusive).
+
+        :param vehicle: Only transitions of this vehicle.
+        :param edge: Only transitions leaving or entering this edge index.
+        :return: Dict of columns time, vehicle, left and entered (NO_EDGE off the network).
+        """
+        parts = []
+        for columns in self._chunks('transitions', start, end):
+            mask = None
+            if vehicle is not None:
+                mask = columns['vehicle'] == (vehicle if columns['vehicle'].dtype.kind in 'iu' else str(vehicle))
+            if edge is not None:
+                on_edge = (columns['left'] == edge) | (columns['entered'] == edge)
+                mask = on_edge if mask is None else mask & on_edge
+            parts.append(self._select(columns, start, end, mask))
+        return self._concat(parts, ('time', 'vehicle', 'left', 'entered'))
+
+    def densities(self, start=None, end=None, edges=None):
+        """
+        Recorded density changes between start and end (inclusive).
+
+        :param edges: Optional array of edge indices to restrict the result to.
+        :return: Dict of columns time, edge and density.
+        """
+        parts = []
+        for columns in self._chunks('densities', start, end):
+            mask = None if edges is None else np.isin(columns['edge'], edges)
+            parts.append(self._select(columns, start, end, mask))
+        return self._concat(parts, ('time', 'edge', 'density'))
+
+    def density_at(self, t):
+        """Rebuild the density of every edge as of the last snapshot at or before time t."""
+        density = np.zeros(self.num_edges, dtype=np.int32)
+        for columns in self._chunks('densities', None, t):
+            keep = columns['time'] <= t
+            # Rows are in time order, so later writes to the same edge win
+            density[columns['edge'][keep]] = columns['density'][keep]
+        return density
@@ -0,0 +1,244 @@
+import json
+import math
+import os
+from collections import OrderedDict
+from multiprocessing import get_context
+
+import numpy as np
+
+from graph_snapshot import arrays_from_edges, normalize_maxspeed
+from spatial_index import haversine
+
+# Highway types kept for the 'drive' network type, roughly as OSMnx filters them
+DRIVE_HIGHWAYS = frozenset({
+    'motorway', 'motorway_link', 'trunk', 'trunk_link', 'primary', 'primary_link', 'secondary',
+    'secondary_link', 'tertiary', 'tertiary_link', 'unclassified', 'residential', 'living_street', 'road',
+})
+ONEWAY_FORWARD = frozenset({'yes', 'true', '1'})
+ONEWAY_REVERSE = frozenset({'-1', 'reverse'})
+
+# Responses split into segments, kept by each worker as neighbouring tiles usually read the same files
+RESPONSE_CACHE_SIZE = 4
+_responses = OrderedDict()
+
+
+def tile_bboxes(bbox, tile_size=0.05):
+    """
+    Split a bounding box into a grid of tiles.
+
+    :param bbox: Two latitudes followed by two longitudes, in either order, as GraphGenerator takes them.
+    :param tile_size: Tile side in degrees.
+    :return: List of (south, north, west, east) tiles covering the box.
+    """
+    south, north = sorted(bbox[:2])
+    west, east = sorted(bbox[2:])
+    rows = max(1, math.ceil((north - south) / tile_size))
+    cols = max(1, math.ceil((east - west) / tile_size))
+    lats = np.linspace(south, north, rows + 1).tolist()
+    lons = np.linspace(west, east, cols + 1).tolist()
+    return [(lats[r], lats[r + 1], lons[c], lons[c + 1]) for r in range(rows) for c in range(cols)]
+
+
+def index_cache(cache_dir='cache'):
+    """
+    Find the cached Overpass responses and the area their nodes cover.
+
+    :param cache_dir: The OSMnx response cache directory.
+    :return: List of (path, south, north, west, east), one per response holding nodes.
+    """
+    index = []
+    for name in sorted(os.listdir(cache_dir)):
+        path = os.path.join(cache_dir, name)
+        if not name.endswith('.json'):
+            continue
+        with open(path) as f:
+            response = json.load(f)
+        elements = response.get('elements') if isinstance(response, dict) else None
+        if not elements:
+            continue
+        lats = [e['lat'] for e in elements if e['type'] == 'node']
+        lons = [e['lon'] for e in elements if e['type'] == 'node']
+        if lats:
+            index.append((path, min(lats), max(lats), min(lons), max(lons)))
+    return index
+
+
+def _overlaps(tile, entry):
+    south, north, west, east = tile
+    return entry[1] <= north and entry[2] >= south and entry[3] <= east and entry[4] >= west
+
+
+def _inside(lat, lon, box, closed_north, closed_east):
+    """Half-open containment, so a point on a shared tile border belongs to exactly one tile."""
+    south, north, west, east = box
+    return (lat >= south) & ((lat <= north) if closed_north else (lat < north)) & \
+        (lon >= west) & ((lon <= east) if closed_east else (lon < east))
+
+
+def _read_response(path, network_type):
+    """
+    Split the ways of a cached response into directed segments, once per file and network type.
+
+    :return: Dict of arrays way, start, end (OSM ids), start_xy, end_xy (lon, lat) and maxspeed (objects).
+    """
+    key = (path, network_type)
+    segments = _responses.get(key)
+    if segments is not None:
+        _responses.move_to_end(key)
+        return segments
+    with open(path) as f:
+        elements = json.load(f)['elements']
+    nodes = {e['id']: (e['lon'], e['lat']) for e in elements if e['type'] == 'node'}
+
+    way_ids, starts, ends, maxspeeds = [], [], [], []
+    for way in elements:
+        if way['type'] != 'way':
+            continue
+        tags = way.get('tags', {})
+        if network_type == 'drive' and tags.get('highway') not in DRIVE_HIGHWAYS:
+            continue
+        way_nodes = [node for node in way['nodes'] if node in nodes]
+        oneway = tags.get('oneway')
+        if oneway in ONEWAY_REVERSE:
+            forward, backward = False, True
+        elif oneway in ONEWAY_FORWARD or oneway is None and (
+                tags.get('junction') == 'roundabout' or tags.get('highway') == 'motorway'):
+            forward, backward = True, False
+        else:
+            forward = backward = True
+        for u, v in zip(way_nodes[:-1], way_nodes[1:]):
+            if forward:
+                way_ids.append(way['id'])
+                starts.append(u)
+                ends.append(v)
+                maxspeeds.append(tags.get('maxspeed'))
+            if backward:
+                way_ids.append(way['id'])
+                starts.append(v)
+                ends.append(u)
+                maxspeeds.append(tags.get('maxspeed'))
+
+    segments = _responses[key] = {
+        'way': np.array(way_ids, dtype=np.int64),
+        'start': np.array(starts, dtype=np.int64),
+        'end': np.array(ends, dtype=np.int64),
+        'start_xy': np.array([nodes[node] for node in starts], dtype=np.float64).reshape(-1, 2),
+        'end_xy': np.array([nodes[node] for node in ends], dtype=np.float64).reshape(-1, 2),
+        'maxspeed': np.array(maxspeeds + [None], dtype=object)[:-1],
+    }
+    while len(_responses) > RESPONSE_CACHE_SIZE:
+        _responses.popitem(last=False)
+    return segments
+
+
+def build_tile(task):
+    """
+    Build the road segments of one tile from cached Overpass responses.
+
+    Each way is split into one edge per consecutive node pair. A tile keeps the edges
+    that start inside it and end inside the region, so every edge is built by exactly
+    one tile and tiles meet at shared node ids.
+
+    :param task: (tile, region, response paths, network_type), with boxes as (south, north, west, east).
+    :return: Dict of arrays start, end (OSM node ids), length (meters), maxspeed (raw values, as objects)
+             and node, x, y for every node the edges touch.
+    """
+    tile, region, paths, network_type = task
+    closed_north, closed_east = tile[1] == region[1], tile[3] == region[3]
+    parts = []
+    for path in paths:
+        segments = _read_response(path, network_type)
+        start_xy, end_xy = segments['start_xy'], segments['end_xy']
+        keep = (_inside(start_xy[:, 1], start_xy[:, 0], tile, closed_north, closed_east)
+                & _inside(end_xy[:, 1], end_xy[:, 0], region, True, True))
+        parts.append({name: values[keep] for name, values in segments.items()})
+    tile_segments = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    if len(parts) > 1:
+        # Responses can overlap; keep each segment of each way once
+        _, first = np.unique(np.stack([tile_segments['way'], tile_segments['start'], tile_segments['end']]),
+                             axis=1, return_index=True)
+        first.sort()
+        tile_segments = {name: values[first] for name, values in tile_segments.items()}
+
+    start, end = tile_segments['start'], tile_segments['end']
+    start_xy, end_xy = tile_segments['start_xy'], tile_segments['end_xy']
+    node, first = np.unique(np.concatenate([start, end]), return_index=True)
+    xy = np.concatenate([start_xy, end_xy])[first]
+    return {
+        'start': start,
+        'end': end,
+        'length': haversine(start_xy[:, 0], start_xy[:, 1], end_xy[:, 0], end_xy[:, 1]),
+        'maxspeed': tile_segments['maxspeed'],
+        'node': node,
+        'x': xy[:, 0],
+        'y': xy[:, 1],
+    }
+
+
+def load_region(bbox, cache_dir='cache', tile_size=0.05, processes=None, network_type='drive',
+                default_maxspeed=50, index=None):
+    """
+    Build the road network of a large area tile by tile from cached Overpass responses.
+
+    Tiles are built in worker processes, each holding only the responses that overlap
+    its tile, and come back as compact arrays. They are stitched at shared node ids
+    and every maxspeed is normalized to km/h in one pass. The graph is not simplified:
+    every OSM node along a way is a graph node.
+
+    :param bbox: Two latitudes followed by two longitudes, as GraphGenerator takes them.
+    :param cache_dir: The OSMnx response cache directory.
+    :param tile_size: Tile side in degrees.
+    :param processes: Number of worker processes; defaults to the CPU count, 1 builds in-process.
+    :param network_type: 'drive' keeps drivable highways only; anything else keeps every way.
+    :param default_maxspeed: The maxspeed used for edges where it's missing or can't be parsed.
+    :param index: Optional result of index_cache, to avoid rescanning the cache.
+    :return: Snapshot arrays (see graph_snapshot.SNAPSHOT_ARRAYS).
+    """
+    south, north = sorted(bbox[:2])
+    west, east = sorted(bbox[2:])
+    region = (south, north, west, east)
+    if index is None:
+        index = index_cache(cache_dir)
+    tasks = []
+    for tile in tile_bboxes(bbox, tile_size):
+        paths = [entry[0] for entry in index if _overlaps(tile, entry)]
+        if paths:
+            tasks.append((tile, region, paths, network_type))
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes <= 1 or len(tasks) <= 1:
+        tiles = [build_tile(task) for task in tasks]
+    else:
+        # Fresh workers now and then return the memory of the parsed responses
+        with get_context().Pool(min(processes, len(tasks)), maxtasksperchild=8) as pool:
+            tiles = list(pool.imap_unordered(build_tile, tasks))
+    return stitch_tiles(tiles, default_maxspeed)
+
+
+def stitch_tiles(tiles, default_maxspeed=50):
+    """
+    Merge tile arrays from build_tile into one graph.
+
+    :return: Snapshot arrays (see graph_snapshot.SNAPSHOT_ARRAYS).
+    """
+    if not tiles:
+        empty = np.empty(0)
+        return arrays_from_edges(np.empty(0, dtype=np.int64), empty, empty, np.empty(0, dtype=np.int64),
+                                 np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), empty, empty)
+    node_ids, first = np.unique(np.concatenate([tile['node'] for tile in tiles]), return_index=True)
+    x = np.concatenate([tile['x'] for tile in tiles])[first]
+    y = np.concatenate([tile['y'] for tile in tiles])[first]
+    start_index = np.searchsorted(node_ids, np.concatenate([tile['start'] for tile in tiles]))
+    end_index = np.searchsorted(node_ids, np.concatenate([tile['end'] for tile in tiles]))
+    length = np.concatenate([tile['length'] for tile in tiles])
+    maxspeed = normalize_maxspeed(np.concatenate([tile['maxspeed'] for tile in tiles]).tolist(), default_maxspeed)
+
+    # Parallel edges between the same pair of nodes get keys 0, 1, ... as in a MultiDiGraph
+    order = np.lexsort((end_index, start_index))
+    pairs = start_index[order] * len(node_ids) + end_index[order]
+    new_pair = np.r_[True, pairs[1:] != pairs[:-1]]
+    group_start = np.maximum.accumulate(np.where(new_pair, np.arange(len(pairs)), 0))
+    keys = np.empty(len(pairs), dtype=np.int32)
+    keys[order] = np.arange(len(pairs)) - group_start
+    return arrays_from_edges(node_ids, x, y, start_index, end_index, keys, length, maxspeed)
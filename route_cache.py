@@ -0,0 +1,155 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+class RouteCache:
+    """
+    Caches routes by (origin, destination) and recomputes them only when an edge
+    they use has become noticeably slower.
+
+    Each cached route records the edges it uses, and an edge -> routes reverse index
+    finds the routes affected by a change. When an edge's cost rises more than
+    `delta` above the cost it had when it was last validated, the routes using it
+    are marked dirty; they are recomputed lazily the next time they are requested.
+
+    The cache wraps a router (a RouteEngine, CCHRouter or CTCU) and offers the same
+    calculate_best_route interface; other attributes are looked up on the router.
+    """
+
+    def __init__(self, router, traffic_network, delta=0.1, max_routes=100000):
+        """
+        :param router: Object providing calculate_best_route(start, destination, traffic_network).
+        :param traffic_network: The traffic network instance; the cache listens to its edge changes.
+        :param delta: How much an edge's cost may rise before routes using it are recomputed.
+        :param max_routes: Maximum number of cached routes; the least recently used are evicted.
+        """
+        self.router = router
+        self.traffic_network = traffic_network
+        self.delta = delta
+        self.max_routes = max_routes
+        self.routes = OrderedDict()  # (origin, destination) -> list of node ids after origin
+        self.route_edges = {}  # (origin, destination) -> array of edge indices
+        self.edge_routes = {}  # edge index -> set of (origin, destination)
+        self.dirty = set()
+        self.baseline = traffic_network.edge_costs()  # Edge costs the cached routes were validated against
+        self.hits = 0
+        self.misses = 0
+        traffic_network.add_edge_listener(self.on_edge_change)
+
+    def __getattr__(self, name):
+        # Only called for attributes the cache doesn't have, e.g. a CTCU's threshold_density
+        if name == 'router':
+            raise AttributeError(name)
+        return getattr(self.router, name)
+
+    def __len__(self):
+        return len(self.routes)
+
+    def calculate_best_route(self, start_node, destination_node, traffic_network=None):
+        """
+        Returns the cached route between two nodes if it is still clean, computing it otherwise.
+
+        :return: List of node ids after start_node, as returned by the router.
+        """
+        key = (start_node, destination_node)
+        route = self.routes.get(key)
+        if route is not None and key not in self.dirty:
+            self.hits += 1
+            self.routes.move_to_end(key)
+            return list(route)
+
+        self.misses += 1
+        route = self.router.calculate_best_route(start_node, destination_node, traffic_network or self.traffic_network)
+        self._store(key, route)
+        return list(route) if route else route
+
+    def calculate_best_routes(self, pairs, traffic_network=None):
+        """
+        Returns the routes between several (start, destination) pairs. Routes that are not cached
+        or dirty are computed with one batched call to the router.
+
+        :return: List of routes, each as returned by calculate_best_route.
+        """
+        routes = [None] * len(pairs)
+        missing = {}  # (origin, destination) -> positions in pairs
+        for k, key in enumerate(pairs):
+            key = tuple(key)
+            route = self.routes.get(key)
+            if route is not None and key not in self.dirty:
+                self.hits += 1
+                self.routes.move_to_end(key)
+                routes[k] = list(route)
+            else:
+                missing.setdefault(key, []).append(k)
+        if missing:
+            self.misses += len(missing)
+            keys = list(missing)
+            for key, route in zip(keys, self.router.calculate_best_routes(keys, traffic_network or self.traffic_network)):
+                self._store(key, route)
+                for k in missing[key]:
+                    routes[k] = list(route) if route else route
+        return routes
+
+    def is_dirty(self, start_node, destination_node):
+        """Returns True if the route between two nodes is not cached or must be recomputed."""
+        key = (start_node, destination_node)
+        return key not in self.routes or key in self.dirty
+
+    def on_edge_change(self, vehicle_id, left_edge, entered_edge):
+        """Edge listener: check the edges a vehicle left and entered for cost increases."""
+        for i in (left_edge, entered_edge):
+            if i is not None and i in self.edge_routes:
+                cost = self.traffic_network.edge_travel_time(i)
+                if cost - self.baseline[i] > self.delta:
+                    self._invalidate_edges([i], cost)
+
+    def refresh(self):
+        """
+        Compare every edge cost against its baseline in one vectorized pass. Use this when
+        densities are changed without going through the network, e.g. by a Fleet.
+
+        :return: The number of routes marked dirty.
+        """
+        costs = self.traffic_network.edge_costs()
+        worse = np.flatnonzero(costs - self.baseline > self.delta)
+        before = len(self.dirty)
+        self._invalidate_edges(worse.tolist(), costs[worse])
+        return len(self.dirty) - before
+
+    def _invalidate_edges(self, edges, costs):
+        for i in edges:
+            keys = self.edge_routes.get(i)
+            if keys:
+                self.dirty.update(keys)
+        self.baseline[edges] = costs
+
+    def _store(self, key, route):
+        self._forget(key)
+        if not route:
+            return
+        edges = self.traffic_network.edges
+        path = edges.node_index([key[0]] + list(route))
+        route_edges = edges.lookup_pairs(path[:-1], path[1:])
+        route_edges = route_edges[route_edges >= 0]
+        # An edge other cached routes use keeps the lowest cost any of them was validated against,
+        # so storing this route never hides a rise those routes should see
+        shared = np.array([i in self.edge_routes for i in route_edges.tolist()], dtype=bool)
+        costs = self.traffic_network.edge_costs(route_edges)
+        self.baseline[route_edges] = np.where(shared, np.minimum(self.baseline[route_edges], costs), costs)
+        self.routes[key] = list(route)
+        self.route_edges[key] = route_edges
+        for i in route_edges.tolist():
+            self.edge_routes.setdefault(i, set()).add(key)
+        while len(self.routes) > self.max_routes:
+            self._forget(next(iter(self.routes)))
+
+    def _forget(self, key):
+        self.routes.pop(key, None)
+        self.dirty.discard(key)
+        for i in self.route_edges.pop(key, np.empty(0, dtype=np.int64)).tolist():
+            keys = self.edge_routes.get(i)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.edge_routes[i]
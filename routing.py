@@ -0,0 +1,194 @@
+import heapq
+import math
+import time
+
+import numpy as np
+
+from instrumentation import instruments
+from traffic_network import EARTH_RADIUS
+
+
+class RouteEngine:
+    """
+    Shortest-path routing over a TrafficNetwork using the live, congestion-weighted
+    edge cost from get_traffic_time, read from the network's edge cost cache.
+
+    The graph is held as forward and reverse CSR adjacency over node indices.
+    Routes are returned as int32 arrays of node indices (see TrafficNetwork.edges.node_ids).
+    """
+
+    def __init__(self, traffic_network):
+        self.traffic_network = traffic_network
+        edges = traffic_network.edges
+        self.edges = edges
+        self.num_nodes = len(edges.node_ids)
+
+        # Forward and reverse adjacency, as Python lists for fast scalar access in the search loops
+        self.forward_ptr, self.forward_head, self.forward_edge = self._csr(edges.start_index, edges.end_index)
+        self.reverse_ptr, self.reverse_head, self.reverse_edge = self._csr(edges.end_index, edges.start_index)
+
+        self.lon = np.radians(traffic_network.node_x).tolist()
+        self.lat = np.radians(traffic_network.node_y).tolist()
+        self.cos_lat = np.cos(np.radians(traffic_network.node_y)).tolist()
+
+        # The heuristic turns straight-line meters into a lower bound on the edge cost, which delay
+        # functions never take below the free-flow time length / maxspeed
+        finite = np.isfinite(edges.maxspeed) & (edges.maxspeed > 0)
+        self.max_speed = float(edges.maxspeed[finite].max()) if finite.any() else 1.0
+
+    def _csr(self, tails, heads):
+        order = np.argsort(tails, kind='stable')
+        counts = np.bincount(tails, minlength=self.num_nodes)
+        ptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(counts, out=ptr[1:])
+        return ptr.tolist(), heads[order].tolist(), order.tolist()
+
+    def edge_cost(self, e):
+        """The cost of the edge with index e, as get_traffic_time computes it."""
+        return self.traffic_network.edge_travel_time(e)
+
+    def _heuristic(self, v, target):
+        """Haversine distance from v to target, scaled into a lower bound on the remaining cost."""
+        lat1, lat2 = self.lat[v], self.lat[target]
+        a = (math.sin((lat2 - lat1) / 2) ** 2
+             + self.cos_lat[v] * self.cos_lat[target] * math.sin((self.lon[target] - self.lon[v]) / 2) ** 2)
+        h = 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a))) / self.max_speed
+        return h if h == h else 0.0  # Nodes without coordinates get no guidance
+
+    def astar(self, source, target):
+        """
+        A* search with a haversine heuristic.
+
+        :param source: Index of the start node.
+        :param target: Index of the destination node.
+        :return: int32 array of node indices from source to target, or None if unreachable.
+        """
+        ptr, head, edge_ids = self.forward_ptr, self.forward_head, self.forward_edge
+        costs = self.traffic_network.edge_cost_cache.cost_list()
+        heuristic = self._heuristic
+        dist = {source: 0.0}
+        parent = {source: -1}
+        heap = [(heuristic(source, target), 0.0, source)]
+        while heap:
+            _, g, u = heapq.heappop(heap)
+            if u == target:
+                return self._path(parent, target)
+            if g > dist[u]:
+                continue  # Stale entry
+            for k in range(ptr[u], ptr[u + 1]):
+                e = edge_ids[k]
+                v = head[k]
+                cost = g + costs[e]
+                if cost < dist.get(v, math.inf):
+                    dist[v] = cost
+                    parent[v] = u
+                    heapq.heappush(heap, (cost + heuristic(v, target), cost, v))
+        return None
+
+    def bidirectional_dijkstra(self, source, target):
+        """
+        Bidirectional Dijkstra search, alternating between a forward and a backward frontier.
+
+        :param source: Index of the start node.
+        :param target: Index of the destination node.
+        :return: int32 array of node indices from source to target, or None if unreachable.
+        """
+        if source == target:
+            return np.array([source], dtype=np.int32)
+        costs = self.traffic_network.edge_cost_cache.cost_list()
+        sides = (
+            (self.forward_ptr, self.forward_head, self.forward_edge, {source: 0.0}, {source: -1}, [(0.0, source)]),
+            (self.reverse_ptr, self.reverse_head, self.reverse_edge, {target: 0.0}, {target: -1}, [(0.0, target)]),
+        )
+        best, meeting = math.inf, None
+        side = 0
+        while sides[0][5] and sides[1][5]:
+            # The shortest path is found once the two frontiers can no longer improve on it
+            if sides[0][5][0][0] + sides[1][5][0][0] >= best:
+                break
+            ptr, head, edge_ids, dist, parent, heap = sides[side]
+            other_dist = sides[1 - side][3]
+            g, u = heapq.heappop(heap)
+            if g <= dist[u]:
+                for k in range(ptr[u], ptr[u + 1]):
+                    e = edge_ids[k]
+                    v = head[k]
+                    cost = g + costs[e]
+                    if cost < dist.get(v, math.inf):
+                        dist[v] = cost
+                        parent[v] = u
+                        heapq.heappush(heap, (cost, v))
+                    if v in other_dist and dist[v] + other_dist[v] < best:
+                        best, meeting = dist[v] + other_dist[v], v
+            side = 1 - side
+
+        if meeting is None:
+            return None
+        forward = self._path(sides[0][4], meeting)
+        backward = self._path(sides[1][4], meeting)[::-1]
+        return np.concatenate([forward, backward[1:]])
+
+    @staticmethod
+    def _path(parent, node):
+        path = []
+        while node != -1:
+            path.append(node)
+            node = parent[node]
+        return np.array(path[::-1], dtype=np.int32)
+
+    def route(self, start_node, destination_node, method='astar'):
+        """
+        Compute the best route between two nodes.
+
+        :param start_node: The start node id.
+        :param destination_node: The destination node id.
+        :param method: 'astar' or 'bidirectional'.
+        :return: int32 array of node indices including both ends, or None if unreachable.
+        """
+        started = time.perf_counter() if instruments.enabled else None
+        try:
+            source, target = self.edges.node_index([start_node, destination_node]).tolist()
+        except KeyError:
+            return None  # A node that isn't in the network can't be reached
+        if method == 'astar':
+            path = self.astar(source, target)
+        elif method == 'bidirectional':
+            path = self.bidirectional_dijkstra(source, target)
+        else:
+            raise ValueError(f"Unknown routing method: {method}")
+        if started is not None:
+            instruments.observe('routing.route', time.perf_counter() - started)
+            instruments.count('routing.route_calls')
+        return path
+
+    def route_cost(self, path):
+        """Returns the current cost of a route given as node indices."""
+        edges = self.edges.lookup_pairs(path[:-1], path[1:])
+        if (edges < 0).any():
+            return math.inf
+        return float(sum(self.edge_cost(e) for e in edges.tolist()))
+
+    def calculate_best_route(self, start_node, destination_node, traffic_network=None, method='astar'):
+        """
+        Compute a route in the form vehicles expect from the CTCU: the node ids after start_node.
+
+        :param start_node: The start node id.
+        :param destination_node: The destination node id.
+        :param traffic_network: Unused; the engine always routes over its own network.
+        :param method: 'astar' or 'bidirectional'.
+        :return: List of node ids, empty if the destination is unreachable.
+        """
+        path = self.route(start_node, destination_node, method)
+        if path is None:
+            return []
+        return self.edges.node_ids[path[1:]].tolist()
+
+    def calculate_best_routes(self, pairs, traffic_network=None):
+        """
+        Compute several routes at once, as a simulator does for the vehicles rerouted in a tick.
+
+        :param pairs: (start node, destination node) tuples.
+        :param traffic_network: Unused; the engine always routes over its own network.
+        :return: List of routes, each as returned by calculate_best_route.
+        """
+        return [self.calculate_best_route(start, destination, traffic_network) for start, destination in pairs]
@@ -0,0 +1,63 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArrays:
+    """
+    A set of NumPy arrays placed in shared memory, so worker processes can attach
+    to them by name instead of receiving pickled copies.
+
+    The creating process owns the memory and must call close(); workers attach with
+    SharedArrays.attach(spec) using the spec() of the owner.
+    """
+
+    def __init__(self, arrays=None):
+        self.arrays = {}
+        self._blocks = {}
+        self._owner = arrays is not None
+        for name, array in (arrays or {}).items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared[...] = array
+            self._blocks[name] = block
+            self.arrays[name] = shared
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def spec(self):
+        """Returns a small picklable description of the arrays for attach()."""
+        return {name: (self._blocks[name].name, array.shape, array.dtype.str)
+                for name, array in self.arrays.items()}
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        Attach to arrays created by another process. Worker processes started by the owner
+        share its resource tracker, so the memory is freed once, when the owner closes it.
+
+        :param spec: The result of spec() in the owning process.
+        """
+        shared = cls()
+        for name, (block_name, shape, dtype) in spec.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            shared._blocks[name] = block
+            shared.arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        return shared
+
+    def close(self):
+        """Release the arrays, freeing the shared memory if this process created it."""
+        self.arrays = {}
+        for block in self._blocks.values():
+            block.close()
+            if self._owner:
+                block.unlink()
+        self._blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
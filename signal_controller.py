@@ -0,0 +1,160 @@
+import csv
+import heapq
+import json
+import random
+
+
+class SignalController:
+    """
+    Keeps the phase of every signalized intersection and switches them on time.
+
+    Each signal has its own next-switch time, kept in a min-heap, so an update only
+    touches the signals that are due. Signals either run a fixed-cycle plan (one
+    duration per phase) or, like add_initial_signal_states, draw a random delay
+    after every switch.
+    """
+
+    def __init__(self, clock, signal_states=('green', 'red'), min_delay=35, max_delay=60):
+        self.clock = clock
+        self.signal_states = list(signal_states)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.state_index = {}  # node -> index into signal_states
+        self.delay = {}  # node -> duration of the current phase
+        self.next_switch = {}  # node -> time of the next switch
+        self.plans = {}  # node -> phase durations, for fixed-cycle signals
+        self.heap = []  # (next switch time, node); entries not matching next_switch are stale
+
+    def __len__(self):
+        return len(self.state_index)
+
+    def __contains__(self, node):
+        return node in self.state_index
+
+    def add_signal(self, node, state_index=0, delay=None, plan=None, start_time=None):
+        """
+        Add or replace the signal at a node.
+
+        :param node: The node the signal is at.
+        :param state_index: The index of the initial phase in signal_states.
+        :param delay: How long the initial phase lasts; defaults to the plan or a random delay.
+        :param plan: Optional sequence of phase durations, one per signal state, for a fixed cycle.
+        :param start_time: When the initial phase started; defaults to the current time.
+        """
+        if start_time is None:
+            start_time = self.clock.time()
+        if plan is not None:
+            self.plans[node] = list(plan)
+        else:
+            self.plans.pop(node, None)
+        if delay is None:
+            delay = self._phase_duration(node, state_index)
+        self.state_index[node] = state_index
+        self.delay[node] = delay
+        self._schedule(node, start_time + delay)
+
+    def remove_signal(self, node):
+        """Remove the signal at a node. Its heap entry is dropped lazily."""
+        self.state_index.pop(node, None)
+        self.delay.pop(node, None)
+        self.next_switch.pop(node, None)
+        self.plans.pop(node, None)
+
+    def state(self, node):
+        """Returns the current phase of the signal at a node, or None if the node has no signal."""
+        i = self.state_index.get(node)
+        return None if i is None else self.signal_states[i]
+
+    def next_switch_time(self):
+        """Returns the time of the next due switch, or None if there are no signals."""
+        heap = self.heap
+        while heap and self.next_switch.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def update(self, now=None):
+        """
+        Switch every signal that is due.
+
+        :param now: The current time; defaults to the clock's time.
+        :return: The list of nodes whose signal changed phase.
+        """
+        if now is None:
+            now = self.clock.time()
+        heap = self.heap
+        changed = []
+        while heap and heap[0][0] <= now:
+            switch_time, node = heapq.heappop(heap)
+            if self.next_switch.get(node) != switch_time:
+                continue  # Stale entry
+            i = (self.state_index[node] + 1) % len(self.signal_states)
+            delay = self._phase_duration(node, i)
+            self.state_index[node] = i
+            self.delay[node] = delay
+            self._schedule(node, switch_time + delay)
+            changed.append(node)
+        return changed
+
+    def load_plans(self, path, start_time=None, known_nodes=None):
+        """
+        Load fixed-cycle plans from a CSV or JSON file.
+
+        CSV files have a 'node' column, one duration column per signal state and an optional
+        'offset' column. JSON files hold a list of {"node", "phases": {state: duration}, "offset"}.
+        The offset is how far into the cycle the signal is at start_time.
+
+        :param path: The plan file.
+        :param start_time: The time the plans start; defaults to the current time.
+        :param known_nodes: Optional collection of the nodes signals may be placed at.
+        :return: The list of nodes that got a plan.
+        :raises ValueError: If a plan has a negative phase or a zero-length cycle, or is for an unknown node.
+        """
+        if start_time is None:
+            start_time = self.clock.time()
+        if path.endswith('.json'):
+            with open(path) as f:
+                rows = [dict(entry.get('phases', {}), node=entry['node'], offset=entry.get('offset', 0))
+                        for entry in json.load(f)]
+        else:
+            with open(path, newline='') as f:
+                rows = list(csv.DictReader(f))
+
+        # Check every plan before adding any, so a bad file leaves the signals untouched
+        plans = []
+        for row in rows:
+            node = row['node']
+            node = int(node) if isinstance(node, str) and node.lstrip('-').isdigit() else node
+            if known_nodes is not None and node not in known_nodes:
+                raise ValueError(f"Signal plan in {path} is for node {node}, which is not in the network")
+            plan = [float(row[state]) for state in self.signal_states]
+            if min(plan) < 0 or not sum(plan) > 0:
+                raise ValueError(f"Signal plan for node {node} in {path} needs non-negative phase durations "
+                                 f"and a cycle longer than zero, got {plan}")
+            plans.append((node, plan, float(row.get('offset') or 0)))
+
+        nodes = []
+        for node, plan, offset in plans:
+            i, remaining = self._position_in_cycle(plan, offset)
+            self.add_signal(node, i, delay=plan[i], plan=plan, start_time=start_time + remaining - plan[i])
+            nodes.append(node)
+        return nodes
+
+    def _phase_duration(self, node, i):
+        plan = self.plans.get(node)
+        if plan is not None:
+            return plan[i]
+        return random.randint(self.min_delay, self.max_delay)
+
+    def _schedule(self, node, switch_time):
+        self.next_switch[node] = switch_time
+        heapq.heappush(self.heap, (switch_time, node))
+
+    @staticmethod
+    def _position_in_cycle(plan, offset):
+        """Returns the phase index and the time left in it, offset seconds into the cycle."""
+        offset %= sum(plan)
+        for i, duration in enumerate(plan):
+            if offset < duration:
+                return i, duration - offset
+            offset -= duration
+        return 0, plan[0]
@@ -0,0 +1,271 @@
+import heapq
+import itertools
+import time
+
+from instrumentation import instruments
+
+# Event kinds handled by the SimulationEngine
+EDGE_ENTRY = 'edge_entry'
+EDGE_EXIT = 'edge_exit'
+SIGNAL_CHANGE = 'signal_change'
+REROUTE = 'reroute'
+
+
+class SimulationClock:
+    """A virtual clock that only moves when the simulation advances it."""
+
+    def __init__(self, start_time=0.0):
+        self.now = float(start_time)
+
+    def time(self):
+        """Returns the current simulated time in seconds."""
+        return self.now
+
+    def advance_to(self, t):
+        """Moves the clock forward to time t. The clock never moves backwards."""
+        if t > self.now:
+            self.now = float(t)
+
+    def sleep(self, seconds):
+        """Advances the clock by the given number of seconds without blocking."""
+        self.now += seconds
+
+    def set_time(self, t):
+        """Sets the clock to time t, also backwards, e.g. when restoring a checkpoint."""
+        self.now = float(t)
+
+
+class WallClock:
+    """A clock backed by real time, for running the network against the wall clock."""
+
+    def time(self):
+        return time.time()
+
+    def advance_to(self, t):
+        pass
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class SimulationEngine:
+    """
+    Discrete-event scheduler driving vehicles through a TrafficNetwork.
+
+    Events are kept in a priority queue ordered by simulated time. Processing an
+    event advances the network's clock to the event time, so a scenario runs as
+    fast as the events can be handled instead of in real time.
+    """
+
+    def __init__(self, traffic_network, ctc_unit):
+        self.traffic_network = traffic_network
+        self.ctc_unit = ctc_unit
+        self.clock = traffic_network.clock
+        self.queue = []
+        self.vehicles = {}  # Vehicles currently driven by the engine, by ID
+        self.events_processed = 0
+        self._sequence = itertools.count()  # Keeps events at the same time in FIFO order
+        self._signals_scheduled = False
+        self.handlers = {
+            EDGE_ENTRY: self._on_edge_entry,
+            EDGE_EXIT: self._on_edge_exit,
+            SIGNAL_CHANGE: self._on_signal_change,
+            REROUTE: self._on_reroute,
+        }
+        traffic_network.add_edge_listener(self._on_edge_change)
+
+    def schedule(self, event_time, kind, vehicle=None, data=None):
+        """
+        Schedule an event.
+
+        :param event_time: The simulated time at which the event fires.
+        :param kind: One of EDGE_ENTRY, EDGE_EXIT, SIGNAL_CHANGE or REROUTE.
+        :param vehicle: The vehicle the event applies to, if any.
+        :param data: Optional extra data passed to the handler.
+        """
+        heapq.heappush(self.queue, (event_time, next(self._sequence), kind, vehicle, data))
+
+    def add_handler(self, kind, handler):
+        """
+        Register a handler for a new kind of event, called as handler(vehicle, data).
+
+        :param kind: The event kind, used with schedule().
+        :param handler: The callable handling events of this kind.
+        """
+        self.handlers[kind] = handler
+
+    def add_vehicle(self, vehicle, departure_time=None):
+        """
+        Add a vehicle that enters the network at the given simulated time.
+
+        :param vehicle: The vehicle instance.
+        :param departure_time: When the vehicle departs; defaults to the current simulated time.
+        """
+        if departure_time is None:
+            departure_time = self.clock.time()
+        self.schedule(departure_time, EDGE_ENTRY, vehicle)
+
+    def pending_events(self):
+        """Returns the queued events as (time, kind, vehicle, data) tuples in processing order."""
+        return [(event_time, kind, vehicle, data) for event_time, _, kind, vehicle, data in sorted(
+            self.queue, key=lambda event: event[:2])]
+
+    def load_events(self, events, vehicles):
+        """
+        Replace the event queue and the vehicles on the network, e.g. when restoring a checkpoint.
+
+        :param events: (time, kind, vehicle, data) tuples in processing order, as from pending_events.
+        :param vehicles: The vehicles currently driven by the engine.
+        """
+        self.queue = [(event_time, i, kind, vehicle, data) for i, (event_time, kind, vehicle, data) in enumerate(events)]
+        heapq.heapify(self.queue)
+        self._sequence = itertools.count(len(self.queue))
+        self._signals_scheduled = any(kind == SIGNAL_CHANGE for _, kind, _, _ in events)
+        self.vehicles = {vehicle.vehicle_id: vehicle for vehicle in vehicles}
+
+    def run(self, until=None, max_events=None):
+        """
+        Process events in time order.
+
+        :param until: Stop before events later than this simulated time, and advance the clock to it.
+        :param max_events: Stop after processing this many events.
+        :return: The number of events processed.
+        """
+        if not self._signals_scheduled:
+            self._schedule_signal_change()
+            self._signals_scheduled = True
+
+        started = time.perf_counter() if instruments.enabled else None
+        processed = 0
+        queue = self.queue
+        while queue and (until is None or queue[0][0] <= until):
+            if max_events is not None and processed >= max_events:
+                break
+            event_time, _, kind, vehicle, data = heapq.heappop(queue)
+            self.clock.advance_to(event_time)
+            self.handlers[kind](vehicle, data)
+            processed += 1
+
+        if until is not None and (max_events is None or processed < max_events):
+            self.clock.advance_to(until)
+        self.events_processed += processed
+        if started is not None:
+            instruments.observe('engine.run', time.perf_counter() - started)
+            instruments.count('engine.events', processed)
+        return processed
+
+    def enter_vehicle(self, vehicle):
+        """Put a vehicle on the network at the current simulated time, as its EDGE_ENTRY event would."""
+        self._on_edge_entry(vehicle, None)
+
+    def _on_edge_entry(self, vehicle, data):
+        """The vehicle starts traversing the edge towards its next position."""
+        network = self.traffic_network
+        link_model = network.link_model
+        now = self.clock.time()
+
+        # A retry scheduled for a vehicle held back by a full edge is stale once it was released
+        blocked_since = data.get('blocked_since') if data is not None else None
+        if blocked_since is not None and link_model.blocked_since(vehicle.vehicle_id) != blocked_since:
+            return
+
+        if vehicle.vehicle_id not in self.vehicles:
+            self.vehicles[vehicle.vehicle_id] = vehicle
+            vehicle.enter_network(network, self.ctc_unit)
+
+        if vehicle.state != 'moving' or vehicle.next_position is None:
+            if vehicle.current_position == vehicle.destination:
+                vehicle.arrive(network)
+            else:
+                # Without a route the vehicle goes no further; don't leave it counted on an edge
+                network.remove_vehicle(vehicle.vehicle_id, vehicle.current_position)
+            self.vehicles.pop(vehicle.vehicle_id, None)
+            return
+
+        # A full edge holds the vehicle back on the edge it is on, so queues spill back upstream. It goes
+        # when a vehicle leaves the full edge, or after max_wait regardless to break gridlock.
+        i = network.edges.lookup((vehicle.current_position, vehicle.next_position))
+        if blocked_since is None and i is not None and not link_model.has_room(i, vehicle.vehicle_id):
+            since = link_model.block(vehicle.vehicle_id, i, data)
+            self.schedule(since + link_model.max_wait, EDGE_ENTRY, vehicle, dict(data or {}, blocked_since=since))
+            if instruments.enabled:
+                instruments.count('engine.blocked')
+            return
+
+        network.update_traffic_density(vehicle.current_position, vehicle.next_position, vehicle.vehicle_id)
+
+        # Congestion on the edge being entered triggers a reroute, unless the vehicle was just rerouted
+        check_congestion = data is None or data.get('check_congestion', True)
+        if check_congestion:
+            traffic_density = network.edge_info.get((vehicle.current_position, vehicle.next_position), {}).get('traffic_density', 0)
+            if traffic_density > self.ctc_unit.threshold_density:
+                self.schedule(now, REROUTE, vehicle)
+                return
+
+        delays = vehicle.edge_delays(vehicle.next_position, network)
+        traversal_time = sum(delays) if delays is not None else 0.0
+        # Vehicles leave in the order they entered, no faster than the edge's outflow capacity
+        exit_time = link_model.exit_time(vehicle.vehicle_id, i, traversal_time) if i is not None else now + traversal_time
+        self.schedule(exit_time, EDGE_EXIT, vehicle)
+
+    def _on_edge_exit(self, vehicle, data):
+        """The vehicle reaches the end of its current edge."""
+        vehicle.current_position = vehicle.next_position
+        if vehicle.current_position != vehicle.destination and vehicle.route_length:
+            vehicle.next_position = vehicle.advance_route()
+            self.schedule(self.clock.time(), EDGE_ENTRY, vehicle)
+        else:
+            vehicle.arrive(self.traffic_network)
+            self.vehicles.pop(vehicle.vehicle_id, None)
+
+    def _on_edge_change(self, vehicle_id, left_edge, entered_edge):
+        """Edge listener: a vehicle leaving an edge makes room for the first vehicle waiting for it."""
+        if left_edge is None:
+            return
+        released = self.traffic_network.link_model.release(left_edge)
+        if released is not None:
+            released_id, data = released
+            vehicle = self.vehicles.get(released_id)
+            if vehicle is not None:
+                self.schedule(self.clock.time(), EDGE_ENTRY, vehicle, data)
+
+    def _on_reroute(self, vehicle, data):
+        """
+        The vehicle asks the CTCU for a new route from its current position. Reroutes queued right
+        behind it for the same time are taken along, so the CTCU gets them as one batch.
+        """
+        now = self.clock.time()
+        vehicles = [vehicle]
+        queue = self.queue
+        while queue and queue[0][0] == now and queue[0][2] == REROUTE:
+            vehicles.append(heapq.heappop(queue)[3])
+        self.events_processed += len(vehicles) - 1
+
+        pairs = [(v.current_position, v.destination) for v in vehicles]
+        batch = getattr(self.ctc_unit, 'calculate_best_routes', None)
+        if batch is not None:
+            new_routes = batch(pairs, self.traffic_network)
+        else:
+            # A CTCU that only offers calculate_best_route
+            new_routes = [self.ctc_unit.calculate_best_route(start, destination, self.traffic_network)
+                          for start, destination in pairs]
+        for v, new_route in zip(vehicles, new_routes):
+            if new_route:
+                v.set_route(new_route, self.traffic_network)
+                v.next_position = v.advance_route()
+            # Keep driving, on the original route if no new one was found
+            self.schedule(now, EDGE_ENTRY, v, {'check_congestion': False})
+
+    def _on_signal_change(self, vehicle, data):
+        """A signal phase is due to change."""
+        self.traffic_network.update_signal_states()
+        # Stop cycling the signals once nothing else is left to simulate
+        if self.queue or self.vehicles:
+            self._schedule_signal_change()
+        else:
+            self._signals_scheduled = False
+
+    def _schedule_signal_change(self):
+        next_change = self.traffic_network.next_signal_change()
+        if next_change is not None:
+            self.schedule(max(next_change, self.clock.time()), SIGNAL_CHANGE)
@@ -1,26 +1,98 @@
-import osmnx as ox
+import os
+
+from graph_snapshot import graph_to_arrays, load_snapshot, normalize_maxspeed, save_snapshot, snapshot_key, SnapshotGraph
+from instrumentation import DEBUG, instruments
+from region_loader import load_region
 
 class GraphGenerator:
-    def __init__(self, bbox, network_type='drive', default_maxspeed=50):
+    def __init__(self, bbox, network_type='drive', default_maxspeed=50, snapshot_dir='snapshots'):
         self.bbox = bbox
         self.network_type = network_type
         self.default_maxspeed = default_maxspeed
+        self.snapshot_dir = snapshot_dir
         self.graph = None
 
     def generate_graph(self):
         """Generates the graph using OSMnx for the specified bounding box."""
+        # Imported here so that loading snapshots doesn't need OSMnx installed
+        import osmnx as ox
+
         self.graph = ox.graph_from_bbox(*self.bbox, network_type=self.network_type)
         self._set_default_maxspeed()
         return self.graph
 
+    def snapshot_path(self):
+        """Returns the directory of the snapshot for this bbox, network type and default maxspeed."""
+        return os.path.join(self.snapshot_dir, snapshot_key(self.bbox, self.network_type, self.default_maxspeed))
+
+    def load_graph(self):
+        """
+        Loads the graph from its compiled snapshot, generating and saving the snapshot on the first run.
+        The returned SnapshotGraph is memory-mapped and can be passed to TrafficNetwork directly.
+        """
+        if self.snapshot_dir is None:
+            return self.generate_graph()
+
+        path = self.snapshot_path()
+        snapshot = load_snapshot(path)
+        if snapshot is None:
+            arrays = graph_to_arrays(self.generate_graph(), self.default_maxspeed)
+            save_snapshot(path, arrays, meta={
+                'bbox': list(self.bbox),
+                'network_type': self.network_type,
+                'default_maxspeed': self.default_maxspeed,
+            })
+            snapshot = load_snapshot(path) or SnapshotGraph(arrays)
+        self.graph = snapshot
+        return self.graph
+
+    def load_tiled_graph(self, tile_size=0.05, processes=None, cache_dir='cache'):
+        """
+        Loads the graph of a large bbox by building it tile by tile from the OSMnx response cache
+        (see region_loader.load_region), snapshotting it like load_graph.
+
+        :param tile_size: Tile side in degrees.
+        :param processes: Number of worker processes building tiles.
+        :param cache_dir: The OSMnx response cache directory.
+        :return: A memory-mapped SnapshotGraph, or one over the built arrays without a snapshot_dir.
+        """
+        if self.snapshot_dir is None:
+            self.graph = SnapshotGraph(load_region(self.bbox, cache_dir, tile_size, processes, self.network_type,
+                                                   self.default_maxspeed))
+            return self.graph
+
+        path = self.snapshot_path() + '-tiled'
+        snapshot = load_snapshot(path)
+        if snapshot is None:
+            arrays = load_region(self.bbox, cache_dir, tile_size, processes, self.network_type, self.default_maxspeed)
+            save_snapshot(path, arrays, meta={
+                'bbox': list(self.bbox),
+                'network_type': self.network_type,
+                'default_maxspeed': self.default_maxspeed,
+                'tile_size': tile_size,
+            })
+            snapshot = load_snapshot(path) or SnapshotGraph(arrays)
+        self.graph = snapshot
+        return self.graph
+
     def _set_default_maxspeed(self):
-        """Sets a default maxspeed for edges where it's missing."""
-        for u, v, key, data in self.graph.edges(keys=True, data=True):
-            if data.get('maxspeed') is None:
-                data['maxspeed'] = self.default_maxspeed
-                print(f"Set default maxspeed for edge from {u} to {v}: {data['maxspeed']} km/h")
+        """
+        Replaces every edge's maxspeed with a number in km/h (see normalize_maxspeed),
+        using the default maxspeed where it's missing or can't be parsed.
+        """
+        edges = list(self.graph.edges(keys=True, data=True))
+        speeds = normalize_maxspeed([data.get('maxspeed') for _, _, _, data in edges], self.default_maxspeed)
+        for (u, v, key, data), speed in zip(edges, speeds.tolist()):
+            missing = data.get('maxspeed') is None
+            data['maxspeed'] = speed
+            if missing:
+                if instruments.enabled:
+                    instruments.count('map.default_maxspeed')
+                if instruments.trace_level <= DEBUG:
+                    instruments.event(DEBUG, 'default_maxspeed', None, u, v, self.default_maxspeed)
 
 # Example usage:
 # bbox = (43.4680, 43.4760, -80.5350, -80.5200)
 # generator = GraphGenerator(bbox)
-# graph = generator.generate_graph()
\ No newline at end of file
+# graph = generator.generate_graph()
+# graph = generator.load_graph()  # Opens the memory-mapped snapshot on later runs
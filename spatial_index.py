@@ -0,0 +1,181 @@
+import math
+
+import numpy as np
+
+EARTH_RADIUS = 6371008.8  # Mean earth radius in meters
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Great-circle distance in meters between points given in degrees. Works on scalars and NumPy arrays.
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class SpatialIndex:
+    """
+    Uniform grid over node positions for batched nearest-node and radius queries.
+
+    Coordinates are projected to meters on an equirectangular projection centered on
+    the network, which is accurate to well under a meter across a city. Nodes are
+    bucketed into square cells of about two nodes each and stored cell by cell, so a
+    query only looks at the cells around it. All queries take NumPy arrays and are
+    vectorized over the query points.
+    """
+
+    def __init__(self, node_x, node_y, nodes_per_cell=2.0):
+        """
+        :param node_x: Node longitudes in degrees; NaN for nodes without a position.
+        :param node_y: Node latitudes in degrees; NaN for nodes without a position.
+        :param nodes_per_cell: Average number of nodes per grid cell.
+        """
+        self.node_x = np.asarray(node_x, dtype=np.float64)
+        self.node_y = np.asarray(node_y, dtype=np.float64)
+        placed = np.flatnonzero(~(np.isnan(self.node_x) | np.isnan(self.node_y)))
+        self.lon0 = float(self.node_x[placed].mean()) if placed.size else 0.0
+        self.lat0 = float(self.node_y[placed].mean()) if placed.size else 0.0
+        self.scale = math.cos(math.radians(self.lat0))
+
+        px, py = self.project(self.node_x[placed], self.node_y[placed])
+        self.min_x = float(px.min()) if placed.size else 0.0
+        self.min_y = float(py.min()) if placed.size else 0.0
+        width = float(px.max()) - self.min_x if placed.size else 0.0
+        height = float(py.max()) - self.min_y if placed.size else 0.0
+        area = max(width * height, 1.0)
+        self.cell_size = max(math.sqrt(area * nodes_per_cell / max(placed.size, 1)), 1e-3)
+        self.cols = int(width // self.cell_size) + 1
+        self.rows = int(height // self.cell_size) + 1
+
+        # Nodes sorted by cell, with cell_start[c]:cell_start[c + 1] covering cell c
+        cells = self._cell(px, py)
+        order = np.argsort(cells, kind='stable')
+        self.nodes = placed[order]
+        self.px = px[order]
+        self.py = py[order]
+        self.cell_start = np.zeros(self.rows * self.cols + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=self.rows * self.cols), out=self.cell_start[1:])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def project(self, x, y):
+        """Project longitudes and latitudes to meters around the index's center."""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        return (np.radians(x - self.lon0) * EARTH_RADIUS * self.scale,
+                np.radians(y - self.lat0) * EARTH_RADIUS)
+
+    def _cell_coords(self, px, py):
+        return (np.floor((px - self.min_x) / self.cell_size).astype(np.int64),
+                np.floor((py - self.min_y) / self.cell_size).astype(np.int64))
+
+    def _cell(self, px, py):
+        cx, cy = self._cell_coords(px, py)
+        return np.clip(cy, 0, self.rows - 1) * self.cols + np.clip(cx, 0, self.cols - 1)
+
+    def _gather(self, queries, cx, cy):
+        """
+        Candidate nodes in the given cells.
+
+        :return: (query of each candidate, position of the candidate in the cell-sorted arrays).
+        """
+        inside = (cx >= 0) & (cx < self.cols) & (cy >= 0) & (cy < self.rows)
+        queries, cells = queries[inside], cy[inside] * self.cols + cx[inside]
+        starts = self.cell_start[cells]
+        counts = self.cell_start[cells + 1] - starts
+        total = int(counts.sum())
+        if not total:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        owner = np.repeat(queries, counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        return owner, np.repeat(starts, counts) + offsets
+
+    @staticmethod
+    def _ring(r):
+        """Cell offsets at Chebyshev distance r."""
+        if r == 0:
+            return np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+        side = np.arange(-r, r + 1)
+        inner = np.arange(-r + 1, r)
+        dx = np.concatenate([side, side, np.full(len(inner), -r), np.full(len(inner), r)])
+        dy = np.concatenate([np.full(len(side), -r), np.full(len(side), r), inner, inner])
+        return dx, dy
+
+    def nearest(self, x, y):
+        """
+        Find the nearest node to each point.
+
+        Cells are searched in rings around each query until the nearest candidate found
+        is closer than anything the next ring could hold.
+
+        :param x: Longitudes of the query points.
+        :param y: Latitudes of the query points.
+        :return: (int64 node indices, float64 projected distances in meters); -1 and inf if the index is empty.
+        """
+        qx, qy = self.project(np.atleast_1d(x), np.atleast_1d(y))
+        n = len(qx)
+        best = np.full(n, -1, dtype=np.int64)
+        best_dist = np.full(n, np.inf)
+        if not len(self.nodes) or not n:
+            return best, best_dist
+
+        cx, cy = self._cell_coords(qx, qy)
+        # Points outside the grid start at the first ring that reaches it
+        ring = np.maximum(np.maximum(-cx, cx - (self.cols - 1)), np.maximum(-cy, cy - (self.rows - 1)))
+        ring = np.maximum(ring, 0)
+        active = np.arange(n)
+        while active.size:
+            for r in np.unique(ring[active]).tolist():
+                group = active[ring[active] == r]
+                dx, dy = self._ring(r)
+                queries = np.repeat(group, len(dx))
+                owner, candidates = self._gather(queries, np.repeat(cx[group], len(dx)) + np.tile(dx, len(group)),
+                                                 np.repeat(cy[group], len(dy)) + np.tile(dy, len(group)))
+                if owner.size:
+                    # Candidates come grouped by query, so each query's closest is a segment minimum
+                    d = np.hypot(self.px[candidates] - qx[owner], self.py[candidates] - qy[owner])
+                    first = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+                    closest = np.minimum.reduceat(d, first)
+                    winners = owner[first]
+                    lengths = np.diff(np.r_[first, len(d)])
+                    hit = d == np.repeat(closest, lengths)
+                    pick = np.maximum.reduceat(np.where(hit, np.arange(len(d)), -1), first)
+                    better = closest < best_dist[winners]
+                    best_dist[winners[better]] = closest[better]
+                    best[winners[better]] = candidates[pick[better]]
+            # A query is settled once no node in the next ring can be closer than its best
+            settled = best_dist[active] <= ring[active] * self.cell_size
+            ring[active] += 1
+            active = active[~settled]
+        return np.where(best >= 0, self.nodes[np.maximum(best, 0)], -1), best_dist
+
+    def within(self, x, y, radius):
+        """
+        Find all nodes within a radius of each point.
+
+        :param x: Longitudes of the query points.
+        :param y: Latitudes of the query points.
+        :param radius: The radius in meters.
+        :return: (ptr, node indices): the nodes near point i are indices[ptr[i]:ptr[i + 1]].
+        """
+        qx, qy = self.project(np.atleast_1d(x), np.atleast_1d(y))
+        n = len(qx)
+        reach = int(math.ceil(radius / self.cell_size))
+        dx, dy = np.meshgrid(np.arange(-reach, reach + 1), np.arange(-reach, reach + 1))
+        dx, dy = dx.ravel(), dy.ravel()
+        cx, cy = self._cell_coords(qx, qy)
+        owner, candidates = self._gather(np.repeat(np.arange(n), len(dx)),
+                                         np.repeat(cx, len(dx)) + np.tile(dx, n),
+                                         np.repeat(cy, len(dy)) + np.tile(dy, n))
+        near = np.hypot(self.px[candidates] - qx[owner], self.py[candidates] - qy[owner]) <= radius
+        owner, candidates = owner[near], candidates[near]
+        order = np.argsort(owner, kind='stable')
+        ptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(owner, minlength=n), out=ptr[1:])
+        return ptr, self.nodes[candidates[order]]
+
+    def distance(self, i, j):
+        """Great-circle distance in meters between node index arrays i and j."""
+        return haversine(self.node_x[i], self.node_y[i], self.node_x[j], self.node_y[j])
@@ -1,20 +1,42 @@
 import random
-import time
+
+import numpy as np
+
+from edge_costs import EdgeCostCache
+from edge_store import EdgeInfoView, EdgeStore
+from instrumentation import DEBUG, INFO, instruments
+from link_model import LinkModel
+from signal_controller import SignalController
+from simulation_engine import SimulationClock
+from spatial_index import EARTH_RADIUS, SpatialIndex, haversine
+from vehicles import RouteTable
+
 
 class TrafficNetwork:
-    def __init__(self, graph, default_maxspeed=50):
+    def __init__(self, graph, default_maxspeed=50, clock=None):
         self.graph = graph
+        self.clock = clock if clock is not None else SimulationClock()
         self.default_maxspeed = default_maxspeed
         self.node_info = {}
+        self.edges = None
         self.edge_info = {}
+        self.edge_cost_cache = None
+        self.link_model = None
+        self.edge_listeners = []  # Callbacks for vehicles moving between edges
+        self.node_x = None  # Node longitudes, aligned with edges.node_ids
+        self.node_y = None  # Node latitudes, aligned with edges.node_ids
+        self.spatial_index = None
         self.signal_states = ['green', 'red']
-        self.start_time = time.time()
+        self.signals = SignalController(self.clock, self.signal_states)
+        self.start_time = self.clock.time()
         self._initialize_network()
 
     def _initialize_network(self):
         """Initializes the network by populating node and edge information."""
         self._populate_node_info()
         self._populate_edge_info()
+        self._populate_node_positions()
+        self.spatial_index = SpatialIndex(self.node_x, self.node_y)
 
     def _populate_node_info(self):
         """Populates the node information dictionary with initial data."""
@@ -28,63 +50,105 @@ class TrafficNetwork:
             }
 
     def _populate_edge_info(self):
-        """Populates the edge information dictionary."""
-        for u, v, key, data in self.graph.edges(keys=True, data=True):
-            if data.get('maxspeed') is None:
-                data['maxspeed'] = self.default_maxspeed
-
-            self.edge_info[(u, v, key)] = {
-                'start_node': u,
-                'end_node': v,
-                'length': data.get('length', None),
-                'maxspeed': data['maxspeed'],
-                'traffic_density': 0,
-                'vehicles_on_edge': [],  # Track vehicles on this edge
-                'arrival_times': {}  # Track the arrival time of each vehicle on this edge
-            }
+        """Populates the edge store and the edge information view on top of it."""
+        self.edges = EdgeStore.from_graph(self.graph, self.default_maxspeed)
+        self.edge_info = EdgeInfoView(self.edges)
+        self.route_table = RouteTable(self.edges.node_ids)
+        self.edge_cost_cache = EdgeCostCache(self.edges)
+        self.add_edge_listener(self.edge_cost_cache.on_edge_change)
+        self.link_model = LinkModel(self)
+
+    def _populate_node_positions(self):
+        """Populates the node coordinate arrays, in the same order as the edge store's node ids."""
+        if hasattr(self.graph, 'x') and hasattr(self.graph, 'y'):
+            self.node_x, self.node_y = self.graph.x, self.graph.y
+            return
+        positions = [self.node_info[node]['position'] for node in self.edges.node_ids.tolist()]
+        xy = np.array([(np.nan if x is None else x, np.nan if y is None else y) for x, y in positions],
+                      dtype=np.float64).reshape(-1, 2)
+        self.node_x, self.node_y = xy[:, 0], xy[:, 1]
+
+    def add_edge_listener(self, listener):
+        """
+        Register a callback for vehicles moving between edges, called as
+        listener(vehicle_id, left_edge, entered_edge) with edge store indices or None.
+        """
+        self.edge_listeners.append(listener)
+
+    def _enter_edge(self, vehicle_id, i, arrival_time=None):
+        """Put a vehicle on edge i (or take it off the network if i is None) and notify the listeners."""
+        if i is None:
+            left = self.edges.leave(vehicle_id)
+        else:
+            left = self.edges.enter(vehicle_id, i, arrival_time)
+        if left is not None or i is not None:
+            if instruments.enabled:
+                instruments.count('network.density_updates')
+            for listener in self.edge_listeners:
+                listener(vehicle_id, left, i)
+        return left
 
     def add_vehicle(self, vehicle_id, start_position):
         """Add a vehicle to the traffic network at the specified start position."""
-        for edge_key, edge_data in self.edge_info.items():
-            if edge_data['start_node'] == start_position:
-                self.edge_info[edge_key]['vehicles_on_edge'].append(vehicle_id)
-                self.edge_info[edge_key]['traffic_density'] += 1
-                print(f"Vehicle {vehicle_id} added to edge starting at {start_position}.")
-                return
+        i = self.edges.first_out.get(start_position)
+        if i is not None:
+            self._enter_edge(vehicle_id, i)
+            if instruments.trace_level <= DEBUG:
+                instruments.event(DEBUG, 'vehicle_added', vehicle_id, start_position, i)
 
     def remove_vehicle(self, vehicle_id, current_position):
         """Remove a vehicle from the traffic network at its current position."""
-        for edge_key, edge_data in self.edge_info.items():
-            if vehicle_id in edge_data['vehicles_on_edge']:
-                self.edge_info[edge_key]['vehicles_on_edge'].remove(vehicle_id)
-                self.edge_info[edge_key]['traffic_density'] -= 1
-                self.edge_info[edge_key]['arrival_times'].pop(vehicle_id, None)
-                print(f"Vehicle {vehicle_id} removed from edge starting at {current_position}.")
-                return
+        left = self._enter_edge(vehicle_id, None)
+        if left is not None and instruments.trace_level <= DEBUG:
+            instruments.event(DEBUG, 'vehicle_removed', vehicle_id, current_position, left)
 
     def update_traffic_density(self, current_position, next_position, vehicle_id):
-        """Update traffic density on the edge from current_position to next_position."""
-        current_edge = (current_position, next_position)
+        """Move a vehicle off the edge it is on and onto the edge from current_position to next_position."""
+        next_edge = self.edges.lookup((current_position, next_position))
 
         # Record the arrival time of the vehicle on the edge it's moving to
-        arrival_time = time.time()
-        
-        if current_edge in self.edge_info:
-            if vehicle_id in self.edge_info[current_edge]['vehicles_on_edge']:
-                self.edge_info[current_edge]['vehicles_on_edge'].remove(vehicle_id)
-                self.edge_info[current_edge]['traffic_density'] -= 1
-                self.edge_info[current_edge]['arrival_times'].pop(vehicle_id, None)
-        
-        next_edge = (current_position, next_position)
-        if next_edge in self.edge_info:
-            self.edge_info[next_edge]['vehicles_on_edge'].append(vehicle_id)
-            self.edge_info[next_edge]['traffic_density'] += 1
-            self.edge_info[next_edge]['arrival_times'][vehicle_id] = arrival_time
+        arrival_time = self.clock.time()
+
+        self._enter_edge(vehicle_id, next_edge, arrival_time)
 
     def get_neighbors(self, node):
         """Get neighbors of the given node."""
         return list(self.graph.neighbors(node))
 
+    def get_distance(self, node, other_node):
+        """
+        Straight-line (great-circle) distance in meters between two nodes.
+
+        :param node: The first node.
+        :param other_node: The second node.
+        :return: The distance, or infinity if either node has no position or isn't in the network.
+        """
+        try:
+            i, j = self.edges.node_index([node, other_node])
+        except KeyError:
+            return float('inf')
+        distance = float(self.spatial_index.distance(i, j))
+        return distance if distance == distance else float('inf')
+
+    def nearest_nodes(self, x, y, return_dist=False):
+        """
+        Find the nearest graph node to each point, like osmnx.distance.nearest_nodes.
+
+        :param x: Longitudes, a scalar or array.
+        :param y: Latitudes, a scalar or array.
+        :param return_dist: Whether to also return the great-circle distances in meters.
+        :return: Node ids (and distances), scalars if x and y are scalars.
+        """
+        scalar = np.isscalar(x)
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        indices, _ = self.spatial_index.nearest(x, y)
+        nodes = self.edges.node_ids[indices]
+        dist = haversine(x, y, self.node_x[indices], self.node_y[indices])
+        if scalar:
+            nodes, dist = nodes[0].item(), float(dist[0])
+        return (nodes, dist) if return_dist else nodes
+
     def get_traffic_time(self, current_node, next_node):
         """
         Calculate the travel time on the edge between the given nodes, taking into account traffic density,
@@ -95,89 +159,99 @@ class TrafficNetwork:
         :return: The estimated travel time between the two nodes.
         """
         edge = (current_node, next_node, 0)  # Assuming a single edge between nodes
-        if edge in self.edge_info:
-            traffic_density = self.edge_info[edge]['traffic_density']
-            max_speed = self.edge_info[edge]['maxspeed']
-            road_length = self.edge_info[edge]['length']
-            
-            # Base time to travel the edge at max speed without traffic
-            base_time = road_length / max_speed
-            
-            # Additional delay factor based on traffic density
-            delay_factor = 1 + (traffic_density * 0.01)  # Example: 1% extra time per vehicle
-            
-            # Calculate the total estimated travel time
-            travel_time = base_time * delay_factor
-            return travel_time
+        i = self.edges.lookup(edge)
+        if i is not None:
+            return self.edge_travel_time(i)
         
         # If the edge is not found, return a large time to discourage using this path
         return float('inf')
 
+    def edge_travel_time(self, i):
+        """
+        Calculate the travel time on the edge with the given index in the edge store,
+        using the edge cost cache's volume-delay function.
+
+        :param i: The index of the edge.
+        :return: The estimated travel time on the edge.
+        """
+        return self.edge_cost_cache.cost(i)
+
+    def edge_costs(self, indices=None):
+        """
+        Returns edge travel times as a new array, as get_traffic_time computes them.
+
+        :param indices: Optional array of edge indices; defaults to every edge in the edge store.
+        """
+        costs = self.edge_cost_cache.values()
+        return costs.copy() if indices is None else costs[indices]
+
+    def set_delay_function(self, delay_function, capacity=None):
+        """
+        Use another volume-delay function for edge travel times (see edge_costs.py).
+
+        :param delay_function: A callable delay(base_time, density, capacity), e.g. BPRDelay().
+        :param capacity: Optional per-edge capacity array.
+        """
+        self.edge_cost_cache.set_delay_function(delay_function, capacity)
+
     def should_yield(self, vehicle_id, other_vehicle_id, current_edge):
         """
-        Determine if a vehicle should yield to another on a shared edge based on arrival times.
+        Determine if a vehicle should yield to another on a shared edge, i.e. whether the other
+        vehicle is ahead of it in the edge's queue.
 
         :param vehicle_id: The ID of the current vehicle.
         :param other_vehicle_id: The ID of the other vehicle on the shared edge.
         :param current_edge: The edge where the decision is being made.
         :return: True if the current vehicle should yield, False otherwise.
         """
-        arrival_times = self.edge_info[current_edge]['arrival_times']
-        
-        if vehicle_id in arrival_times and other_vehicle_id in arrival_times:
-            return arrival_times[vehicle_id] > arrival_times[other_vehicle_id]
-        return False  # Default to not yielding if arrival times are not available
+        i = self.edges.lookup(current_edge)
+        if i is None or self.edges.vehicle_edge.get(vehicle_id) != i:
+            return False  # Default to not yielding if the vehicles aren't both queued on the edge
+        return self.link_model.is_ahead(other_vehicle_id, vehicle_id) is True
 
     def update_shared_edge(self, vehicle_id, other_vehicle_id, current_edge):
         """
-        Update the traffic network to manage shared edge scenarios where two vehicles are on the same edge.
-        This function will manage the interaction between vehicles, adjusting speeds, managing priorities,
-        and ensuring safe passage based on arrival times and other factors.
+        Manage two vehicles on the same edge: the one further back in the edge's queue slows down.
 
         :param vehicle_id: The ID of the current vehicle.
         :param other_vehicle_id: The ID of the other vehicle on the shared edge.
         :param current_edge: The edge where the vehicles are sharing space.
         """
-        # Retrieve the arrival times of both vehicles
-        arrival_times = self.edge_info[current_edge]['arrival_times']
-        
-        # Determine which vehicle arrived first
-        if arrival_times[vehicle_id] < arrival_times[other_vehicle_id]:
-            first_vehicle_id = vehicle_id
-            second_vehicle_id = other_vehicle_id
+        if self.should_yield(vehicle_id, other_vehicle_id, current_edge):
+            first_vehicle_id, second_vehicle_id = other_vehicle_id, vehicle_id
+        elif self.should_yield(other_vehicle_id, vehicle_id, current_edge):
+            first_vehicle_id, second_vehicle_id = vehicle_id, other_vehicle_id
         else:
-            first_vehicle_id = other_vehicle_id
-            second_vehicle_id = vehicle_id
+            return  # Not both on the edge
 
-        print(f"Vehicle {first_vehicle_id} arrived first on edge {current_edge}. Managing shared edge scenario.")
+        if instruments.trace_level <= DEBUG:
+            instruments.event(DEBUG, 'shared_edge', second_vehicle_id, self.edges.lookup(current_edge),
+                              first_vehicle_id)
 
-        # Speed adjustment: Give the first vehicle priority, and adjust the speed of the second vehicle
-        speed_adjustment_factor = 0.8  # Example: The second vehicle reduces speed to 80% of its original speed
+        # The second vehicle reduces speed to 80% of its original speed for its traversal
+        speed_adjustment_factor = 0.8
         self._adjust_speed(second_vehicle_id, current_edge, speed_adjustment_factor)
 
-        # Optionally, you could add logic to further manage priorities or determine right-of-way
-        # This could involve stopping one vehicle temporarily or other forms of coordination
-
-        # Log the shared edge scenario
-        print(f"Vehicle {first_vehicle_id} has priority on edge {current_edge}. "
-              f"Vehicle {second_vehicle_id} speed adjusted.")
-
     def _adjust_speed(self, vehicle_id, current_edge, adjustment_factor):
         """
-        Adjust the speed of the specified vehicle on the given edge.
+        Adjust the speed of the specified vehicle on the given edge. The link model applies it
+        when the vehicle's exit from the edge is scheduled.
 
         :param vehicle_id: The ID of the vehicle whose speed is being adjusted.
         :param current_edge: The edge where the speed adjustment is being applied.
         :param adjustment_factor: The factor by which to adjust the vehicle's speed (e.g., 0.8 for 80%).
+        :return: The adjusted speed, or None if the vehicle isn't on the edge.
         """
-        # Find the vehicle's original speed
-        for edge_key, edge_data in self.edge_info.items():
-            if edge_key == current_edge and vehicle_id in edge_data['vehicles_on_edge']:
-                original_speed = edge_data['maxspeed']
-                adjusted_speed = original_speed * adjustment_factor
-                # Update the edge information with the adjusted speed (for the specific vehicle)
-                print(f"Vehicle {vehicle_id} on edge {current_edge} speed adjusted from {original_speed} to {adjusted_speed}.")
-                break
+        i = self.edges.lookup(current_edge)
+        if i is None or self.edges.vehicle_edge.get(vehicle_id) != i:
+            return None
+        adjusted_speed = self.edges.maxspeed[i] * adjustment_factor
+        self.link_model.slow_down(vehicle_id, adjustment_factor)
+        if instruments.enabled:
+            instruments.count('network.speed_adjustments')
+        if instruments.trace_level <= DEBUG:
+            instruments.event(DEBUG, 'speed_adjusted', vehicle_id, i, value=adjusted_speed)
+        return adjusted_speed
 
     def add_initial_signal_states(self, num_signals=4):
         """Randomly assigns initial signal states and delays to selected nodes."""
@@ -186,25 +260,61 @@ class TrafficNetwork:
         for node in selected_nodes:
             initial_state = random.choice(self.signal_states)
             delay = random.randint(35, 60)
-            self.node_info[node]['signal_state'] = initial_state
-            self.node_info[node]['signal_index'] = self.signal_states.index(initial_state)
-            self.node_info[node]['delay'] = delay
-            print(f"Node {node} assigned initial signal state: {initial_state} with delay: {delay} seconds")
+            self.signals.add_signal(node, self.signal_states.index(initial_state), delay)
+            self._sync_signal(node)
+            if instruments.trace_level <= INFO:
+                instruments.event(INFO, 'signal_added', None, node, self.signal_states.index(initial_state), delay)
+
+    def load_signal_plans(self, path):
+        """
+        Loads fixed-cycle signal plans from a CSV or JSON file (see SignalController.load_plans).
+
+        :param path: The plan file.
+        :return: The list of nodes that got a plan.
+        :raises ValueError: If a plan is invalid or for a node that isn't in the network; no plan is loaded then.
+        """
+        nodes = self.signals.load_plans(path, known_nodes=self.node_info)
+        for node in nodes:
+            self._sync_signal(node)
+        return nodes
 
     def update_signal_states(self):
-        """Updates the signal states based on random timing in a non-blocking manner."""
-        current_time = time.time()
+        """Switches the signals that are due, touching only those signals."""
+        changed = self.signals.update(self.clock.time())
+        for node in changed:
+            info = self._sync_signal(node)
+            if instruments.trace_level <= INFO:
+                instruments.event(INFO, 'signal_changed', None, node, info['signal_index'], info['delay'])
+        if instruments.enabled:
+            instruments.count('signals.flips', len(changed))
+
+    def _sync_signal(self, node):
+        """Copies a signal's phase from the signal controller into node_info."""
+        info = self.node_info[node]
+        info['signal_index'] = self.signals.state_index[node]
+        info['signal_state'] = self.signal_states[info['signal_index']]
+        info['delay'] = self.signals.delay[node]
+        return info
+
+    def sync_signals(self):
+        """Copies every signal from the signal controller into node_info, clearing nodes that no longer have one."""
         for node, info in self.node_info.items():
-            if info['signal_state'] is not None:
-                elapsed_time = current_time - self.start_time
-                if elapsed_time >= info['delay']:
-                    # Update the signal state
-                    info['signal_index'] = (info['signal_index'] + 1) % len(self.signal_states)
-                    info['signal_state'] = self.signal_states[info['signal_index']]
-                    print(f"Node {node} updated to signal state: {info['signal_state']} after delay: {info['delay']} seconds")
-                    # Reset the delay timer
-                    info['delay'] = random.randint(35, 60)
-                    self.start_time = current_time
+            if node in self.signals:
+                self._sync_signal(node)
+            elif info['signal_index'] is not None:
+                info['signal_state'] = info['signal_index'] = info['delay'] = None
+
+    def next_signal_change(self):
+        """Returns the simulated time at which the next signal is due to change, or None if there are no signals."""
+        return self.signals.next_switch_time()
+
+    def update_vehicle_arrival(self, vehicle_id, position):
+        """Take a vehicle that has reached its destination off the network."""
+        self._enter_edge(vehicle_id, None)
+
+    def get_signal_state(self, node):
+        """Returns the current signal state of a node, or None if it has no signal."""
+        return self.signals.state(node)
 
     def get_signal_states(self):
         """Returns the current signal states."""
@@ -0,0 +1,108 @@
+import heapq
+import math
+import os
+from multiprocessing import get_context
+
+import numpy as np
+
+from shared_arrays import SharedArrays
+
+# Per-worker state set up by _init_worker
+_worker = {}
+
+
+def travel_time_matrix(traffic_network, origins, destinations, processes=None, rows_per_task=16):
+    """
+    Compute origin-destination travel times under the network's current congestion.
+
+    The CSR adjacency, the edge costs (get_traffic_time formula) and the output matrix are
+    placed in shared memory. Worker processes attach to them by name and each run
+    one-to-many Dijkstra searches for a block of origins, writing their rows in place.
+
+    :param traffic_network: The traffic network instance.
+    :param origins: Sequence of origin node ids.
+    :param destinations: Sequence of destination node ids.
+    :param processes: Number of worker processes; defaults to the CPU count, 1 runs in-process.
+    :param rows_per_task: Number of origins handed to a worker at a time.
+    :return: A len(origins) x len(destinations) float64 matrix, inf where unreachable.
+    """
+    edges = traffic_network.edges
+    n = len(edges.node_ids)
+    order = np.argsort(edges.start_index, kind='stable')
+    ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edges.start_index, minlength=n), out=ptr[1:])
+    arrays = {
+        'ptr': ptr,
+        'head': edges.end_index[order],
+        'cost': traffic_network.edge_costs()[order],
+        'origins': edges.node_index(np.asarray(origins)),
+        'destinations': edges.node_index(np.asarray(destinations)),
+        'out': np.full((len(origins), len(destinations)), np.inf),
+    }
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    tasks = [(start, min(start + rows_per_task, len(origins))) for start in range(0, len(origins), rows_per_task)]
+
+    if processes <= 1 or len(tasks) <= 1:
+        _load_worker(arrays)
+        try:
+            for task in tasks:
+                _compute_rows(task)
+        finally:
+            _worker.clear()
+        return arrays['out']
+
+    with SharedArrays(arrays) as shared:
+        with get_context().Pool(min(processes, len(tasks)), initializer=_init_worker, initargs=(shared.spec(),)) as pool:
+            for _ in pool.imap_unordered(_compute_rows, tasks):
+                pass
+        return shared['out'].copy()
+
+
+def _init_worker(spec):
+    """Pool initializer: attach to the shared arrays."""
+    _worker['shared'] = SharedArrays.attach(spec)
+    _load_worker(_worker['shared'].arrays)
+
+
+def _load_worker(arrays):
+    """Keep references to the arrays; in a worker these are views of the shared memory, not copies."""
+    for name in ('ptr', 'head', 'cost', 'origins', 'destinations', 'out'):
+        _worker[name] = arrays[name]
+
+
+def _compute_rows(task):
+    """Fill the matrix rows for origins[start:end]."""
+    start, end = task
+    destinations = _worker['destinations'].tolist()
+    targets = set(destinations)
+    out = _worker['out']
+    for row in range(start, end):
+        dist = _one_to_many(int(_worker['origins'][row]), targets)
+        out[row] = [dist.get(d, math.inf) for d in destinations]
+    return end - start
+
+
+def _one_to_many(source, targets):
+    """Dijkstra from source, stopping once every target is settled."""
+    ptr, head, cost = _worker['ptr'], _worker['head'], _worker['cost']
+    dist = {source: 0.0}
+    settled = {}
+    remaining = len(targets)
+    heap = [(0.0, source)]
+    while heap and remaining:
+        d, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled[u] = d
+        if u in targets:
+            remaining -= 1
+        # Only the settled node's edges are read out of the shared arrays
+        first, last = ptr[u:u + 2].tolist()
+        for v, c in zip(head[first:last].tolist(), cost[first:last].tolist()):
+            nd = d + c
+            if nd < dist.get(v, math.inf):
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return settled
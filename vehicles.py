@@ -1,15 +1,158 @@
-import time
+from collections import OrderedDict
+
+import numpy as np
+
+from instrumentation import DEBUG, instruments
+
+# Integer codes for the vehicle states, used by the array-based Fleet
+STATE_CODES = {'waiting': 0, 'entering': 1, 'moving': 2, 'rerouting': 3,
+               'stopped': 4, 'arrived': 5, 'exiting': 6, 'exited': 7}
+STATE_NAMES = list(STATE_CODES)
+
+EMPTY_ROUTE = np.empty(0, dtype=np.int32)
+EMPTY_ROUTE.flags.writeable = False
+
+
+class RouteTable:
+    """
+    Interns routes as read-only int32 arrays of node indices (into the network's sorted node_ids).
+
+    Vehicles travelling between the same (origin, destination) get the same array as long
+    as the route hasn't changed, so many vehicles on one route cost a single buffer.
+    """
+
+    def __init__(self, node_ids, max_routes=100000):
+        """
+        :param node_ids: The network's sorted node ids.
+        :param max_routes: Number of (origin, destination) routes remembered; the oldest are dropped.
+        """
+        self.node_ids = node_ids
+        self.max_routes = max_routes
+        self.routes = OrderedDict()  # (origin, destination) -> int32 array of node indices
+        self.shared = 0  # Number of times an existing route buffer was reused
+
+    def __len__(self):
+        return len(self.routes)
+
+    def node_index(self, nodes):
+        """Returns the int32 indices of the given node ids, raising KeyError for unknown nodes."""
+        nodes = np.asarray(nodes, dtype=self.node_ids.dtype)
+        indices = np.searchsorted(self.node_ids, nodes)
+        found = indices < len(self.node_ids)
+        found[found] = self.node_ids[indices[found]] == nodes[found]
+        if not found.all():
+            raise KeyError(nodes[~found][0].item())
+        return indices.astype(np.int32)
+
+    def intern(self, origin, destination, nodes):
+        """
+        Returns the shared index array for a route.
+
+        :param origin: The node the route starts from.
+        :param destination: The node the route leads to.
+        :param nodes: The node ids of the route after origin.
+        """
+        if not len(nodes):
+            return EMPTY_ROUTE
+        indices = self.node_index(nodes)
+        key = (origin, destination)
+        cached = self.routes.get(key)
+        if cached is not None and np.array_equal(cached, indices):
+            self.shared += 1
+            self.routes.move_to_end(key)
+            return cached
+        indices.flags.writeable = False
+        self.routes[key] = indices
+        self.routes.move_to_end(key)
+        if len(self.routes) > self.max_routes:
+            self.routes.popitem(last=False)
+        return indices
 
 
 class Vehicle:
+    # A few hundred bytes per vehicle matter with millions of queued vehicles
+    __slots__ = ('vehicle_id', 'current_position', 'destination', 'speed', 'next_position',
+                 'state_code', '_route', '_cursor', '_route_table')
+
     def __init__(self, vehicle_id, start_node, destination_node, speed=25):
         self.vehicle_id = vehicle_id
         self.current_position = start_node
         self.destination = destination_node
         self.speed = speed
-        self.state = 'waiting'
-        self.route = []
+        self.state_code = 0  # waiting
         self.next_position = None
+        # The route is a shared node index array; _cursor points at the next node to take
+        self._route = EMPTY_ROUTE
+        self._cursor = 0
+        self._route_table = None
+
+    @property
+    def state(self):
+        return STATE_NAMES[self.state_code]
+
+    @state.setter
+    def state(self, name):
+        self.state_code = STATE_CODES[name]
+
+    @property
+    def route(self):
+        """The node ids still ahead of the vehicle after next_position, as a new list."""
+        if self._cursor >= len(self._route):
+            return []
+        return self._route_table.node_ids[self._route[self._cursor:]].tolist()
+
+    @route.setter
+    def route(self, nodes):
+        nodes = list(nodes)
+        if nodes and self._route_table is None:
+            raise ValueError("Vehicle has no route table yet; use set_route() with the traffic network")
+        self._set_route(nodes)
+
+    @property
+    def route_length(self):
+        """The number of nodes still ahead of the vehicle after next_position."""
+        return len(self._route) - self._cursor
+
+    def set_route(self, nodes, traffic_network):
+        """
+        Replace the vehicle's route, sharing the route buffer with other vehicles on the same trip.
+
+        :param nodes: The node ids after the vehicle's current position.
+        :param traffic_network: The traffic network whose route table interns the route.
+        """
+        self._route_table = traffic_network.route_table
+        self._set_route(nodes)
+
+    def set_route_state(self, route, cursor, traffic_network):
+        """
+        Set the route buffer and cursor directly, e.g. when restoring a checkpoint.
+
+        :param route: A read-only int32 array of node indices, possibly shared with other vehicles.
+        :param cursor: The position in route of the next node to take.
+        :param traffic_network: The traffic network the node indices refer to.
+        """
+        self._route_table = traffic_network.route_table
+        self._route = route
+        self._cursor = cursor
+
+    def route_state(self):
+        """Returns the route buffer and cursor, as accepted by set_route_state."""
+        return self._route, self._cursor
+
+    def _set_route(self, nodes):
+        if self._route_table is None:
+            self._route = EMPTY_ROUTE
+        else:
+            self._route = self._route_table.intern(self.current_position, self.destination, nodes)
+        self._cursor = 0
+
+    def advance_route(self):
+        """Take the next node off the vehicle's route and return it."""
+        if self._cursor >= len(self._route):
+            raise IndexError("advance_route on an empty route")
+        node = self._route_table.node_ids[self._route[self._cursor]].item()
+        self._cursor += 1
+        return node
 
     def initialize_route(self, traffic_network, ctc_unit):
         """
@@ -23,54 +166,72 @@ class Vehicle:
         calculated_route = ctc_unit.calculate_best_route(self.current_position, self.destination, traffic_network)
         
         if calculated_route:
-            self.route = calculated_route
-            self.next_position = self.route.pop(0)
+            self.set_route(calculated_route, traffic_network)
+            self.next_position = self.advance_route()
             self.state = 'moving'
         else:
             self.state = 'waiting'  # If no route could be calculated, remain in the waiting state
 
-        print(f"Vehicle {self.vehicle_id} initialized with route: {self.route}")
+        if instruments.trace_level <= DEBUG:
+            instruments.event(DEBUG, 'route_initialized', self.vehicle_id, self.current_position, self.destination,
+                              self.route_length)
+
 
+    def edge_delays(self, new_position, traffic_network):
+        """
+        Calculate the time needed to move from the current position to new_position.
+
+        :param new_position: The position the vehicle is moving to.
+        :param traffic_network: The traffic network instance to check for traffic conditions.
+        :return: A (travel_time, congestion_delay, intersection_delay) tuple, or None if the edge is unknown.
+        """
+        current_edge = (self.current_position, new_position)
+        
+        edges = traffic_network.edges
+        i = edges.lookup(current_edge)
+        if i is None:
+            return None
+
+        max_speed = edges.maxspeed[i]
+        road_length = edges.length[i]
+
+        # Calculate travel time with potential delays
+        travel_time = road_length / max_speed  # basic travel time at max speed
+        congestion_delay = traffic_network.edge_travel_time(i) - travel_time  # delay due to congestion, as get_traffic_time
+        intersection_delay = traffic_network.node_info.get(new_position, {}).get('delay') or 0  # delay at intersections
+        return float(travel_time), float(congestion_delay), float(intersection_delay)
 
     def update_position(self, new_position, traffic_network):
         """
         Update the vehicle's current position, taking into account delays due to traffic conditions
-        and intersections.
+        and intersections. The delays are spent on the network's simulation clock.
 
         :param new_position: The new position to which the vehicle is moving.
         :param traffic_network: The traffic network instance to check for traffic conditions.
         """
-        # Calculate any additional delay based on traffic conditions
-        current_edge = (self.current_position, new_position)
+        delays = self.edge_delays(new_position, traffic_network)
         
-        if current_edge in traffic_network.edge_info:
-            traffic_density = traffic_network.edge_info[current_edge]['traffic_density']
-            max_speed = traffic_network.edge_info[current_edge]['maxspeed']
-            road_length = traffic_network.edge_info[current_edge]['length']
-
-            # Calculate travel time with potential delays
-            travel_time = road_length / max_speed  # basic travel time at max speed
-            congestion_delay = traffic_density * (road_length / max_speed) * 0.01  # delay due to congestion
-            intersection_delay = traffic_network.node_info.get(new_position, {}).get('delay', 0)  # delay at intersections
+        if delays is not None:
+            travel_time, congestion_delay, intersection_delay = delays
 
             # Total delay
             total_delay = congestion_delay + intersection_delay
 
-            # Log the calculated delays for debugging purposes
-            print(f"Vehicle {self.vehicle_id} moving from {self.current_position} to {new_position} "
-                f"with delays - Congestion: {congestion_delay:.2f}s, Intersection: {intersection_delay:.2f}s, "
-                f"Total: {total_delay:.2f}s")
+            # Trace the calculated delays for debugging purposes
+            if instruments.trace_level <= DEBUG:
+                instruments.event(DEBUG, 'vehicle_moved', self.vehicle_id, self.current_position, new_position,
+                                  total_delay)
 
-            # Update the current position after applying the delay
+            # Update the current position after spending the travel time and delays on the simulated clock
             self.current_position = new_position
-            time.sleep(total_delay)  # Simulate the delay in movement
+            traffic_network.clock.sleep(travel_time + total_delay)
         else:
             # If the edge info is not available, just move the vehicle to the new position
             self.current_position = new_position
 
         # Check if the vehicle has reached its destination
         if self.current_position == self.destination:
-            self.arrive()
+            self.arrive(traffic_network)
 
 
 
@@ -92,59 +253,66 @@ class Vehicle:
             
             # Decision-making based on traffic conditions
             if traffic_density > ctc_unit.threshold_density:  # Assume the CTCU has a threshold for rerouting
-                print(f"Vehicle {self.vehicle_id} encountering congestion on edge {current_edge}. Requesting reroute.")
+                if instruments.trace_level <= DEBUG:
+                    instruments.event(DEBUG, 'congestion_reroute', self.vehicle_id, self.current_position,
+                                      self.next_position, traffic_density)
                 new_route = ctc_unit.calculate_best_route(self.current_position, self.destination, traffic_network)
-                self.reroute(new_route)
+                if new_route:
+                    self.set_route(new_route, traffic_network)
+                    self.next_position = self.advance_route()
+                else:
+                    self.reroute(traffic_network, self.destination, ctc_unit)
             else:
                 # Proceed to the next position
                 self.update_position(self.next_position, traffic_network)
                 
                 # Move to the next node in the route if available
-                if self.route:
-                    self.next_position = self.route.pop(0)
-                else:
-                    self.arrive()  # If there's no more nodes, the vehicle has arrived
+                if self.route_length:
+                    self.next_position = self.advance_route()
+                elif self.state != 'arrived':  # update_position already handles reaching the destination
+                    self.arrive(traffic_network)  # If there's no more nodes, the vehicle has arrived
 
         elif self.state == 'rerouting':
             # If in rerouting state, attempt to reroute or stop if no viable route is found
-            if self.route:
+            if self.route_length:
                 self.state = 'moving'
-                self.next_position = self.route.pop(0)
-                print(f"Vehicle {self.vehicle_id} resumed moving after reroute.")
+                self.next_position = self.advance_route()
+                if instruments.trace_level <= DEBUG:
+                    instruments.event(DEBUG, 'vehicle_resumed', self.vehicle_id, self.current_position)
             else:
-                self.stop()  # If no route is found, stop the vehicle
-                print(f"Vehicle {self.vehicle_id} could not find a viable route and has stopped.")
+                self.stop('no_route')  # If no route is found, stop the vehicle
 
         elif self.state == 'stopped':
             # If the vehicle is stopped, check for possible conditions to resume or remain stopped
             if self.next_position:
                 # Check if the stop condition (e.g., temporary congestion) has been resolved
+                current_edge = (self.current_position, self.next_position)
                 traffic_density = traffic_network.edge_info.get(current_edge, {}).get('traffic_density', 0)
                 if traffic_density <= ctc_unit.threshold_density:
                     self.state = 'moving'
-                    print(f"Vehicle {self.vehicle_id} is resuming movement after stop.")
-                else:
-                    print(f"Vehicle {self.vehicle_id} remains stopped due to continued congestion.")
-            else:
-                print(f"Vehicle {self.vehicle_id} remains stopped with no further route planned.")
+                    if instruments.trace_level <= DEBUG:
+                        instruments.event(DEBUG, 'vehicle_resumed', self.vehicle_id, self.current_position)
 
 
-        def stop(self, reason="unknown"):
-            """
-            Stop the vehicle, typically used when the vehicle reaches its destination, in case of congestion, or other reasons.
-            
-            :param reason: The reason for stopping the vehicle (e.g., "destination", "congestion", "emergency").
-            """
-            self.state = 'stopped'
-            self.next_position = None
-            
-            # Log the stop event with the reason
-            print(f"Vehicle {self.vehicle_id} has stopped. Reason: {reason}.")
-            
-            # Optionally, communicate the stop event to the CTCU
-            # traffic_network.report_stop(self.vehicle_id, self.current_position, reason)
-            
-            # Additional logic can be added here if necessary, e.g., handling emergency stops or recalculating routes
+    def stop(self, reason="unknown"):
+        """
+        Stop the vehicle, typically used when the vehicle reaches its destination, in case of congestion, or other reasons.
+        
+        :param reason: The reason for stopping the vehicle (e.g., "destination", "congestion", "emergency").
+        """
+        self.state = 'stopped'
+        self.next_position = None
+        
+        # Trace the stop event with the reason
+        if instruments.enabled:
+            instruments.count('vehicles.stopped')
+        if instruments.trace_level <= DEBUG:
+            instruments.event(DEBUG, 'vehicle_stopped', self.vehicle_id, self.current_position, reason)
+        
+        # Optionally, communicate the stop event to the CTCU
+        # traffic_network.report_stop(self.vehicle_id, self.current_position, reason)
+        
+        # Additional logic can be added here if necessary, e.g., handling emergency stops or recalculating routes
 
 
     def reroute(self, traffic_network, destination_node, ctc_unit):
@@ -157,6 +325,8 @@ class Vehicle:
         :param ctc_unit: The Central Traffic Control Unit (CTCU) instance for additional rerouting decisions.
         """
         # self.state = 'rerouting'
+        if instruments.enabled:
+            instruments.count('vehicles.reroutes')
         current_node = self.current_position
         
         # Step 1: Get neighbors of the current node
@@ -164,10 +334,11 @@ class Vehicle:
         
         best_neighbor = None
         best_value = float('inf')
+        visited = {current_node}  # Nodes already on the new route, for constant-time loop checks
         
         # Step 2: Evaluate each neighbor based on traffic and distance to destination
         for neighbor in neighbors:
-            if neighbor in self.route:  # Avoid loops
+            if neighbor in visited:  # Avoid loops
                 continue
 
             traffic_time = traffic_network.get_traffic_time(current_node, neighbor)
@@ -181,15 +352,16 @@ class Vehicle:
                 best_neighbor = neighbor
         
         # Step 3: Update the route
-        if best_neighbor:
-            self.route = [best_neighbor]  # Start the new route with the best neighbor
+        if best_neighbor is not None:
+            route = [best_neighbor]  # Start the new route with the best neighbor
+            visited.add(best_neighbor)
             while best_neighbor != destination_node:
                 neighbors = traffic_network.get_neighbors(best_neighbor)
                 best_value = float('inf')
                 next_best_neighbor = None
                 
                 for neighbor in neighbors:
-                    if neighbor in self.route:  # Avoid loops
+                    if neighbor in visited:  # Avoid loops
                         continue
                     
                     traffic_time = traffic_network.get_traffic_time(best_neighbor, neighbor)
@@ -201,18 +373,21 @@ class Vehicle:
                         best_value = evaluation_value
                         next_best_neighbor = neighbor
                 
-                if next_best_neighbor:
+                if next_best_neighbor is not None:
                     best_neighbor = next_best_neighbor
-                    self.route.append(best_neighbor)
+                    route.append(best_neighbor)
+                    visited.add(best_neighbor)
                 else:
                     break  # No more valid neighbors
             
-            self.next_position = self.route.pop(0)
+            self.set_route(route, traffic_network)
+            self.next_position = self.advance_route()
             self.state = 'moving'
-            print(f"Vehicle {self.vehicle_id} has been rerouted to new route: {self.route}")
+            if instruments.trace_level <= DEBUG:
+                instruments.event(DEBUG, 'vehicle_rerouted', self.vehicle_id, current_node, destination_node,
+                                  self.route_length)
         else:
-            self.stop()  # If no valid reroute is found, stop the vehicle
-            print(f"Vehicle {self.vehicle_id} could not be rerouted and has stopped.")
+            self.stop('no_route')  # If no valid reroute is found, stop the vehicle
 
 
     def arrive(self, traffic_network):
@@ -224,8 +399,11 @@ class Vehicle:
         self.state = 'arrived'
         self.next_position = None
         
-        # Log the arrival event
-        print(f"Vehicle {self.vehicle_id} has arrived at its destination (Node {self.destination}).")
+        # Trace the arrival event
+        if instruments.enabled:
+            instruments.count('vehicles.arrived')
+        if instruments.trace_level <= DEBUG:
+            instruments.event(DEBUG, 'vehicle_arrived', self.vehicle_id, self.destination)
         
         # Update the traffic network to reflect that the vehicle has completed its journey
         traffic_network.update_vehicle_arrival(self.vehicle_id, self.current_position)
@@ -234,14 +412,14 @@ class Vehicle:
         # traffic_network.notify_ctcu_of_arrival(self.vehicle_id, self.current_position)
         
         # Free up any resources or clear data related to the vehicle's journey
-        self.route = []
+        self._set_route([])
         self.current_position = None  # Optionally reset position if necessary
         
 
     def is_moving(self):
         """Check if the vehicle is currently moving."""
         # Check if the vehicle's state is 'moving' or any other state that implies motion
-        return self.state in ['moving', 'rerouting']
+        return self.state_code in (STATE_CODES['moving'], STATE_CODES['rerouting'])
 
     def enter_network(self, traffic_network, ctc_unit):
         """
@@ -262,11 +440,16 @@ class Vehicle:
         
         # Initialize the vehicle's route with the provided initial route
         if initial_route:
-            self.initialize_route(initial_route)
-            print(f"Vehicle {self.vehicle_id} has entered the network and is starting with route: {self.route}")
+            self.set_route(initial_route, traffic_network)
+            self.next_position = self.advance_route()
+            self.state = 'moving'
         else:
             self.state = 'waiting'  # If no initial route is available, set the vehicle to 'waiting'
-            print(f"Vehicle {self.vehicle_id} has entered the network but is waiting for a route.")
+        if instruments.enabled:
+            instruments.count('vehicles.entered')
+        if instruments.trace_level <= DEBUG:
+            instruments.event(DEBUG, 'vehicle_entered', self.vehicle_id, self.current_position, self.destination,
+                              self.route_length)
 
 
     def exit_network(self, traffic_network, ctc_unit):
@@ -286,13 +469,16 @@ class Vehicle:
         # Notify the CTCU that the vehicle is exiting
         ctc_unit.notify_vehicle_exit(self.vehicle_id)
         
-        # Perform any additional cleanup or logging
-        print(f"Vehicle {self.vehicle_id} has exited the network from position: {self.current_position}")
+        # Perform any additional cleanup or tracing
+        if instruments.enabled:
+            instruments.count('vehicles.exited')
+        if instruments.trace_level <= DEBUG:
+            instruments.event(DEBUG, 'vehicle_exited', self.vehicle_id, self.current_position)
         
         # Reset the vehicle state or perform any other required finalization
         self.state = 'exited'
         self.current_position = None
-        self.route = []
+        self._set_route([])
         self.next_position = None
 
 
@@ -308,10 +494,11 @@ class Vehicle:
         current_edge = (self.current_position, self.next_position)
         
         # Example logic: Check if the other vehicle should move first based on some criteria
-        if traffic_network.should_yield(self.vehicle_id, other_vehicle_id):
-            print(f"Vehicle {self.vehicle_id} is yielding to Vehicle {other_vehicle_id} on edge {current_edge}.")
+        if traffic_network.should_yield(self.vehicle_id, other_vehicle_id, current_edge):
+            if instruments.trace_level <= DEBUG:
+                instruments.event(DEBUG, 'vehicle_yielded', self.vehicle_id, other_vehicle_id,
+                                  traffic_network.edges.lookup(current_edge))
             self.state = 'waiting'  # Temporarily wait if yielding
         else:
-            print(f"Vehicle {self.vehicle_id} is moving ahead of Vehicle {other_vehicle_id} on edge {current_edge}.")
             self.state = 'moving'  # Continue moving
 